@@ -22,6 +22,8 @@ const lambdaStack = new LambdaStack(app, "Assignment3-LambdaStack", {
   bucketName: storageStack.bucket.bucketName,
   tableArn: storageStack.table.tableArn,
   tableName: storageStack.table.tableName,
+  objectIndexTableArn: storageStack.objectIndexTable.tableArn,
+  objectIndexTableName: storageStack.objectIndexTable.tableName,
 });
 
 console.log(`Lambda Stack configured with API URL: ${lambdaStack.apiUrl}`);
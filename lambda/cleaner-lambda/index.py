@@ -1,114 +1,312 @@
-import boto3
+import heapq
 import json
 import os
-from typing import List, Dict, Any, Optional
+from typing import Callable, Iterable, Iterator, List, Dict, Any, Optional, Tuple
 
-s3_client = boto3.client('s3')
+from aws_clients import lazy_client, lazy_resource
+from instrumentation import Metrics
+from listing import list_object_pages
+from s3_events import is_plot_key
+
+metrics = Metrics('cleaner')
+
+s3_client = lazy_client('s3')
+dynamodb: Any = lazy_resource('dynamodb')
 
 BUCKET_NAME = os.environ.get('BUCKET_NAME', '')
+TABLE_NAME = os.environ.get('TABLE_NAME', '')
+OBJECT_INDEX_TABLE_NAME = os.environ.get('OBJECT_INDEX_TABLE_NAME', '')
+OBJECT_SIZE_INDEX_NAME = os.environ.get('OBJECT_SIZE_INDEX_NAME', 'bySize')
+
+# Evict until the bucket is back at or below this size
+TARGET_SIZE_BYTES = int(os.environ.get('TARGET_SIZE_BYTES', '20'))
+EVICTION_POLICY = os.environ.get('EVICTION_POLICY', 'largest')
+
+# Items read per object index page; candidates are consumed lazily
+INDEX_PAGE_SIZE = 100
 
-def get_largest_object(bucket_name: str) -> Optional[Dict[str, Any]]:
+# DeleteObjects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+# Query errors meaning the object index table (ResourceNotFoundException)
+# or its bySize index (ValidationException) does not exist
+INDEX_UNAVAILABLE_ERRORS = ('ResourceNotFoundException', 'ValidationException')
+
+def to_candidate(item: Dict[str, Any]) -> Dict[str, Any]:
     """
-    List all objects in the bucket and find the one with the largest size.
-    Excludes plot files.
-    Returns dict with 'Key' and 'Size', or None if bucket is empty.
+    Convert an object index item to an eviction candidate.
     """
+    last_modified = float(item.get('last_modified', 0))
+    return {
+        'Key': item['objectKey'],
+        'Size': int(item['size']),
+        'LastModified': last_modified,
+        'CreatedAt': float(item.get('created_at', last_modified))
+    }
+
+def query_object_index(bucket_name: str, **query_kwargs) -> Optional[Iterator[Dict[str, Any]]]:
+    """
+    Lazily page through a query of the bucket's partition in the object index.
+    Each further page is only fetched once the previous one is consumed.
+    Returns None when the index is not configured or does not exist.
+    """
+    if not OBJECT_INDEX_TABLE_NAME:
+        return None
+
+    index_table = dynamodb.Table(OBJECT_INDEX_TABLE_NAME)
+    query_kwargs['KeyConditionExpression'] = 'bucketName = :bn'
+    query_kwargs['ExpressionAttributeValues'] = {':bn': bucket_name}
+
     try:
-        print(f"Listing objects in bucket: {bucket_name}")
+        with metrics.stage('dynamodb_read'):
+            response = index_table.query(**query_kwargs)
+    except dynamodb.meta.client.exceptions.ClientError as e:
+        # A missing table or index; anything else (e.g. throttling) is not a
+        # reason to pay for a full listing, and fails the invocation instead
+        if e.response['Error']['Code'] not in INDEX_UNAVAILABLE_ERRORS:
+            raise
+        print(f"Object index unavailable, falling back to listing: {e}")
+        return None
 
-        largest_object = None
-        largest_size = 0
+    def iter_items(response):
+        while True:
+            yield from response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            with metrics.stage('dynamodb_read'):
+                response = index_table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_kwargs)
 
-        # Use paginator to handle buckets with many objects
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket_name)
+    return iter_items(response)
 
-        for page in pages:
-            if 'Contents' not in page:
+def list_objects(bucket_name: str) -> Iterator[Dict[str, Any]]:
+    """
+    List all objects in the bucket as eviction candidates.
+    Excludes plot files.
+    """
+    print(f"Listing objects in bucket: {bucket_name}")
+
+    # Shards of the key space are listed concurrently
+    pages = list_object_pages(bucket_name)
+
+    while True:
+        with metrics.stage('listing'):
+            page = next(pages, None)
+        if page is None:
+            return
+        for object_key, object_size, last_modified in page:
+            # Skip plot files
+            if is_plot_key(object_key):
                 continue
+            yield {
+                'Key': object_key,
+                'Size': object_size,
+                'LastModified': last_modified,
+                # S3 does not expose creation time across overwrites
+                'CreatedAt': last_modified
+            }
+
+def iter_sorted(objects: Iterable[Dict[str, Any]], sort_key: Callable[[Dict[str, Any]], Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Yield objects in ascending sort_key order.
+    Heapifies once and pops lazily, so taking k of n objects costs O(n + k log n).
+    """
+    heap = [(sort_key(obj), i, obj) for i, obj in enumerate(objects)]
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+def iter_live_objects(bucket_name: str, indexed: bool) -> Iterator[Dict[str, Any]]:
+    """
+    All live objects, from the object index when it covers the bucket and
+    is available, else from a listing.
+    """
+    items = query_object_index(
+        bucket_name,
+        FilterExpression='attribute_not_exists(deleted_at)'
+    ) if indexed else None
+    if items is None:
+        return list_objects(bucket_name)
+    return (to_candidate(item) for item in items)
+
+def iter_largest_first(bucket_name: str, indexed: bool) -> Iterator[Dict[str, Any]]:
+    """
+    Largest objects first, read page by page from the size-ordered GSI.
+    """
+    items = query_object_index(
+        bucket_name,
+        IndexName=OBJECT_SIZE_INDEX_NAME,
+        ScanIndexForward=False,  # Largest first
+        Limit=INDEX_PAGE_SIZE
+    ) if indexed else None
+    if items is None:
+        return iter_sorted(list_objects(bucket_name), lambda obj: -obj['Size'])
+    return (to_candidate(item) for item in items)
 
-            for obj in page['Contents']:
-                # Skip plot files
-                if obj['Key'] in ['plot', 'plot.png']:
-                    print(f"Skipping plot file: {obj['Key']}")
-                    continue
+def iter_oldest_first(bucket_name: str, indexed: bool) -> Iterator[Dict[str, Any]]:
+    """
+    Objects whose key was created earliest first.
+    """
+    return iter_sorted(iter_live_objects(bucket_name, indexed), lambda obj: obj['CreatedAt'])
 
-                print(f"Object: {obj['Key']} - Size: {obj['Size']} bytes")
+def iter_least_recently_modified(bucket_name: str, indexed: bool) -> Iterator[Dict[str, Any]]:
+    """
+    Objects that were written least recently first.
+    """
+    return iter_sorted(iter_live_objects(bucket_name, indexed), lambda obj: obj['LastModified'])
 
-                if obj['Size'] > largest_size:
-                    largest_size = obj['Size']
-                    largest_object = {
-                        'Key': obj['Key'],
-                        'Size': obj['Size']
-                    }
+# Eviction policy name -> candidate iterator (given whether the object index
+# covers the bucket), in eviction order
+EVICTION_POLICIES: Dict[str, Callable[[str, bool], Iterator[Dict[str, Any]]]] = {
+    'largest': iter_largest_first,
+    'oldest': iter_oldest_first,
+    'lru': iter_least_recently_modified,
+}
 
-        if largest_object:
-            print(f"Largest object: {largest_object['Key']} ({largest_object['Size']} bytes)")
-        else:
-            print("No objects found in bucket (excluding plot files)")
+def get_current_size(bucket_name: str) -> Tuple[int, bool]:
+    """
+    Current total size of the bucket, and whether the object index covers it.
+    Read from the aggregate's running total, which the size-tracking lambda
+    only keeps while it maintains the object index (TRACKING_MODE=incremental),
+    or computed by listing the bucket when there is none.
+    """
+    if TABLE_NAME:
+        with metrics.stage('dynamodb_read'):
+            response = dynamodb.Table(TABLE_NAME).get_item(
+                Key={'bucketName': f'{bucket_name}#aggregate', 'timestamp': 0},
+                ProjectionExpression='total_size'
+            )
+        if 'total_size' in response.get('Item', {}):
+            return int(response['Item']['total_size']), True
 
-        return largest_object
+    print("Running total not available, computing size by listing the bucket")
+    return sum(obj['Size'] for obj in list_objects(bucket_name)), False
 
-    except Exception as e:
-        print(f"Error listing objects: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+def plan_eviction(candidates: Iterable[Dict[str, Any]], bytes_to_reclaim: int) -> List[Dict[str, Any]]:
+    """
+    Take candidates in policy order until they add up to bytes_to_reclaim.
+    """
+    plan: List[Dict[str, Any]] = []
+    planned_bytes = 0
+
+    for obj in candidates:
+        if planned_bytes >= bytes_to_reclaim:
+            break
+        plan.append(obj)
+        planned_bytes += obj['Size']
+
+    return plan
+
+def delete_objects(bucket_name: str, plan: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Delete the planned objects with DeleteObjects, up to 1000 keys per call.
+    Returns (deleted, errors).
+    """
+    deleted: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+
+    for start in range(0, len(plan), DELETE_BATCH_SIZE):
+        batch = plan[start:start + DELETE_BATCH_SIZE]
 
+        with metrics.stage('delete'):
+            response = s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={
+                    'Objects': [{'Key': obj['Key']} for obj in batch],
+                    'Quiet': True  # Only errors are reported back
+                }
+            )
+
+        failed_keys = {error['Key'] for error in response.get('Errors', [])}
+        errors.extend(response.get('Errors', []))
+        deleted.extend(obj for obj in batch if obj['Key'] not in failed_keys)
+
+    return deleted, errors
+
+@metrics.instrument
 def lambda_handler(event, context):
     """
-    Cleaner Lambda - triggered by CloudWatch Alarm.
-    Deletes the largest object from the bucket.
+    Cleaner Lambda - invoked asynchronously by the size-tracking lambda when
+    a bucket goes over its quota, and by the CloudWatch Alarm as a backstop.
+    Deletes objects, in the order given by the eviction policy, until the
+    bucket is back at or below the target size.
+    A direct invocation may override 'bucketName', 'target_size' and 'policy'.
     """
     print(f"Cleaner Lambda invoked!")
     print(f"Event: {json.dumps(event)}")
 
-    if not BUCKET_NAME:
+    bucket_name = event.get('bucketName') or BUCKET_NAME
+    if not bucket_name:
         print("ERROR: BUCKET_NAME environment variable not set")
         return {
             'statusCode': 500,
             'body': json.dumps('BUCKET_NAME not configured')
         }
 
-    # Find the largest object
-    largest_object = get_largest_object(BUCKET_NAME)
+    target_size = int(event.get('target_size', TARGET_SIZE_BYTES))
+    policy = event.get('policy', EVICTION_POLICY)
 
-    if not largest_object:
-        print("No objects to delete")
+    if policy not in EVICTION_POLICIES:
+        print(f"ERROR: Unknown eviction policy: {policy}")
         return {
-            'statusCode': 200,
-            'body': json.dumps('No objects to delete')
+            'statusCode': 400,
+            'body': json.dumps(f'Unknown eviction policy: {policy}')
         }
 
-    # Delete the largest object
     try:
-        object_key = largest_object['Key']
-        object_size = largest_object['Size']
+        current_size, indexed = get_current_size(bucket_name)
+        bytes_to_reclaim = current_size - target_size
+        print(f"Current size: {current_size} bytes, target: {target_size} bytes")
+
+        if bytes_to_reclaim <= 0:
+            print("Bucket is within target size, nothing to delete")
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': 'No objects to delete',
+                    'current_size': current_size,
+                    'target_size': target_size,
+                    'api_calls': dict(metrics.api_calls)
+                })
+            }
+
+        plan = plan_eviction(EVICTION_POLICIES[policy](bucket_name, indexed), bytes_to_reclaim)
+
+        if not plan:
+            print("No objects to delete")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('No objects to delete')
+            }
 
-        print(f"Deleting largest object: {object_key} ({object_size} bytes)")
+        print(f"Evicting {len(plan)} objects ({policy}) to reclaim {bytes_to_reclaim} bytes")
 
-        s3_client.delete_object(
-            Bucket=BUCKET_NAME,
-            Key=object_key
-        )
+        deleted, errors = delete_objects(bucket_name, plan)
+        bytes_reclaimed = sum(obj['Size'] for obj in deleted)
+        metrics.count('deleted_objects', len(deleted))
 
-        print(f"Successfully deleted {object_key}")
+        print(f"Successfully deleted {len(deleted)} objects ({bytes_reclaimed} bytes)")
+        for error in errors:
+            print(f"Error deleting {error['Key']}: {error.get('Code')} {error.get('Message')}")
 
         return {
-            'statusCode': 200,
+            'statusCode': 500 if errors else 200,
             'body': json.dumps({
-                'message': 'Successfully deleted largest object',
-                'deleted_object': object_key,
-                'deleted_size': object_size
+                'message': f'Deleted {len(deleted)} objects using {policy} policy',
+                'deleted_objects': [obj['Key'] for obj in deleted],
+                'failed_objects': [error['Key'] for error in errors],
+                'bytes_reclaimed': bytes_reclaimed,
+                'current_size': current_size - bytes_reclaimed,
+                'target_size': target_size,
+                'api_calls': dict(metrics.api_calls)
             })
         }
 
     except Exception as e:
-        print(f"Error deleting object: {e}")
+        print(f"Error evicting objects: {e}")
         import traceback
         traceback.print_exc()
 
         return {
             'statusCode': 500,
-            'body': json.dumps(f'Error deleting object: {str(e)}')
+            'body': json.dumps(f'Error deleting objects: {str(e)}')
         }
@@ -1,27 +1,77 @@
-import boto3
 import json
 import os 
 import time
 import urllib3
 
-s3_client = boto3.client('s3')
+from aws_clients import lazy_client
+from instrumentation import Metrics
+from loadgen import run_load
+
+metrics = Metrics('driver')
+
+s3_client = lazy_client('s3')
+dynamodb_client = lazy_client('dynamodb')
 
 # Configuration - use environment variables
 # Extract bucket name from ARN (format: arn:aws:s3:::bucket-name)
 BUCKET_ARN = os.environ.get('BUCKET_ARN', '')
 BUCKET_NAME = BUCKET_ARN.split(':::')[-1] if BUCKET_ARN else os.environ.get('BUCKET_NAME', '')
 API_ENDPOINT = os.environ.get('API_URL', '') 
+TABLE_NAME = os.environ.get('TABLE_NAME', '')
+QUOTA_BYTES = int(os.environ['QUOTA_BYTES'])
+
+# The size-tracking lambda invokes the Cleaner seconds after the bucket goes
+# over its quota, so each step polls for the cleanup instead of sleeping
+# through alarm periods
+CLEANUP_WAIT_SECONDS = 75
+POLL_INTERVAL_SECONDS = 1
+
+def object_exists(object_key: str) -> bool:
+    try:
+        s3_client.head_object(Bucket=BUCKET_NAME, Key=object_key)
+        return True
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def tracked_size() -> int:
+    response = dynamodb_client.get_item(
+        TableName=TABLE_NAME,
+        Key={'bucketName': {'S': f'{BUCKET_NAME}#aggregate'}, 'timestamp': {'N': '0'}},
+        ProjectionExpression='total_size'
+    )
+    return int(response.get('Item', {}).get('total_size', {}).get('N', '0'))
 
+def wait_for_cleanup(object_key: str) -> bool:
+    """
+    Poll until the Cleaner has deleted object_key and the tracked total is
+    back within the quota, for up to CLEANUP_WAIT_SECONDS.
+    Returns False if that did not happen in time.
+    """
+    deadline = time.time() + CLEANUP_WAIT_SECONDS
+    while time.time() < deadline:
+        if not object_exists(object_key) and (not TABLE_NAME or tracked_size() <= QUOTA_BYTES):
+            return True
+        time.sleep(POLL_INTERVAL_SECONDS)
+    return False
+
+@metrics.instrument
 def lambda_handler(event, context):
     """
     Driver lambda for Assignment 4 workflow:
     1. Create assignment1.txt (19 bytes)
-    2. Create assignment2.txt (28 bytes) - total: 47 bytes, triggers alarm, Cleaner deletes assignment2.txt
+    2. Create assignment2.txt (28 bytes) - total: 47 bytes, over quota, Cleaner deletes assignment2.txt
     3. Wait for Cleaner to delete assignment2.txt
-    4. Create assignment3.txt (2 bytes) - total: 21 bytes, triggers alarm, Cleaner deletes assignment1.txt
+    4. Create assignment3.txt (2 bytes) - total: 21 bytes, over quota, Cleaner deletes assignment1.txt
     5. Wait for Cleaner to delete assignment1.txt
     6. Call plotting API
+
+    An event with "mode": "load" runs the load generator instead (see loadgen.py).
     """
+    if event.get('mode') == 'load':
+        return run_load(event, context)
+
     print("Starting driver lambda (Assignment 4)...")
     print(f"Using bucket: {BUCKET_NAME}")
     print(f"Using API: {API_ENDPOINT}")
@@ -44,10 +94,10 @@ def lambda_handler(event, context):
     time.sleep(5)
 
     # Step 2: Create assignment2.txt (28 bytes)
-    # Total size will be 19 + 28 = 47 bytes, which exceeds threshold of 20
-    # This should trigger the alarm and Cleaner should delete assignment2.txt
+    # Total size will be 19 + 28 = 47 bytes, which exceeds the quota of 20
+    # This should trigger a cleanup and Cleaner should delete assignment2.txt
     print("\n=== Step 2: Creating assignment2.txt (28 bytes) ===")
-    print("(This should trigger alarm - total size: 47 bytes > 20 bytes threshold)")
+    print("(This should trigger a cleanup - total size: 47 bytes > 20 bytes quota)")
     try:
         s3_client.put_object(
             Bucket=BUCKET_NAME,
@@ -59,24 +109,18 @@ def lambda_handler(event, context):
         print(f"✗ Error creating assignment2.txt: {e}")
         return {'statusCode': 500, 'body': str(e)}
 
-    # Wait for alarm to fire and Cleaner to delete assignment2.txt
-    # Note: CloudWatch alarm evaluation happens every 1 minute, so we need to wait
-    # for the next evaluation period plus some buffer time for the Cleaner to execute
-    print("\nWaiting 75 seconds for alarm to fire and Cleaner to delete assignment2.txt...")
-    time.sleep(75)
-
-    # Wait for alarm to clear back to OK before creating next file
-    # This ensures the alarm can fire again when assignment3.txt is created
-    print("\nWaiting additional 60 seconds for alarm to clear to OK state...")
-    time.sleep(60)
+    # Wait for Cleaner to delete assignment2.txt and the bucket to be tracked
+    # back within its quota, so the next breach starts a new cleanup
+    print(f"\nWaiting up to {CLEANUP_WAIT_SECONDS} seconds for Cleaner to delete assignment2.txt...")
+    if not wait_for_cleanup('assignment2.txt'):
+        print("⚠ assignment2.txt was not cleaned up in time")
 
     # Step 3: Create assignment3.txt (5 bytes)
     # After Cleaner deletes assignment2.txt, only assignment1.txt (18 bytes) remains
     # Adding assignment3.txt (5 bytes) makes total 23 bytes, which exceeds threshold of 20
-    # Since we waited for alarm to clear to OK, this should trigger alarm again
-    # The alarm will then fire and Cleaner should delete assignment1.txt (the largest)
+    # Cleaner should then delete assignment1.txt (the largest)
     print("\n=== Step 3: Creating assignment3.txt (5 bytes) ===")
-    print("(Alarm should be OK now, this will trigger alarm again)")
+    print("(This should trigger another cleanup)")
     try:
         s3_client.put_object(
             Bucket=BUCKET_NAME,
@@ -88,9 +132,9 @@ def lambda_handler(event, context):
         print(f"✗ Error creating assignment3.txt: {e}")
         return {'statusCode': 500, 'body': str(e)}
 
-    # Wait for alarm to fire and Cleaner to delete assignment1.txt
-    print("\nWaiting 75 seconds for alarm to fire and Cleaner to delete assignment1.txt...")
-    time.sleep(75)
+    print(f"\nWaiting up to {CLEANUP_WAIT_SECONDS} seconds for Cleaner to delete assignment1.txt...")
+    if not wait_for_cleanup('assignment1.txt'):
+        print("⚠ assignment1.txt was not cleaned up in time")
 
     # Step 4: Call the plotting lambda API
     print("\n=== Step 4: Calling plotting API ===")
@@ -121,8 +165,8 @@ def lambda_handler(event, context):
             'message': 'Driver lambda completed successfully (Assignment 4)',
             'operations': [
                 'Created assignment1.txt (18 bytes)',
-                'Created assignment2.txt (27 bytes) - triggered alarm, Cleaner deleted it',
-                'Created assignment3.txt (5 bytes) - triggered alarm, Cleaner deleted assignment1.txt',
+                'Created assignment2.txt (27 bytes) - over quota, Cleaner deleted it',
+                'Created assignment3.txt (5 bytes) - over quota, Cleaner deleted assignment1.txt',
                 'Called plotting API'
             ]
         })
@@ -0,0 +1,316 @@
+"""
+Load-generation mode for the driver lambda.
+
+PUTs (and optionally DELETEs) objects at a target rate through a thread pool,
+then measures how long each operation takes to show up in the pipeline: the
+object index reflects it and the bucket's aggregate item has a sample written
+after it. Returns throughput and latency percentiles.
+"""
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import aws_clients
+
+BUCKET_ARN = os.environ.get('BUCKET_ARN', '')
+BUCKET_NAME = BUCKET_ARN.split(':::')[-1] if BUCKET_ARN else os.environ.get('BUCKET_NAME', '')
+TABLE_NAME = os.environ.get('TABLE_NAME', '')
+OBJECT_INDEX_TABLE_NAME = os.environ.get('OBJECT_INDEX_TABLE_NAME', '')
+
+# Upper bound on worker threads, and the size of the shared connection pools
+MAX_CONCURRENCY = int(os.environ.get('LOAD_MAX_CONCURRENCY', '64'))
+
+DEFAULT_OBJECT_COUNT = 100
+DEFAULT_PUT_RATE = 10.0  # PUTs per second
+DEFAULT_CONCURRENCY = 16
+DEFAULT_KEY_PREFIX = 'load/'
+
+# How often pending operations are checked for visibility
+POLL_INTERVAL_SECONDS = 0.25
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_SIZE = 100
+# Time kept in reserve to build the response before the Lambda times out
+DEADLINE_MARGIN_SECONDS = 5
+
+def get_client(service: str) -> Any:
+    """
+    Shared client whose connection pool is large enough for every worker.
+    Clients are thread-safe and created on first use, so the assignment
+    workflow does not pay for them.
+    """
+    return aws_clients.client(service, max_pool_connections=MAX_CONCURRENCY)
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Nearest-rank p50/p95/p99 in milliseconds of latencies given in seconds.
+    """
+    ordered = sorted(values)
+    result: Dict[str, Optional[float]] = {}
+    for p in (50, 95, 99):
+        if not ordered:
+            result[f'p{p}'] = None
+            continue
+        rank = max(1, math.ceil(p / 100 * len(ordered)))
+        result[f'p{p}'] = round(ordered[rank - 1] * 1000, 1)
+    return result
+
+def make_size_sampler(spec: Dict[str, Any], rng: random.Random):
+    """
+    Object size sampler for a distribution spec, e.g.
+    {"type": "fixed", "size": 100}, {"type": "uniform", "min": 1, "max": 1000}
+    or {"type": "lognormal", "mean": 1000, "sigma": 1.0} (mean in bytes).
+    Raises ValueError for unknown or invalid specs.
+    """
+    kind = spec.get('type', 'fixed')
+
+    if kind == 'fixed':
+        size = int(spec.get('size', 100))
+        if size < 0:
+            raise ValueError('size must not be negative')
+        return lambda: size
+
+    if kind == 'uniform':
+        low, high = int(spec.get('min', 1)), int(spec.get('max', 1000))
+        if not 0 <= low <= high:
+            raise ValueError('uniform sizes need 0 <= min <= max')
+        return lambda: rng.randint(low, high)
+
+    if kind == 'lognormal':
+        mean, sigma = float(spec.get('mean', 1000)), float(spec.get('sigma', 1.0))
+        if mean <= 0 or sigma < 0:
+            raise ValueError('lognormal sizes need mean > 0 and sigma >= 0')
+        # Choose mu so that the distribution's mean is the requested mean
+        mu = math.log(mean) - sigma ** 2 / 2
+        return lambda: int(rng.lognormvariate(mu, sigma))
+
+    raise ValueError(f'Unknown size distribution: {kind}')
+
+def build_schedule(object_count: int, put_rate: float, delete_rate: float) -> List[Dict[str, Any]]:
+    """
+    Operations in start-time order (offsets in seconds from the run start).
+    PUT i starts at i / put_rate; DELETE j removes the j-th PUT object at
+    j / delete_rate, so deletes never overtake the puts they target.
+    """
+    schedule = [
+        {'op': 'put', 'index': i, 'offset': i / put_rate}
+        for i in range(object_count)
+    ]
+    if delete_rate > 0:
+        duration = object_count / put_rate
+        delete_count = min(object_count, int(duration * delete_rate))
+        schedule.extend(
+            {'op': 'delete', 'index': j, 'offset': j / delete_rate}
+            for j in range(delete_count)
+        )
+    schedule.sort(key=lambda op: (op['offset'], op['op'] == 'delete'))
+    return schedule
+
+class VisibilityWatcher(threading.Thread):
+    """
+    Polls the pipeline's DynamoDB tables for completed S3 operations.
+    An operation is visible once the object index reflects it and the
+    aggregate item's last sample is not older than the operation. The
+    size-tracking lambda writes the index before the sample, so this is
+    the first sample that can include the operation.
+    All pending operations share one BatchGetItem per 100 keys per poll.
+    """
+
+    def __init__(self, deadline: float):
+        super().__init__(daemon=True)
+        self.deadline = deadline
+        self.pending: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.submitting = True
+
+    def add(self, op: Dict[str, Any]) -> None:
+        with self.lock:
+            self.pending.append(op)
+
+    def reflects(self, op: Dict[str, Any], item: Optional[Dict[str, Any]]) -> bool:
+        # Keys are unique per run, so any record for a PUT key is this PUT
+        if op['op'] == 'put':
+            return item is not None
+        return item is None or 'deleted_at' in item
+
+    def poll(self) -> None:
+        dynamodb = get_client('dynamodb')
+        with self.lock:
+            pending = [op for op in self.pending if not op.get('indexed')]
+
+        for start in range(0, len(pending), BATCH_GET_SIZE):
+            chunk = pending[start:start + BATCH_GET_SIZE]
+            keys = {op['key'] for op in chunk}
+            response = dynamodb.batch_get_item(RequestItems={
+                OBJECT_INDEX_TABLE_NAME: {
+                    'Keys': [
+                        {'bucketName': {'S': BUCKET_NAME}, 'objectKey': {'S': key}}
+                        for key in keys
+                    ],
+                    'ProjectionExpression': 'objectKey, deleted_at',
+                    'ConsistentRead': True
+                }
+            })
+            items = {
+                item['objectKey']['S']: item
+                for item in response['Responses'].get(OBJECT_INDEX_TABLE_NAME, [])
+            }
+            # Unprocessed keys are simply checked again on the next poll
+            unprocessed = {
+                key['objectKey']['S']
+                for key in response.get('UnprocessedKeys', {})
+                .get(OBJECT_INDEX_TABLE_NAME, {}).get('Keys', [])
+            }
+            for op in chunk:
+                if op['key'] not in unprocessed and self.reflects(op, items.get(op['key'])):
+                    op['indexed'] = True
+
+        # Read after the index, so a sample seen here was written after it
+        response = dynamodb.get_item(
+            TableName=TABLE_NAME,
+            Key={'bucketName': {'S': f'{BUCKET_NAME}#aggregate'}, 'timestamp': {'N': '0'}},
+            ProjectionExpression='last_timestamp',
+            ConsistentRead=True
+        )
+        last_timestamp = float(response.get('Item', {}).get('last_timestamp', {}).get('N', 0))
+
+        now = time.time()
+        with self.lock:
+            still_pending = []
+            for op in self.pending:
+                if op.get('indexed') and last_timestamp >= op['started']:
+                    op['latency'] = now - op['started']
+                else:
+                    still_pending.append(op)
+            self.pending = still_pending
+
+    def run(self) -> None:
+        while time.time() < self.deadline:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling for visibility: {e}")
+            with self.lock:
+                if not self.submitting and not self.pending:
+                    return
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+def run_load(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Load-generation mode: {"mode": "load", ...} with optional
+    object_count, size_distribution, key_prefix, put_rate, delete_rate
+    (operations per second), concurrency and seed.
+    """
+    try:
+        object_count = int(event.get('object_count', DEFAULT_OBJECT_COUNT))
+        put_rate = float(event.get('put_rate', DEFAULT_PUT_RATE))
+        delete_rate = float(event.get('delete_rate', 0))
+        concurrency = int(event.get('concurrency', DEFAULT_CONCURRENCY))
+        key_prefix = event.get('key_prefix', DEFAULT_KEY_PREFIX)
+        rng = random.Random(event.get('seed'))
+        sample_size = make_size_sampler(event.get('size_distribution') or {}, rng)
+
+        if object_count < 1 or put_rate <= 0:
+            raise ValueError('object_count and put_rate must be positive')
+        if not 0 <= delete_rate <= put_rate:
+            raise ValueError('delete_rate must be between 0 and put_rate')
+        if not 1 <= concurrency <= MAX_CONCURRENCY:
+            raise ValueError(f'concurrency must be between 1 and {MAX_CONCURRENCY}')
+    except (TypeError, ValueError) as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(f'Invalid load parameters: {str(e)}')
+        }
+
+    run_id = uuid.uuid4().hex[:8]
+    keys = [f'{key_prefix}{run_id}/{i:06d}' for i in range(object_count)]
+    schedule = build_schedule(object_count, put_rate, delete_rate)
+    print(f"Load run {run_id}: {len(schedule)} operations, {concurrency} workers")
+
+    if context is not None:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+    else:
+        deadline = time.time() + 300
+
+    s3 = get_client('s3')
+    watcher = VisibilityWatcher(deadline)
+    watcher.start()
+    put_futures: Dict[int, Any] = {}
+    operations: List[Dict[str, Any]] = []
+
+    def perform(op: Dict[str, Any]) -> None:
+        if op['op'] == 'delete':
+            # The object must exist before it can be deleted
+            put_futures[op['index']].result()
+        op['started'] = time.time()
+        try:
+            if op['op'] == 'put':
+                s3.put_object(Bucket=BUCKET_NAME, Key=op['key'], Body=b'x' * op['size'])
+            else:
+                s3.delete_object(Bucket=BUCKET_NAME, Key=op['key'])
+        except Exception as e:
+            op['error'] = str(e)
+            return
+        op['request_latency'] = time.time() - op['started']
+        watcher.add(op)
+
+    run_start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for op in schedule:
+            delay = run_start + op['offset'] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if time.time() >= deadline:
+                print("Deadline reached, not submitting further operations")
+                break
+            op['key'] = keys[op['index']]
+            if op['op'] == 'put':
+                op['size'] = sample_size()
+            operations.append(op)
+            future = executor.submit(perform, op)
+            if op['op'] == 'put':
+                put_futures[op['index']] = future
+    submit_seconds = time.time() - run_start
+
+    with watcher.lock:
+        watcher.submitting = False
+    watcher.join(max(0, deadline - time.time()))
+
+    completed = [op for op in operations if 'request_latency' in op]
+    visible = [op for op in completed if 'latency' in op]
+    errors = [op for op in operations if 'error' in op]
+    for op in errors[:10]:
+        print(f"Error on {op['op']} {op['key']}: {op['error']}")
+
+    result = {
+        'message': 'Load run completed',
+        'run_id': run_id,
+        'key_prefix': f'{key_prefix}{run_id}/',
+        'operations': {
+            'put': sum(1 for op in completed if op['op'] == 'put'),
+            'delete': sum(1 for op in completed if op['op'] == 'delete'),
+            'failed': len(errors),
+            'not_submitted': len(schedule) - len(operations)
+        },
+        'bytes_written': sum(op['size'] for op in completed if op['op'] == 'put'),
+        'duration_seconds': round(submit_seconds, 3),
+        'target_ops_per_second': put_rate + delete_rate,
+        'throughput_ops_per_second': round(len(completed) / submit_seconds, 2) if submit_seconds else None,
+        'request_latency_ms': percentiles([op['request_latency'] for op in completed]),
+        'end_to_end_latency_ms': dict(
+            percentiles([op['latency'] for op in visible]),
+            observed=len(visible),
+            timed_out=len(completed) - len(visible)
+        )
+    }
+    print(json.dumps(result))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(result)
+    }
@@ -0,0 +1,109 @@
+"""
+Shared AWS clients for the lambda handlers.
+
+Clients and resources are created on first use, not at import, so a cold
+start only pays for the services its invocation actually calls. They all
+come from one session, keep their connections alive across warm
+invocations and use bounded timeouts with adaptive retries.
+
+    s3_client = lazy_client('s3')
+    table = lazy_table(os.environ['TABLE_NAME'])
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+
+CLIENT_CONFIG = Config(
+    connect_timeout=float(os.environ.get('CLIENT_CONNECT_TIMEOUT_SECONDS', '3')),
+    read_timeout=float(os.environ.get('CLIENT_READ_TIMEOUT_SECONDS', '10')),
+    max_pool_connections=int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '10')),
+    tcp_keepalive=True,
+    retries={
+        'max_attempts': int(os.environ.get('CLIENT_MAX_ATTEMPTS', '5')),
+        'mode': 'adaptive'
+    }
+)
+
+# Called with every new low-level client, e.g. to register event handlers
+client_created_hooks: List[Callable[[Any], Any]] = []
+
+# 'client:<service>' / 'resource:<service>' -> milliseconds it took to create,
+# until collected with pop_init_times()
+init_times: Dict[str, float] = {}
+
+_session: Optional['boto3.session.Session'] = None
+_clients: Dict[Tuple[str, str, tuple], Any] = {}
+_lock = threading.Lock()
+
+def session() -> 'boto3.session.Session':
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+def _get(kind: str, service: str, config: Dict[str, Any]) -> Any:
+    key = (kind, service, tuple(sorted(config.items())))
+    with _lock:
+        if key not in _clients:
+            started = time.perf_counter()
+            factory = session().client if kind == 'client' else session().resource
+            created = factory(service, config=CLIENT_CONFIG.merge(Config(**config)) if config else CLIENT_CONFIG)
+            init_times[f'{kind}:{service}'] = (
+                init_times.get(f'{kind}:{service}', 0.0) + (time.perf_counter() - started) * 1000
+            )
+            for hook in client_created_hooks:
+                hook(created if kind == 'client' else created.meta.client)
+            _clients[key] = created
+        return _clients[key]
+
+def client(service: str, **config) -> Any:
+    """
+    The shared client for a service. Keyword arguments override the shared
+    botocore Config (e.g. max_pool_connections) and get their own client.
+    """
+    return _get('client', service, config)
+
+def resource(service: str, **config) -> Any:
+    """
+    The shared service resource, e.g. for DynamoDB tables.
+    """
+    return _get('resource', service, config)
+
+def pop_init_times() -> Dict[str, float]:
+    """
+    Creation times recorded since the last call.
+    """
+    times = dict(init_times)
+    init_times.clear()
+    return times
+
+class Lazy:
+    """
+    Stands in for an object that is only built, by factory(), the first
+    time one of its attributes is used.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._target = None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._target is None:
+            self._target = self._factory()
+        return getattr(self._target, name)
+
+def lazy_client(service: str) -> Any:
+    return Lazy(lambda: client(service))
+
+def lazy_resource(service: str) -> Any:
+    return Lazy(lambda: resource(service))
+
+def lazy_table(name: str) -> Any:
+    """
+    A DynamoDB Table of the shared resource.
+    """
+    return Lazy(lambda: resource('dynamodb').Table(name))
@@ -0,0 +1,68 @@
+"""
+Concurrent consumption of independent streams of pages.
+
+Each stream (an iterable of pages, e.g. a paginated query or listing) is
+drained by its own task on a thread pool, and their pages are yielded as
+they arrive:
+
+    for page in iter_concurrently([list_shard(...), list_shard(...)], max_workers=8):
+        ...
+
+Pages of one stream keep their order; pages of different streams interleave.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, List, TypeVar
+
+T = TypeVar('T')
+
+_DONE = object()
+
+def iter_concurrently(streams: List[Iterable[T]], max_workers: int) -> Iterator[T]:
+    """
+    Yield the pages of every stream, draining up to max_workers streams at
+    once. An exception raised by a stream is raised here. Closing the
+    generator early stops the remaining streams and waits for the running
+    ones to notice.
+    """
+    workers = max(1, min(max_workers, len(streams)))
+    # Bounded, so workers stay at most a couple of pages ahead of the consumer
+    pages: queue.Queue = queue.Queue(maxsize=2 * workers)
+    stopped = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work(stream: Iterable[T]) -> None:
+        try:
+            for page in stream:
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for stream in streams:
+            executor.submit(work, stream)
+        remaining = len(streams)
+        while remaining:
+            item = pages.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True, cancel_futures=True)
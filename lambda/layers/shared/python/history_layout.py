@@ -0,0 +1,53 @@
+"""
+Partitions of a bucket's size history, as written by the size-tracking
+lambda and read back by the plotting lambda.
+
+    {bucket}#aggregate      running totals, last sample, all-time max/min
+    {bucket}, {bucket}#N    raw samples (HISTORY_SHARDS > 1 spreads them)
+    {partition}#packed      raw samples packed into blocks (packed_history)
+    {bucket}#{tier}         rollups, one item per ROLLUP_TIERS window
+"""
+import os
+from decimal import Decimal
+from typing import List
+
+from packed_history import HISTORY_LAYOUT, TIMESTAMP_SCALE, packed_partition
+
+# Raw samples are spread over this many partitions ({bucket}#0 ...) so a
+# busy bucket's writes are not limited to one partition; 1 keeps them all
+# in the {bucket} partition. Readers query every shard and merge them.
+HISTORY_SHARDS = int(os.environ.get('HISTORY_SHARDS', '1'))
+
+# Rollup tier -> window length in seconds, finest first. Every tier keeps
+# one item per window with the min/max/last size and the number of samples in it.
+ROLLUP_TIERS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+def sample_partition(bucket_name: str, timestamp: Decimal) -> str:
+    """
+    Partition of the raw sample taken at timestamp. Samples are assigned to
+    shards by their microsecond timestamp, which spreads them evenly.
+    """
+    if HISTORY_SHARDS <= 1:
+        return bucket_name
+    return f'{bucket_name}#{int(timestamp * TIMESTAMP_SCALE) % HISTORY_SHARDS}'
+
+def sample_partitions(bucket_name: str) -> List[str]:
+    """
+    Partitions holding the bucket's raw samples: its shards, and the
+    unsharded partition with the samples written before sharding was enabled.
+    """
+    if HISTORY_SHARDS <= 1:
+        return [bucket_name]
+    return [bucket_name] + [f'{bucket_name}#{shard}' for shard in range(HISTORY_SHARDS)]
+
+def packed_partitions(bucket_name: str) -> List[str]:
+    """
+    Partitions holding the bucket's packed sample blocks, if any are written.
+    """
+    if HISTORY_LAYOUT != 'packed':
+        return []
+    return [packed_partition(partition) for partition in sample_partitions(bucket_name)]
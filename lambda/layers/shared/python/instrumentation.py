@@ -0,0 +1,139 @@
+"""
+Per-stage timing for the lambda handlers, logged in CloudWatch embedded
+metric format (EMF): CloudWatch extracts the metrics from the log line, so
+publishing them costs no API calls. Shipped to every function as a layer.
+
+    metrics = Metrics('size-tracking')
+
+    @metrics.instrument
+    def lambda_handler(event, context):
+        with metrics.stage('dynamodb_write'):
+            ...
+        metrics.count('records', len(records))
+
+One EMF line is printed per sampled invocation with the handler's duration,
+the time spent in each stage, the count metrics, whether it was a cold start
+and the AWS API calls it made. Cold starts also report how long the module
+took to import, and any invocation that created clients how long that took.
+"""
+import functools
+import json
+import os
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+
+import aws_clients
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Assignment4App')
+# Fraction of invocations that emit their metrics (0 disables them)
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1'))
+
+class Metrics:
+    """
+    Metrics of one function. Lambda runs one invocation per container at a
+    time, so the current invocation's measurements are kept on the instance.
+    """
+
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.cold_start = True
+        # From here to the handler's definition, i.e. the rest of its module's import
+        self.created = time.perf_counter()
+        self.import_time = 0.0
+        self.stages: Dict[str, float] = {}
+        aws_clients.client_created_hooks.append(self.track)
+        self.counts: Counter = Counter()
+        self.api_calls: Counter = Counter()
+
+    def track(self, client: Any) -> Any:
+        """
+        Count every API call the boto3 client makes as '<service>:<Operation>'.
+        Clients from aws_clients are tracked automatically; for a resource,
+        pass resource.meta.client.
+        """
+        client.meta.events.register('before-call', self.count_api_call)
+        return client
+
+    def count_api_call(self, event_name: str, **kwargs) -> None:
+        # event_name is before-call.<service>.<Operation>
+        _, service, operation = event_name.split('.', 2)
+        self.api_calls[f'{service}:{operation}'] += 1
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Add the time spent in the block to the named stage.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counts[name] += value
+
+    def reset(self) -> None:
+        self.stages = {}
+        self.counts = Counter()
+        self.api_calls = Counter()
+
+    def instrument(self, handler: Callable) -> Callable:
+        """
+        Decorate a lambda handler: measurements start empty for every
+        invocation and are emitted when it returns or raises.
+        """
+        self.import_time = (time.perf_counter() - self.created) * 1000
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            self.reset()
+            started = time.perf_counter()
+            try:
+                return handler(event, context)
+            finally:
+                duration = (time.perf_counter() - started) * 1000
+                client_init = sum(aws_clients.pop_init_times().values())
+                if client_init:
+                    self.stages['client_init'] = client_init
+                if random.random() < METRICS_SAMPLE_RATE:
+                    print(json.dumps(self.emf_record(duration)))
+                self.cold_start = False
+
+        return wrapper
+
+    def emf_record(self, duration: float) -> Dict[str, Any]:
+        """
+        The invocation's measurements as an EMF log record.
+        """
+        metrics = [
+            {'Name': 'duration', 'Unit': 'Milliseconds'},
+            {'Name': 'cold_start', 'Unit': 'Count'},
+            {'Name': 'api_calls', 'Unit': 'Count'},
+        ]
+        if self.cold_start:
+            self.stages['import'] = self.import_time
+        metrics += [{'Name': name, 'Unit': 'Milliseconds'} for name in self.stages]
+        metrics += [{'Name': name, 'Unit': 'Count'} for name in self.counts]
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['function']],
+                    'Metrics': metrics
+                }]
+            },
+            'function': self.function_name,
+            'duration': round(duration, 3),
+            'cold_start': int(self.cold_start),
+            'api_calls': sum(self.api_calls.values()),
+            **{name: round(elapsed, 3) for name, elapsed in self.stages.items()},
+            **self.counts,
+            # Not a metric: the per-operation breakdown, for Logs Insights
+            'api_call_counts': dict(self.api_calls)
+        }
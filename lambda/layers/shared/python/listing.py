@@ -0,0 +1,132 @@
+"""
+Parallel listing of a bucket's objects.
+
+A single ListObjectsV2 paginator makes one sequential call per 1000 objects,
+so a full scan takes longer the larger the bucket. Here the key space is cut
+into shards at split points -- the bucket's common prefixes, discovered with
+a delimiter, plus any configured in LISTING_PREFIXES -- and the shards are
+listed concurrently on a thread pool.
+
+    for page in list_object_pages(bucket_name):
+        for key, size, last_modified in page:
+            ...
+
+Pages arrive as the shards produce them, not in key order. Every key belongs
+to exactly one shard, whatever the split points are, so they only affect how
+evenly the work is spread.
+"""
+import bisect
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import aws_clients
+from concurrency import iter_concurrently
+
+LISTING_MAX_WORKERS = int(os.environ.get('LISTING_MAX_WORKERS', '8'))
+# Comma-separated extra split points, e.g. for flat key spaces with no delimiter
+LISTING_PREFIXES = [prefix for prefix in os.environ.get('LISTING_PREFIXES', '').split(',') if prefix]
+# How many delimiter levels to explore while there are fewer shards than workers
+LISTING_DISCOVERY_DEPTH = int(os.environ.get('LISTING_DISCOVERY_DEPTH', '2'))
+LISTING_DELIMITER = '/'
+
+# (key, size in bytes, last modified as epoch seconds)
+ObjectTuple = Tuple[str, int, float]
+
+def s3_client(max_workers: int) -> Any:
+    """
+    The shared S3 client, or one with a connection per worker if the shared
+    pool is smaller than that.
+    """
+    if max_workers > aws_clients.CLIENT_CONFIG.max_pool_connections:
+        return aws_clients.client('s3', max_pool_connections=max_workers)
+    return aws_clients.client('s3')
+
+def discover_split_points(s3: Any, bucket_name: str, max_workers: int,
+                          depth: int = LISTING_DISCOVERY_DEPTH) -> List[str]:
+    """
+    Common prefixes of the bucket, a level deeper each time there are fewer
+    of them than workers. Only the first page of each delimited listing is
+    read: a partial set of prefixes still makes valid split points, and a
+    flat level must not cost a full listing.
+    """
+    found = set()
+    level = ['']
+    for _ in range(depth):
+        next_level: List[str] = []
+        for prefix in level[:max_workers]:
+            response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix, Delimiter=LISTING_DELIMITER)
+            children = [common['Prefix'] for common in response.get('CommonPrefixes', [])]
+            if children:
+                # Its children split the same range more finely
+                found.discard(prefix)
+            next_level.extend(children)
+        found.update(next_level)
+        if not next_level or len(found) >= max_workers:
+            break
+        level = next_level
+    return sorted(found)
+
+def to_tuples(contents: List[Dict[str, Any]]) -> List[ObjectTuple]:
+    return [(obj['Key'], obj['Size'], obj['LastModified'].timestamp()) for obj in contents]
+
+def list_shard(s3: Any, bucket_name: str, after: Optional[str], upto: Optional[str]) -> Iterator[List[ObjectTuple]]:
+    """
+    Pages of the keys k with after < k <= upto (None: unbounded).
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucket_name}
+    if after is not None:
+        kwargs['StartAfter'] = after
+
+    for page in paginator.paginate(**kwargs):
+        contents = page.get('Contents', [])
+        if upto is not None and contents and contents[-1]['Key'] > upto:
+            # Keys are listed in order: the shard ends inside this page
+            end = bisect.bisect_right([obj['Key'] for obj in contents], upto)
+            yield to_tuples(contents[:end])
+            return
+        yield to_tuples(contents)
+
+def spread(split_points: List[str], count: int) -> List[str]:
+    """
+    At most count of the split points, evenly spaced.
+    """
+    if len(split_points) <= count:
+        return split_points
+    return [split_points[i * len(split_points) // count] for i in range(count)]
+
+def list_object_pages(bucket_name: str, max_workers: int = LISTING_MAX_WORKERS,
+                      prefixes: Optional[List[str]] = None) -> Iterator[List[ObjectTuple]]:
+    """
+    Yield every object of the bucket as pages of (key, size, last_modified)
+    tuples. The first page is listed on its own, so a bucket that fits in
+    it costs one call; the rest is split into about two shards per worker,
+    listed up to max_workers at once. prefixes are split points used in
+    addition to the discovered ones (default: LISTING_PREFIXES).
+    Closing the generator early stops the remaining shards.
+    """
+    s3 = s3_client(max_workers)
+    response = s3.list_objects_v2(Bucket=bucket_name)
+    contents = response.get('Contents', [])
+    yield to_tuples(contents)
+    if not response['IsTruncated']:
+        return
+    listed_upto = contents[-1]['Key']
+
+    split_points: List[str] = []
+    if max_workers > 1:
+        configured = LISTING_PREFIXES if prefixes is None else prefixes
+        discovered = discover_split_points(s3, bucket_name, max_workers)
+        split_points = sorted(point for point in set(discovered).union(configured) if point > listed_upto)
+        split_points = spread(split_points, 2 * max_workers - 1)
+
+    if not split_points:
+        yield from list_shard(s3, bucket_name, listed_upto, None)
+        return
+
+    bounds: List[Optional[str]] = [listed_upto, *split_points, None]
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    print(f"Listing {bucket_name} in {len(shards)} shards with {min(max_workers, len(shards))} workers")
+
+    streams = [list_shard(s3, bucket_name, after, upto) for after, upto in shards]
+    yield from iter_concurrently(streams, max_workers)
@@ -0,0 +1,87 @@
+"""
+Packed layout of the raw size history.
+
+With HISTORY_LAYOUT=packed, raw samples are not written as one item each
+but appended to a block item per PACKED_BLOCK_SECONDS of time, in the
+{partition}#packed partition keyed by the block's start. A block holds its
+samples as three binary columns, each the zlib-compressed little-endian
+int64 deltas of a sorted column:
+
+    timestamps      microseconds since the epoch
+    sizes           total_size
+    object_counts   object_count
+
+A window of raw samples then reads a handful of items, and a reader with
+NumPy decodes a column in one shot:
+
+    np.cumsum(np.frombuffer(unpack_column(item['sizes']), dtype=COLUMN_DTYPE))
+
+Readers also query the per-sample partitions, which keep the samples
+written before the packed layout was enabled.
+"""
+import os
+import struct
+import zlib
+from decimal import Decimal
+from itertools import accumulate
+from typing import Any, Dict, List, Tuple
+
+# 'items' writes one item per raw sample, 'packed' appends them to blocks
+HISTORY_LAYOUT = os.environ.get('HISTORY_LAYOUT', 'items')
+# Time span of a block. Every append rewrites its block, so longer blocks
+# mean fewer items to read but larger writes.
+PACKED_BLOCK_SECONDS = int(os.environ.get('PACKED_BLOCK_SECONDS', '300'))
+
+TIMESTAMP_SCALE = 1000000
+COLUMN_DTYPE = '<i8'
+COLUMNS = ('timestamps', 'sizes', 'object_counts')
+
+# (timestamp in microseconds, total_size, object_count)
+PackedSample = Tuple[int, int, int]
+
+def packed_partition(partition: str) -> str:
+    """
+    Partition of the blocks packing the samples of a per-sample partition.
+    """
+    return f'{partition}#packed'
+
+def block_start(timestamp: Any) -> int:
+    """
+    Sort key of the block holding the sample taken at timestamp (epoch seconds).
+    """
+    return int(timestamp // PACKED_BLOCK_SECONDS) * PACKED_BLOCK_SECONDS
+
+def to_micros(timestamp: Decimal) -> int:
+    return int(timestamp * TIMESTAMP_SCALE)
+
+def from_micros(micros: int) -> Decimal:
+    return Decimal(micros) / TIMESTAMP_SCALE
+
+def pack_column(values: List[int]) -> bytes:
+    deltas = [current - previous for previous, current in zip([0] + values[:-1], values)]
+    return zlib.compress(struct.pack(f'<{len(deltas)}q', *deltas))
+
+def unpack_column(blob: Any) -> bytes:
+    """
+    The raw int64 deltas of a column, as stored (bytes or boto3 Binary).
+    """
+    return zlib.decompress(bytes(blob))
+
+def encode_block(samples: List[PackedSample]) -> Dict[str, Any]:
+    """
+    Block attributes for samples, which must be sorted.
+    """
+    columns = list(zip(*samples)) if samples else [(), (), ()]
+    attributes: Dict[str, Any] = {name: pack_column(list(column)) for name, column in zip(COLUMNS, columns)}
+    attributes['sample_count'] = len(samples)
+    return attributes
+
+def decode_block(item: Dict[str, Any]) -> List[PackedSample]:
+    """
+    The samples of a block item, in timestamp order.
+    """
+    columns = []
+    for name in COLUMNS:
+        raw = unpack_column(item[name])
+        columns.append(list(accumulate(struct.unpack(f'<{len(raw) // 8}q', raw))))
+    return list(zip(*columns))
@@ -0,0 +1,65 @@
+"""
+S3 event notifications as the SQS-subscribed lambdas receive them.
+
+Every SQS message carries an SNS notification whose message is an S3 event
+with one or more records:
+
+    for message_id, s3_event in extract_s3_events_from_sqs(event):
+        for s3_record in s3_event['Records']:
+            ...
+
+Plot artifacts, which the plotting lambda writes to the monitored bucket,
+are not tracked by any of its consumers (is_plot_key).
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+# S3 sequencers are hexadecimal strings; zero-padded to a fixed width they
+# order like the numbers they encode, which is how DynamoDB compares them
+SEQUENCER_WIDTH = 32
+
+PLOT_KEYS = ['plot', 'plot.png']
+# Rendered plots cached by the plotting lambda
+PLOT_CACHE_PREFIX = 'plot-cache/'
+
+# How long removed keys are remembered as tombstones (in the object index
+# and the logging lambda's records), so late or redelivered events for
+# them are still recognized and their size can still be looked up
+TOMBSTONE_TTL_SECONDS = int(os.environ.get('TOMBSTONE_TTL_SECONDS', '86400'))
+
+def is_plot_key(object_key: str) -> bool:
+    """
+    Plot artifacts written by the plotting lambda are not tracked.
+    """
+    return object_key in PLOT_KEYS or object_key.startswith(PLOT_CACHE_PREFIX)
+
+def get_sequencer(s3_record: Dict[str, Any]) -> str:
+    """
+    The record's sequencer, padded so that a later event on the same key
+    compares greater. Empty when the record has none.
+    """
+    sequencer = s3_record['s3']['object'].get('sequencer', '')
+    return sequencer.upper().rjust(SEQUENCER_WIDTH, '0') if sequencer else ''
+
+def extract_s3_events_from_sqs(event: Dict[str, Any]) -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+    """
+    Extract the S3 event from every SQS message in the batch.
+    Event structure: SQS -> SNS -> S3
+    Returns (messageId, s3_event) pairs; s3_event is None for malformed messages.
+    """
+    messages = []
+
+    for sqs_record in event.get('Records', []):
+        message_id = sqs_record.get('messageId', '')
+        try:
+            # Get SNS message from SQS body
+            sqs_body = json.loads(sqs_record['body'])
+            sns_message = json.loads(sqs_body['Message'])
+            messages.append((message_id, sns_message))
+        except (KeyError, TypeError, json.JSONDecodeError) as e:
+            print(f"Error extracting S3 event from message {message_id}: {e}")
+            print(f"Record structure: {json.dumps(sqs_record)}")
+            messages.append((message_id, None))
+
+    return messages
@@ -1,152 +1,225 @@
-import boto3
 import json
 import os
 import time
+import urllib.parse
+from decimal import Decimal
 from typing import Dict, Any, Optional
 
-logs_client = boto3.client('logs')
+from aws_clients import lazy_resource, lazy_table
+from instrumentation import Metrics
+from s3_events import TOMBSTONE_TTL_SECONDS, extract_s3_events_from_sqs, get_sequencer, is_plot_key
+
+metrics = Metrics('logging')
+
+dynamodb: Any = lazy_resource('dynamodb')
+object_index_table = lazy_table(os.environ['OBJECT_INDEX_TABLE_NAME'])
 
 BUCKET_NAME = os.environ.get('BUCKET_NAME', '')
-LOG_GROUP_NAME = os.environ.get('LOG_GROUP_NAME', '')
 
-def extract_s3_event_from_sqs(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+# bucket -> epoch seconds since which this lambda keeps records of its objects
+tracking_since: Dict[str, float] = {}
+
+def consumer_key(bucket_name: str, object_key: str) -> Dict[str, Any]:
+    """
+    Key of this lambda's own record of an object. It lives in the object
+    index under its own partition ({bucket}#logging), so the deltas logged
+    here do not depend on when the size-tracking lambda sees the same event.
+    """
+    return {
+        'bucketName': f'{bucket_name}#logging',
+        'objectKey': object_key
+    }
+
+def record_event(bucket_name: str, object_key: str, sequencer: str,
+                 object_size: Optional[int]) -> Optional[Dict[str, Any]]:
     """
-    Extract S3 event from SQS message containing SNS notification.
-    Event structure: SQS -> SNS -> S3
+    Record an event in this lambda's record of the object: the new size for
+    a creation, a tombstone for a removal (object_size None).
+    With a sequencer, the conditional write only succeeds for events newer
+    than the last one recorded for the key.
+    Returns the previous record ({} if there was none), or None when the
+    event is a duplicate or out of date and must not be logged.
     """
+    if object_size is None:
+        now = int(time.time())
+        assignments = ['deleted_at = :now', 'expires_at = :expires_at']
+        removals = '#size'
+        values: Dict[str, Any] = {':now': now, ':expires_at': now + TOMBSTONE_TTL_SECONDS}
+    else:
+        assignments = ['#size = :size']
+        removals = 'deleted_at, expires_at'
+        values = {':size': object_size}
+
+    update_kwargs: Dict[str, Any] = {}
+    if sequencer:
+        assignments.append('sequencer = :sequencer')
+        values[':sequencer'] = sequencer
+        update_kwargs['ConditionExpression'] = 'attribute_not_exists(sequencer) OR sequencer < :sequencer'
+
     try:
-        # Get SQS message body
-        sqs_record = event['Records'][0]
-        sqs_body = json.loads(sqs_record['body'])
-
-        # Get SNS message from SQS body
-        sns_message = json.loads(sqs_body['Message'])
-
-        # Return the S3 event records
-        return sns_message
-    except (KeyError, IndexError, json.JSONDecodeError) as e:
-        print(f"Error extracting S3 event: {e}")
-        print(f"Event structure: {json.dumps(event)}")
+        with metrics.stage('dynamodb_write'):
+            response = object_index_table.update_item(
+                Key=consumer_key(bucket_name, object_key),
+                UpdateExpression=f'SET {", ".join(assignments)} REMOVE {removals}',
+                ExpressionAttributeNames={'#size': 'size'},
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_OLD',
+                **update_kwargs
+            )
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
         return None
 
-def find_object_creation_size(object_name: str) -> Optional[int]:
+    return response.get('Attributes', {})
+
+def get_tracking_since(bucket_name: str) -> float:
     """
-    Search CloudWatch Logs for the object creation event to find its size.
-    Returns the size in bytes, or None if not found.
+    Epoch seconds since which this lambda keeps records of the bucket's
+    objects. Set before the first record is written, then cached.
     """
-    try:
-        # Search for logs containing the object creation event
-        # Filter pattern to find JSON logs with this object_name and positive size_delta
-        filter_pattern = f'{{ $.object_name = "{object_name}" && $.size_delta > 0 }}'
-
-        print(f"Searching logs for object: {object_name}")
-        print(f"Filter pattern: {filter_pattern}")
-
-        # Query logs from the last 24 hours
-        end_time = int(time.time() * 1000)
-        start_time = end_time - (24 * 60 * 60 * 1000)  # 24 hours ago
-
-        response = logs_client.filter_log_events(
-            logGroupName=LOG_GROUP_NAME,
-            filterPattern=filter_pattern,
-            startTime=start_time,
-            endTime=end_time,
-            limit=10  # We only need the first match
+    if bucket_name not in tracking_since:
+        response = object_index_table.update_item(
+            Key={
+                'bucketName': f'{bucket_name}#logging-state',
+                'objectKey': 'tracking_since'
+            },
+            UpdateExpression='SET since = if_not_exists(since, :now)',
+            ExpressionAttributeValues={':now': Decimal(str(time.time()))},
+            ReturnValues='UPDATED_NEW'
         )
+        tracking_since[bucket_name] = float(response['Attributes']['since'])
+    return tracking_since[bucket_name]
 
-        events = response.get('events', [])
-        print(f"Found {len(events)} matching log events")
+def lookup_object_size(bucket_name: str, object_key: str) -> Optional[int]:
+    """
+    Size of a removed object this lambda has no record of, from the
+    size-tracking lambda's record in the object index.
+    Only objects last written before this lambda started keeping records,
+    and not from a notification, are looked up: for the others, the removal
+    overtook a creation that will still arrive here, as stale.
+    Returns the size in bytes, or None if the object is unknown.
+    """
+    with metrics.stage('size_lookup'):
+        response = object_index_table.get_item(
+            Key={
+                'bucketName': bucket_name,
+                'objectKey': object_key
+            },
+            ProjectionExpression='#size, last_modified, sequencer',
+            ExpressionAttributeNames={'#size': 'size'},
+            ConsistentRead=True
+        )
 
-        if events:
-            # Parse the first matching event
-            log_message = events[0]['message']
-            print(f"Found creation log: {log_message}")
+        item = response.get('Item')
+        if item is None or 'size' not in item or 'sequencer' in item:
+            return None
+        if float(item.get('last_modified', 0)) >= get_tracking_since(bucket_name):
+            return None
+    return int(item['size'])
 
-            # Extract the size_delta from the log message
-            log_data = json.loads(log_message)
-            size_delta = log_data.get('size_delta', 0)
+def build_log_entry(record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Apply a single S3 record and build its JSON size_delta log entry.
+    Returns None for records that should not be logged, including
+    duplicates and records older than one already logged for their key.
+    """
+    event_name = record['eventName']
+    bucket_name = record['s3']['bucket']['name']
+    # Keys arrive URL-encoded in S3 notifications
+    object_key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+    sequencer = get_sequencer(record)
+
+    # Skip plot files
+    if is_plot_key(object_key):
+        metrics.count('ignored_records')
+        return None
 
-            print(f"Extracted size: {size_delta} bytes")
-            return int(size_delta)
-        else:
-            print(f"No creation event found for {object_name}")
+    get_tracking_since(bucket_name)
+
+    # Handle object creation events
+    if event_name.startswith('ObjectCreated'):
+        # Size is available in the event for creation
+        object_size = record['s3']['object'].get('size', 0)
+        previous = record_event(bucket_name, object_key, sequencer, object_size)
+        if previous is None:
+            metrics.count('stale_events')
             return None
 
-    except Exception as e:
-        print(f"Error searching logs: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+        # Overwrites only change the total by the difference
+        return {
+            "object_name": object_key,
+            "size_delta": object_size - int(previous.get('size', 0))
+        }
+
+    # Handle object deletion events
+    if event_name.startswith('ObjectRemoved'):
+        # Size is NOT available in delete events, it comes from our record
+        previous = record_event(bucket_name, object_key, sequencer, None)
+        if previous is None:
+            metrics.count('stale_events')
+            return None
+
+        if 'size' in previous:
+            object_size = int(previous['size'])
+        elif previous:
+            object_size = 0  # Already removed
+        else:
+            object_size = lookup_object_size(bucket_name, object_key)
+            if object_size is None:
+                # Unknown object, logged with size 0
+                metrics.count('unknown_sizes')
+                object_size = 0
+
+        # Negative size_delta
+        return {
+            "object_name": object_key,
+            "size_delta": -object_size
+        }
+
+    return None
 
+@metrics.instrument
 def lambda_handler(event, context):
     """
-    Logging Lambda - consumes S3 events from SQS queue.
+    Logging Lambda - consumes batches of S3 events from SQS queue.
     Logs object creation/deletion with size deltas in JSON format.
+    Each object's events are deduplicated and ordered by their S3 sequencer,
+    so redelivered or overtaken events never reach the size_delta metric.
+    Failed messages are reported through batchItemFailures so only they are retried.
+    Apart from the size_delta entries, per-record outcomes are counted in the
+    invocation's metrics, not logged.
     """
-    print(f"Received event: {json.dumps(event)}")
+    print(f"Received {len(event.get('Records', []))} messages")
 
-    # Extract S3 event from SQS/SNS envelope
-    s3_event = extract_s3_event_from_sqs(event)
-    if not s3_event:
-        return {
-            'statusCode': 400,
-            'body': json.dumps('Invalid event format')
-        }
+    failed_message_ids = []
+
+    # Process every S3 record of every SQS message
+    for message_id, s3_event in extract_s3_events_from_sqs(event):
+        if s3_event is None:
+            failed_message_ids.append(message_id)
+            continue
 
-    # Process each S3 event record
-    for record in s3_event.get('Records', []):
+        # Each entry is logged as soon as its record is applied: when the
+        # message is retried, the records applied so far are seen as duplicates
         try:
-            event_name = record['eventName']
-            bucket_name = record['s3']['bucket']['name']
-            object_key = record['s3']['object']['key']
-
-            print(f"Processing event: {event_name} for object: {object_key}")
-
-            # Skip plot files
-            if object_key in ['plot', 'plot.png']:
-                print(f"Skipping plot file: {object_key}")
-                continue
-
-            # Handle object creation events
-            if event_name.startswith('ObjectCreated'):
-                # Size is available in the event for creation
-                object_size = record['s3']['object'].get('size', 0)
-
-                # Log in JSON format with positive size_delta
-                log_entry = {
-                    "object_name": object_key,
-                    "size_delta": object_size
-                }
-                print(json.dumps(log_entry))
-
-            # Handle object deletion events
-            elif event_name.startswith('ObjectRemoved'):
-                # Size is NOT available in delete events
-                # Need to search logs for the creation event
-                object_size = find_object_creation_size(object_key)
-
-                if object_size is not None:
-                    # Log in JSON format with negative size_delta
-                    log_entry = {
-                        "object_name": object_key,
-                        "size_delta": -object_size
-                    }
-                    print(json.dumps(log_entry))
-                else:
-                    print(f"Warning: Could not find creation size for {object_key}, logging with size 0")
-                    log_entry = {
-                        "object_name": object_key,
-                        "size_delta": 0
-                    }
+            for record in s3_event.get('Records', []):
+                log_entry = build_log_entry(record)
+                if log_entry is not None:
                     print(json.dumps(log_entry))
-
+                    metrics.count('logged_records')
         except Exception as e:
-            print(f"Error processing record: {e}")
+            print(f"Error processing message {message_id}: {e}")
             import traceback
             traceback.print_exc()
-            continue
+            failed_message_ids.append(message_id)
+
+    if failed_message_ids:
+        metrics.count('failed_messages', len(failed_message_ids))
+        print(f"Reporting {len(failed_message_ids)} failed messages for retry")
 
     return {
         'statusCode': 200,
-        'body': json.dumps('Logging completed')
+        'body': json.dumps('Logging completed'),
+        'batchItemFailures': [
+            {'itemIdentifier': message_id} for message_id in failed_message_ids
+        ]
     }
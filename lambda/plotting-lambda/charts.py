@@ -0,0 +1,379 @@
+"""
+Renderers for the bucket size chart (size polyline + dashed max size line).
+The built-in PNG and SVG renderers do not need matplotlib; the matplotlib
+renderer imports it lazily, only when requested.
+"""
+import io
+import math
+import struct
+import zlib
+from typing import List, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+WIDTH = 1000
+HEIGHT = 600
+MARGIN_LEFT = 90
+MARGIN_RIGHT = 30
+MARGIN_TOP = 60
+MARGIN_BOTTOM = 60
+
+BLUE = (31, 119, 180)
+RED = (214, 39, 40)
+GRID = (230, 230, 230)
+AXIS = (0, 0, 0)
+
+# 3x5 bitmap glyphs for the text of the PNG renderer, which is drawn in
+# upper case
+GLYPHS = {
+    '0': ['###', '#.#', '#.#', '#.#', '###'],
+    '1': ['.#.', '##.', '.#.', '.#.', '###'],
+    '2': ['###', '..#', '###', '#..', '###'],
+    '3': ['###', '..#', '###', '..#', '###'],
+    '4': ['#.#', '#.#', '###', '..#', '..#'],
+    '5': ['###', '#..', '###', '..#', '###'],
+    '6': ['###', '#..', '###', '#.#', '###'],
+    '7': ['###', '..#', '..#', '..#', '..#'],
+    '8': ['###', '#.#', '###', '#.#', '###'],
+    '9': ['###', '#.#', '###', '..#', '###'],
+    '.': ['...', '...', '...', '...', '.#.'],
+    '-': ['...', '...', '###', '...', '...'],
+    '+': ['...', '.#.', '###', '.#.', '...'],
+    ' ': ['...', '...', '...', '...', '...'],
+    '(': ['.#.', '#..', '#..', '#..', '.#.'],
+    ')': ['.#.', '..#', '..#', '..#', '.#.'],
+    ':': ['...', '.#.', '...', '.#.', '...'],
+    '_': ['...', '...', '...', '...', '###'],
+    '/': ['..#', '..#', '.#.', '#..', '#..'],
+    'A': ['.#.', '#.#', '###', '#.#', '#.#'],
+    'B': ['##.', '#.#', '##.', '#.#', '##.'],
+    'C': ['.##', '#..', '#..', '#..', '.##'],
+    'D': ['##.', '#.#', '#.#', '#.#', '##.'],
+    'E': ['###', '#..', '##.', '#..', '###'],
+    'F': ['###', '#..', '##.', '#..', '#..'],
+    'G': ['.##', '#..', '#.#', '#.#', '.##'],
+    'H': ['#.#', '#.#', '###', '#.#', '#.#'],
+    'I': ['###', '.#.', '.#.', '.#.', '###'],
+    'J': ['..#', '..#', '..#', '#.#', '.#.'],
+    'K': ['#.#', '#.#', '##.', '#.#', '#.#'],
+    'L': ['#..', '#..', '#..', '#..', '###'],
+    'M': ['#.#', '###', '###', '#.#', '#.#'],
+    'N': ['##.', '#.#', '#.#', '#.#', '#.#'],
+    'O': ['.#.', '#.#', '#.#', '#.#', '.#.'],
+    'P': ['##.', '#.#', '##.', '#..', '#..'],
+    'Q': ['.#.', '#.#', '#.#', '###', '.##'],
+    'R': ['##.', '#.#', '##.', '#.#', '#.#'],
+    'S': ['.##', '#..', '.#.', '..#', '##.'],
+    'T': ['###', '.#.', '.#.', '.#.', '.#.'],
+    'U': ['#.#', '#.#', '#.#', '#.#', '###'],
+    'V': ['#.#', '#.#', '#.#', '#.#', '.#.'],
+    'W': ['#.#', '#.#', '###', '###', '#.#'],
+    'X': ['#.#', '#.#', '.#.', '#.#', '#.#'],
+    'Y': ['#.#', '#.#', '.#.', '.#.', '.#.'],
+    'Z': ['###', '..#', '.#.', '#..', '###'],
+}
+GLYPH_SCALE = 2
+TITLE_SCALE = 3
+
+def nice_ticks(low: float, high: float, count: int = 5) -> List[float]:
+    """
+    Round tick positions (multiples of 1, 2 or 5 x 10^n) covering [low, high].
+    """
+    span = high - low
+    if span <= 0:
+        return [low]
+
+    raw_step = span / count
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= raw_step)
+
+    first = math.ceil(low / step) * step
+    return [first + i * step for i in range(int((high - first) / step + 1e-9) + 1)]
+
+def format_tick(value: float) -> str:
+    return f'{value:g}'
+
+def chart_bounds(relative_times: Sequence[float], sizes: Sequence[int], max_size: int) -> Tuple[float, float, float, float]:
+    """
+    Data ranges shown on the axes: x over the samples, y from -1 to just
+    above the max line (the same limits the matplotlib chart uses).
+    """
+    x_max = max(relative_times[-1], 1.0)
+    y_max = max(max_size, max(sizes)) + 5
+    return 0.0, x_max, -1.0, float(y_max)
+
+def to_pixels(relative_times: Sequence[float], sizes: Sequence[int],
+              bounds: Tuple[float, float, float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Map data coordinates to pixel coordinates of the plot area.
+    """
+    x_min, x_max, y_min, y_max = bounds
+    plot_width = WIDTH - MARGIN_LEFT - MARGIN_RIGHT
+    plot_height = HEIGHT - MARGIN_TOP - MARGIN_BOTTOM
+
+    xs = MARGIN_LEFT + (np.asarray(relative_times, dtype=float) - x_min) / (x_max - x_min) * plot_width
+    ys = HEIGHT - MARGIN_BOTTOM - (np.asarray(sizes, dtype=float) - y_min) / (y_max - y_min) * plot_height
+    return xs, ys
+
+# ----------------------------------------------------------------------------
+# PNG
+# ----------------------------------------------------------------------------
+
+def draw_segments(canvas: np.ndarray, xs: np.ndarray, ys: np.ndarray, color, thickness: int = 1) -> None:
+    """
+    Draw the polyline through (xs, ys), sampling every segment once per pixel.
+    All segments are rasterized together with vectorized NumPy operations.
+    """
+    if len(xs) == 1:
+        px, py = xs, ys
+    else:
+        dx, dy = np.diff(xs), np.diff(ys)
+        steps = np.maximum(np.ceil(np.maximum(np.abs(dx), np.abs(dy))), 1).astype(np.int64)
+        segment = np.repeat(np.arange(len(steps)), steps)
+        # Position along each segment in [0, 1)
+        offsets = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+        t = offsets / steps[segment]
+        px = np.append(xs[:-1][segment] + dx[segment] * t, xs[-1])
+        py = np.append(ys[:-1][segment] + dy[segment] * t, ys[-1])
+
+    stamp_points(canvas, px, py, color, thickness)
+
+def stamp_points(canvas: np.ndarray, px: np.ndarray, py: np.ndarray, color, size: int) -> None:
+    """
+    Paint a size x size square of pixels centred on every point.
+    """
+    px = np.rint(px).astype(np.int64)
+    py = np.rint(py).astype(np.int64)
+    half = size // 2
+
+    for oy in range(-half, size - half):
+        for ox in range(-half, size - half):
+            x, y = px + ox, py + oy
+            inside = (x >= 0) & (x < WIDTH) & (y >= 0) & (y < HEIGHT)
+            canvas[y[inside], x[inside]] = color
+
+def text_mask(text: str, scale: int = GLYPH_SCALE) -> np.ndarray:
+    """
+    The pixels of text in the 3x5 bitmap font, as a boolean array.
+    Characters without a glyph are left blank.
+    """
+    mask = np.zeros((5, max(4 * len(text) - 1, 0)), dtype=bool)
+    for i, char in enumerate(text):
+        glyph = GLYPHS.get(char.upper())
+        if glyph is not None:
+            mask[:, 4 * i:4 * i + 3] = [[pixel == '#' for pixel in line] for line in glyph]
+    return mask.repeat(scale, axis=0).repeat(scale, axis=1)
+
+def draw_mask(canvas: np.ndarray, mask: np.ndarray, x: int, y: int, color=AXIS) -> None:
+    """
+    Paint the pixels set in mask, with its top-left corner at (x, y).
+    """
+    height, width = mask.shape
+    top, left = max(y, 0), max(x, 0)
+    bottom, right = min(y + height, HEIGHT), min(x + width, WIDTH)
+    if bottom > top and right > left:
+        canvas[top:bottom, left:right][mask[top - y:bottom - y, left - x:right - x]] = color
+
+def draw_text(canvas: np.ndarray, text: str, x: int, y: int, align: str = 'left',
+              scale: int = GLYPH_SCALE, vertical: bool = False) -> None:
+    """
+    Draw text with the 3x5 bitmap font; (x, y) is the top-left corner
+    (or top-right with align='right', top-centre with align='center').
+    Vertical text reads bottom to top and is aligned along y instead.
+    """
+    mask = text_mask(text, scale)
+    if vertical:
+        mask = np.rot90(mask)
+        if align == 'center':
+            y -= mask.shape[0] // 2
+    elif align == 'right':
+        x -= mask.shape[1]
+    elif align == 'center':
+        x -= mask.shape[1] // 2
+    draw_mask(canvas, mask, x, y)
+
+def encode_png(canvas: np.ndarray) -> bytes:
+    """
+    Encode an RGB uint8 array as PNG (no filtering, zlib-compressed).
+    """
+    height, width, _ = canvas.shape
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    # Every scanline starts with filter type 0
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = canvas.reshape(height, width * 3)
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b'')
+    ])
+
+def render_png(relative_times: Sequence[float], sizes: Sequence[int], max_size: int, title: str) -> bytes:
+    """
+    Rasterize the chart with NumPy, with title, axis labels and legend in
+    the bitmap font.
+    """
+    canvas = np.full((HEIGHT, WIDTH, 3), 255, dtype=np.uint8)
+    bounds = chart_bounds(relative_times, sizes, max_size)
+    x_min, x_max, y_min, y_max = bounds
+    left, right = MARGIN_LEFT, WIDTH - MARGIN_RIGHT
+    top, bottom = MARGIN_TOP, HEIGHT - MARGIN_BOTTOM
+
+    line_top = 10
+    for i, line in enumerate(title.split('\n')):
+        scale = TITLE_SCALE if i == 0 else GLYPH_SCALE
+        draw_text(canvas, line, WIDTH // 2, line_top, align='center', scale=scale)
+        line_top += 7 * scale
+
+    # Grid and tick labels
+    x_ticks = nice_ticks(x_min, x_max)
+    y_ticks = nice_ticks(max(y_min, 0), y_max)
+    tick_xs, _ = to_pixels(x_ticks, [0] * len(x_ticks), bounds)
+    _, tick_ys = to_pixels([0] * len(y_ticks), y_ticks, bounds)
+    for value, x in zip(x_ticks, np.rint(tick_xs).astype(int)):
+        canvas[top:bottom, x] = GRID
+        draw_text(canvas, format_tick(value), x, bottom + 8, align='center')
+    for value, y in zip(y_ticks, np.rint(tick_ys).astype(int)):
+        canvas[y, left:right] = GRID
+        draw_text(canvas, format_tick(value), left - 8, y - 5, align='right')
+
+    # Axes and axis labels
+    canvas[bottom, left:right] = AXIS
+    canvas[top:bottom + 1, left] = AXIS
+    draw_text(canvas, 'Time (seconds)', (left + right) // 2, HEIGHT - 25, align='center')
+    draw_text(canvas, 'Size (bytes)', 15, (top + bottom) // 2, align='center', vertical=True)
+
+    # Dashed max size line (10px on, 6px off)
+    _, max_y = to_pixels([0], [max_size], bounds)
+    dash_xs = np.array([x for x in range(left, right) if (x - left) % 16 < 10])
+    stamp_points(canvas, dash_xs, np.full(len(dash_xs), max_y[0]), RED, 2)
+
+    # Bucket size polyline, with markers when there are few points
+    xs, ys = to_pixels(relative_times, sizes, bounds)
+    draw_segments(canvas, xs, ys, BLUE, thickness=2)
+    if len(xs) <= 100:
+        stamp_points(canvas, xs, ys, BLUE, 7)
+
+    # Legend, right-aligned in the top corner of the plot area
+    labels = ['Bucket Size', f'Max Size Ever: {max_size} bytes']
+    legend_left = right - 10 - 38 - max(text_mask(label).shape[1] for label in labels)
+    for row, (label, color) in enumerate(zip(labels, (BLUE, RED))):
+        y = top + 15 + row * 20
+        line_xs = np.arange(legend_left, legend_left + 30)
+        if color == RED:
+            line_xs = line_xs[(line_xs - legend_left) % 10 < 6]
+        stamp_points(canvas, line_xs, np.full(len(line_xs), y), color, 2)
+        draw_text(canvas, label, legend_left + 38, y - 5)
+
+    return encode_png(canvas)
+
+# ----------------------------------------------------------------------------
+# SVG
+# ----------------------------------------------------------------------------
+
+def render_svg(relative_times: Sequence[float], sizes: Sequence[int], max_size: int, title: str) -> bytes:
+    """
+    Write the chart as SVG markup, including title, axis labels and legend.
+    """
+    bounds = chart_bounds(relative_times, sizes, max_size)
+    x_min, x_max, y_min, y_max = bounds
+    left, right = MARGIN_LEFT, WIDTH - MARGIN_RIGHT
+    top, bottom = MARGIN_TOP, HEIGHT - MARGIN_BOTTOM
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{WIDTH}" height="{HEIGHT}" '
+        f'viewBox="0 0 {WIDTH} {HEIGHT}" font-family="sans-serif">',
+        f'<rect width="{WIDTH}" height="{HEIGHT}" fill="white"/>',
+    ]
+
+    for i, line in enumerate(title.split('\n')):
+        parts.append(f'<text x="{WIDTH / 2}" y="{22 + i * 20}" font-size="{16 if i == 0 else 13}" '
+                     f'text-anchor="middle">{escape(line)}</text>')
+
+    # Grid and tick labels
+    x_ticks = nice_ticks(x_min, x_max)
+    y_ticks = nice_ticks(max(y_min, 0), y_max)
+    tick_xs, _ = to_pixels(x_ticks, [0] * len(x_ticks), bounds)
+    _, tick_ys = to_pixels([0] * len(y_ticks), y_ticks, bounds)
+    for value, x in zip(x_ticks, tick_xs):
+        parts.append(f'<line x1="{x:.1f}" y1="{top}" x2="{x:.1f}" y2="{bottom}" stroke="#e6e6e6"/>')
+        parts.append(f'<text x="{x:.1f}" y="{bottom + 18}" font-size="11" text-anchor="middle">{format_tick(value)}</text>')
+    for value, y in zip(y_ticks, tick_ys):
+        parts.append(f'<line x1="{left}" y1="{y:.1f}" x2="{right}" y2="{y:.1f}" stroke="#e6e6e6"/>')
+        parts.append(f'<text x="{left - 8}" y="{y + 4:.1f}" font-size="11" text-anchor="end">{format_tick(value)}</text>')
+
+    # Axes and axis labels
+    parts.append(f'<polyline points="{left},{top} {left},{bottom} {right},{bottom}" fill="none" stroke="black"/>')
+    parts.append(f'<text x="{(left + right) / 2}" y="{HEIGHT - 15}" font-size="13" text-anchor="middle">Time (seconds)</text>')
+    parts.append(f'<text x="20" y="{(top + bottom) / 2}" font-size="13" text-anchor="middle" '
+                 f'transform="rotate(-90 20 {(top + bottom) / 2})">Size (bytes)</text>')
+
+    # Max size line
+    _, max_y = to_pixels([0], [max_size], bounds)
+    parts.append(f'<line x1="{left}" y1="{max_y[0]:.1f}" x2="{right}" y2="{max_y[0]:.1f}" '
+                 f'stroke="rgb{RED}" stroke-width="2" stroke-dasharray="10 6"/>')
+
+    # Bucket size polyline
+    xs, ys = to_pixels(relative_times, sizes, bounds)
+    points = ' '.join(f'{x:.1f},{y:.1f}' for x, y in zip(xs, ys))
+    parts.append(f'<polyline points="{points}" fill="none" stroke="rgb{BLUE}" stroke-width="2"/>')
+    if len(xs) <= 100:
+        parts.extend(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="4" fill="rgb{BLUE}"/>' for x, y in zip(xs, ys))
+
+    # Legend
+    parts.append(f'<line x1="{right - 230}" y1="{top + 15}" x2="{right - 200}" y2="{top + 15}" stroke="rgb{BLUE}" stroke-width="2"/>')
+    parts.append(f'<text x="{right - 192}" y="{top + 19}" font-size="12">Bucket Size</text>')
+    parts.append(f'<line x1="{right - 230}" y1="{top + 35}" x2="{right - 200}" y2="{top + 35}" '
+                 f'stroke="rgb{RED}" stroke-width="2" stroke-dasharray="6 4"/>')
+    parts.append(f'<text x="{right - 192}" y="{top + 39}" font-size="12">Max Size Ever: {max_size} bytes</text>')
+
+    parts.append('</svg>')
+    return '\n'.join(parts).encode('utf-8')
+
+# ----------------------------------------------------------------------------
+# matplotlib
+# ----------------------------------------------------------------------------
+
+def render_matplotlib(relative_times: Sequence[float], sizes: Sequence[int], max_size: int, title: str) -> bytes:
+    """
+    High-fidelity PNG rendered with matplotlib, imported on first use.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 6))
+
+    # Plot bucket size changes
+    plt.plot(relative_times, sizes, 'bo-', label='Bucket Size', linewidth=2,
+             markersize=8 if len(sizes) <= 100 else 0)
+
+    # Plot maximum size line
+    plt.axhline(y=max_size, color='r', linestyle='--', linewidth=2, label=f'Max Size Ever: {max_size} bytes')
+
+    # Labels and formatting
+    plt.xlabel('Time (seconds)', fontsize=12)
+    plt.ylabel('Size (bytes)', fontsize=12)
+    plt.title(title, fontsize=14)
+    plt.legend(fontsize=10)
+    plt.grid(True, alpha=0.3)
+
+    # Set y-axis to start from 0 to clearly show the drop to 0 bytes
+    plt.ylim(bottom=-1, top=max_size + 5)
+
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
+    plt.close()
+    return buf.getvalue()
+
+# Renderer name -> (render function, file extension, content type)
+RENDERERS = {
+    'png': (render_png, 'png', 'image/png'),
+    'svg': (render_svg, 'svg', 'image/svg+xml'),
+    'matplotlib': (render_matplotlib, 'png', 'image/png'),
+}
@@ -1,164 +1,968 @@
-import boto3
+import base64
+import hashlib
 import json
+import math
 import os
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
-from typing import Any
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import io
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
 
-s3_client = boto3.client('s3')
-dynamodb: Any = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['TABLE_NAME'])
+from aws_clients import CLIENT_CONFIG, lazy_client, lazy_resource, lazy_table
+from charts import RENDERERS
+from concurrency import iter_concurrently
+from history_layout import ROLLUP_TIERS, packed_partitions, sample_partitions
+from instrumentation import Metrics
+from packed_history import COLUMN_DTYPE, HISTORY_LAYOUT, PACKED_BLOCK_SECONDS, TIMESTAMP_SCALE, unpack_column
+from s3_events import PLOT_CACHE_PREFIX
+from series import ENCODERS, FORMATS, WindowAggregates
+
+metrics = Metrics('plotting')
+
+# Created on first use: a 304 or invalid request never needs the S3 client
+s3_client = lazy_client('s3')
+dynamodb: Any = lazy_resource('dynamodb')
+TABLE_NAME = os.environ['TABLE_NAME']
+table = lazy_table(TABLE_NAME)
 
 # Configuration - Extract bucket name from ARN (format: arn:aws:s3:::bucket-name)
 BUCKET_ARN = os.environ.get('BUCKET_ARN', '')
 BUCKET_NAME = BUCKET_ARN.split(':::')[-1] if BUCKET_ARN else os.environ.get('BUCKET_NAME', '')
 
+# Default time window (seconds) and number of plotted points
+DEFAULT_WINDOW_SECONDS = 300
+DEFAULT_MAX_POINTS = int(os.environ.get('DEFAULT_MAX_POINTS', '1000'))
+MAX_POINTS_LIMIT = 10000
+
+# How long raw samples are kept (0: forever); older ones only live on in the rollups
+RAW_RETENTION_SECONDS = int(os.environ.get('RAW_RETENTION_SECONDS', '604800'))
+
+# 'png' and 'svg' are built-in renderers; 'matplotlib' is the optional
+# high-fidelity path
+DEFAULT_RENDERER = os.environ.get('PLOT_RENDERER', 'png')
+
+# Rendered plots are cached under a key derived from the bucket's latest
+# sample timestamp (watermark) and the request parameters, under PLOT_CACHE_PREFIX
+PLOT_CACHE_VERSION = '5'  # Bump when the rendering changes
+PLOT_MEMORY_CACHE_ENTRIES = int(os.environ.get('PLOT_MEMORY_CACHE_ENTRIES', '32'))
+# Windows without an explicit end are aligned to this many seconds so that
+# repeated requests map to the same cache key
+PLOT_CACHE_QUANTUM_SECONDS = int(os.environ.get('PLOT_CACHE_QUANTUM_SECONDS', '10'))
+
+# Lifetime of the presigned plot_url returned with JSON responses
+PLOT_URL_EXPIRES_SECONDS = int(os.environ.get('PLOT_URL_EXPIRES_SECONDS', '3600'))
+
+# Long plot windows are split into up to this many time segments, of at
+# least PLOT_SEGMENT_MIN_ITEMS items each, and read concurrently on at most
+# PLOT_QUERY_WORKERS threads (also capped by the client's connection pool)
+PLOT_QUERY_SEGMENTS = int(os.environ.get('PLOT_QUERY_SEGMENTS', '8'))
+PLOT_SEGMENT_MIN_ITEMS = int(os.environ.get('PLOT_SEGMENT_MIN_ITEMS', '3600'))
+PLOT_QUERY_WORKERS = int(os.environ.get('PLOT_QUERY_WORKERS', '8'))
+
+# Query endpoint (/query): samples per page, and the quota the time spent
+# above is reported for
+QUERY_DEFAULT_LIMIT = 10000
+QUERY_MAX_LIMIT = 50000
+QUOTA_BYTES = int(os.environ['QUOTA_BYTES'])
+
+# cache key -> (response body, image or None), kept across invocations of a
+# warm container
+plot_memory_cache: "OrderedDict[str, Tuple[Dict[str, Any], Optional[bytes]]]" = OrderedDict()
+
 def decimal_to_float(obj):
     """Helper function to convert Decimal to float for JSON serialization"""
     if isinstance(obj, Decimal):
         return float(obj)
     raise TypeError
 
-def lambda_handler(event, context):
+def get_aggregate(bucket_name: str) -> Dict[str, Any]:
     """
-    Query bucket size history from last 10 seconds and create a plot.
-    Plot includes recent sizes and a horizontal line for max size ever.
+    The bucket's aggregate item (max size ever, last sample timestamp),
+    read with a single GetItem. Empty if the bucket has none.
     """
-    
-    print("Starting plotting lambda...")
+    with metrics.stage('dynamodb_read'):
+        response = table.get_item(
+            Key={'bucketName': f'{bucket_name}#aggregate', 'timestamp': 0},
+            ProjectionExpression='max_size, last_timestamp'
+        )
+    return response.get('Item', {})
 
-    current_time = Decimal(str(time.time()))
-    twenty_seconds_ago = current_time - Decimal('300')
+def unpack_array(blob: Any) -> np.ndarray:
+    """
+    A packed block column as an int64 array.
+    """
+    return np.cumsum(np.frombuffer(unpack_column(blob), dtype=COLUMN_DTYPE))
 
-    # Query items from last 300 seconds (5 minutes) to capture the full workflow
-    try:
-        response = table.query(
-            KeyConditionExpression='bucketName = :bn AND #ts >= :start_time',
-            ExpressionAttributeNames={
-                '#ts': 'timestamp'
+def query_items(query_table: Any, partition: str, query_kwargs: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+    """
+    The items of a query on one partition, a page at a time.
+    query_kwargs may refer to the partition as :bn.
+    """
+    query_kwargs = dict(query_kwargs)
+    query_kwargs['ExpressionAttributeValues'] = dict(query_kwargs['ExpressionAttributeValues'], **{':bn': partition})
+    while True:
+        response = query_table.query(**query_kwargs)
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_max_size(bucket_name: str, aggregate: Dict[str, Any],
+                 stopped: Optional[threading.Event] = None) -> int:
+    """
+    Maximum bucket size ever recorded.
+    Taken from the aggregate item that the size-tracking lambda maintains;
+    buckets without one fall back to paging through the whole history,
+    which stops at the next page once stopped is set.
+    """
+    if 'max_size' in aggregate:
+        return int(aggregate['max_size'])
+
+    print("No aggregate item, scanning the full history")
+    max_size = 0
+    partitions = [(partition, 'total_size') for partition in sample_partitions(bucket_name)]
+    partitions.extend((partition, 'sizes') for partition in packed_partitions(bucket_name))
+    for partition, attribute in partitions:
+        query_kwargs: Dict[str, Any] = {
+            'KeyConditionExpression': 'bucketName = :bn',
+            'ExpressionAttributeValues': {},
+            'ProjectionExpression': attribute
+        }
+        pages = query_items(table, partition, query_kwargs)
+        while True:
+            if stopped is not None and stopped.is_set():
+                return max_size
+            with metrics.stage('dynamodb_read'):
+                items = next(pages, None)
+            if items is None:
+                break
+            for item in items:
+                if attribute == 'sizes':
+                    max_size = max(max_size, int(unpack_array(item['sizes']).max(initial=0)))
+                else:
+                    max_size = max(max_size, int(item['total_size']))
+    return max_size
+
+def finite_float(params: Dict[str, str], name: str) -> float:
+    """
+    A numeric query string parameter; nan and infinities are invalid.
+    """
+    value = float(params[name])
+    if not math.isfinite(value):
+        raise ValueError(f'{name} must be a finite number')
+    return value
+
+def parse_window(params: Dict[str, str]) -> Tuple[float, float]:
+    """
+    start/end (epoch seconds) from the query string, by default the last 5 minutes.
+    """
+    if params.get('end'):
+        end = finite_float(params, 'end')
+    else:
+        # Round up so every sample written so far is still inside the window
+        end = float(math.ceil(time.time() / PLOT_CACHE_QUANTUM_SECONDS) * PLOT_CACHE_QUANTUM_SECONDS)
+    start = finite_float(params, 'start') if params.get('start') else end - DEFAULT_WINDOW_SECONDS
+
+    if start >= end:
+        raise ValueError('start must be before end')
+    return start, end
+
+def parse_request(event: Optional[Dict[str, Any]]) -> Tuple[float, float, int, str, str, str]:
+    """
+    Read start/end (epoch seconds), max_points, renderer, tier and the
+    response format (json or image) from the query string. The format
+    defaults to image when the Accept header asks for an image type.
+    Defaults to the last 5 minutes. Raises ValueError on invalid parameters.
+    """
+    params = (event or {}).get('queryStringParameters') or {}
+    start, end = parse_window(params)
+    max_points = int(params.get('max_points') or DEFAULT_MAX_POINTS)
+
+    if not 2 <= max_points <= MAX_POINTS_LIMIT:
+        raise ValueError(f'max_points must be between 2 and {MAX_POINTS_LIMIT}')
+
+    renderer = params.get('renderer') or DEFAULT_RENDERER
+    if renderer not in RENDERERS:
+        raise ValueError(f'renderer must be one of {", ".join(RENDERERS)}')
+
+    tier = params.get('tier') or 'auto'
+    if tier not in ('auto', 'raw', *ROLLUP_TIERS):
+        raise ValueError(f'tier must be one of auto, raw, {", ".join(ROLLUP_TIERS)}')
+
+    accept = get_request_header(event, 'Accept') or ''
+    output = params.get('format') or ('image' if accept.startswith('image/') else 'json')
+    if output not in ('json', 'image'):
+        raise ValueError('format must be one of json, image')
+
+    return start, end, max_points, renderer, tier, output
+
+def choose_tier(start: float, end: float, max_points: int) -> str:
+    """
+    Coarsest rollup tier whose windows are no wider than one downsampling
+    bucket, or 'raw' when even minute rollups would lose resolution.
+    """
+    bucket_seconds = (end - start) / max(1, max_points // 2)
+    for tier, window in sorted(ROLLUP_TIERS.items(), key=lambda tier: tier[1], reverse=True):
+        if window <= bucket_seconds:
+            return tier
+    return 'raw'
+
+def to_arrays(items: List[Dict[str, Any]], tier: str, start: float,
+              end: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A page of raw samples, packed blocks or rollup items as (timestamps,
+    sizes) arrays.
+    """
+    if tier == 'packed':
+        if not items:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        timestamps = np.concatenate([unpack_array(item['timestamps']) for item in items]) / TIMESTAMP_SCALE
+        sizes = np.concatenate([unpack_array(item['sizes']) for item in items])
+        # Blocks straddling the range edges hold samples outside it
+        inside = (timestamps >= start) & (timestamps <= end)
+        return timestamps[inside], sizes[inside]
+
+    if tier == 'raw':
+        timestamps = np.array([float(item['timestamp']) for item in items])
+        sizes = np.array([int(item['total_size']) for item in items], dtype=np.int64)
+        return timestamps, sizes
+
+    points = ('min', 'max', 'last')
+    timestamps = np.array([float(item[f'{p}_timestamp']) for p in points for item in items])
+    sizes = np.array([int(item[f'{p}_size']) for p in points for item in items], dtype=np.int64)
+    # Windows straddling the range edges may have extremes outside it
+    inside = (timestamps >= start) & (timestamps <= end)
+    return timestamps[inside], sizes[inside]
+
+def prefetch(pages: Iterator[Any], executor: Executor) -> Iterator[Any]:
+    """
+    Iterate over pages, fetching the next one on the executor while the
+    current one is consumed. The first fetch starts right away.
+    """
+    future = executor.submit(next, pages, None)
+
+    def iterate(future):
+        while True:
+            page = future.result()
+            if page is None:
+                return
+            future = executor.submit(next, pages, None)
+            yield page
+
+    return iterate(future)
+
+def merge_pages(streams: List[Iterator[Tuple[np.ndarray, np.ndarray]]]) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Merge streams of (timestamps, sizes) pages, each in timestamp order,
+    into one stream in timestamp order. Samples are passed on as soon as no
+    stream can still produce an earlier one, so memory stays at about one
+    page per stream.
+    """
+    empty = (np.empty(0), np.empty(0, dtype=np.int64))
+    buffers = [empty] * len(streams)
+    active = list(range(len(streams)))
+
+    while True:
+        for i in list(active):
+            while not len(buffers[i][0]):
+                page = next(streams[i], None)
+                if page is None:
+                    active.remove(i)
+                    break
+                buffers[i] = page
+        if not active:
+            return
+
+        # The earliest of the streams' last buffered samples: nothing later
+        # from any stream can come before it
+        horizon = min(buffers[i][0][-1] for i in active)
+        parts = []
+        for i in active:
+            timestamps, sizes = buffers[i]
+            cut = np.searchsorted(timestamps, horizon, side='right')
+            parts.append((timestamps[:cut], sizes[:cut]))
+            buffers[i] = (timestamps[cut:], sizes[cut:])
+
+        timestamps = np.concatenate([part[0] for part in parts])
+        sizes = np.concatenate([part[1] for part in parts])
+        order = np.argsort(timestamps, kind='stable')
+        yield timestamps[order], sizes[order]
+
+def sample_streams(bucket_name: str, start: float, end: float, tier: str = 'raw',
+                   exclusive_end: bool = False) -> List[Iterator[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    One stream of (timestamps, sizes) pages per partition holding the
+    samples in [start, end] (or [start, end) with exclusive_end), each in
+    timestamp order. Nothing is queried until a stream is iterated.
+    Raw samples of a sharded or packed history have several partitions.
+    For a rollup tier, each window overlapping the range contributes its
+    min, max and last sample instead of every raw sample.
+    """
+    # (partition, layout of its items)
+    if tier == 'raw':
+        partitions = [(partition, 'raw') for partition in sample_partitions(bucket_name)]
+        partitions.extend((partition, 'packed') for partition in packed_partitions(bucket_name))
+    else:
+        partitions = [(f'{bucket_name}#{tier}', tier)]
+
+    def query_kwargs(layout: str) -> Dict[str, Any]:
+        if layout == 'raw':
+            range_start, projection = start, '#ts, total_size'
+        elif layout == 'packed':
+            range_start = math.floor(start / PACKED_BLOCK_SECONDS) * PACKED_BLOCK_SECONDS
+            projection = '#ts, timestamps, sizes'
+        else:
+            window = ROLLUP_TIERS[layout]
+            range_start = math.floor(start / window) * window
+            projection = 'min_timestamp, min_size, max_timestamp, max_size, last_timestamp, last_size'
+        return {
+            'KeyConditionExpression': 'bucketName = :bn AND #ts BETWEEN :start_time AND :end_time',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'},
+            'ExpressionAttributeValues': {
+                ':start_time': Decimal(str(range_start)),
+                ':end_time': Decimal(str(end))
             },
-            ExpressionAttributeValues={
-                ':bn': BUCKET_NAME,
-                ':start_time': twenty_seconds_ago
-            }
-        )
+            'ProjectionExpression': projection
+        }
 
-        recent_items = response['Items']
-        print(f"Found {len(recent_items)} items in last 300 seconds")
-        
+    def partition_pages(query_table: Any, partition: str, layout: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        for items in query_items(query_table, partition, query_kwargs(layout)):
+            timestamps, sizes = to_arrays(items, layout, start, end)
+            if exclusive_end:
+                before = timestamps < end
+                timestamps, sizes = timestamps[before], sizes[before]
+            yield timestamps, sizes
+
+    # One Table object per stream, so streams can be read on different
+    # threads: resources are not thread-safe, the client they share is
+    return [partition_pages(dynamodb.Table(TABLE_NAME), partition, layout) for partition, layout in partitions]
+
+def iter_sample_pages(bucket_name: str, start: float, end: float,
+                      tier: str = 'raw') -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Stream the samples in [start, end] one query page at a time,
+    as (timestamps, sizes) arrays in timestamp order.
+    The partitions of a sharded or packed history are queried in parallel
+    and merged.
+    """
+    streams = sample_streams(bucket_name, start, end, tier)
+
+    executor = None
+    if len(streams) == 1:
+        pages = streams[0]
+    else:
+        executor = ThreadPoolExecutor(max_workers=len(streams))
+        pages = merge_pages([prefetch(stream, executor) for stream in streams])
+
+    try:
+        while True:
+            with metrics.stage('dynamodb_read'):
+                page = next(pages, None)
+            if page is None:
+                return
+            if len(page[0]):
+                yield page
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def window_ranges(start: float, end: float, tier: str) -> List[Tuple[float, float, str]]:
+    """
+    The (start, end, tier) ranges a window is read from: the part of a raw
+    window from before the raw retention period comes from the minute
+    rollups it was compacted into.
+    """
+    if tier == 'raw' and RAW_RETENTION_SECONDS:
+        horizon = time.time() - RAW_RETENTION_SECONDS
+        if end <= horizon:
+            return [(start, end, 'minute')]
+        if start < horizon:
+            return [(start, horizon, 'minute'), (horizon, end, tier)]
+    return [(start, end, tier)]
+
+def iter_window_pages(bucket_name: str, start: float, end: float,
+                      tier: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    iter_sample_pages over the window's ranges (see window_ranges), in
+    timestamp order.
+    """
+    for range_start, range_end, range_tier in window_ranges(start, end, tier):
+        yield from iter_sample_pages(bucket_name, range_start, range_end, range_tier)
+
+def split_window(start: float, end: float, tier: str, max_segments: int) -> List[Tuple[float, float]]:
+    """
+    [start, end] cut into at most max_segments time segments of at least
+    PLOT_SEGMENT_MIN_ITEMS items each, assuming raw samples about a second
+    apart. Inner bounds fall on the tier's windows (or packed blocks), so
+    no item straddles two segments.
+    """
+    if tier == 'raw':
+        granularity = PACKED_BLOCK_SECONDS if HISTORY_LAYOUT == 'packed' else 1
+    else:
+        granularity = ROLLUP_TIERS[tier]
+    items = (end - start) / granularity
+    count = int(min(max_segments, max(1, items // PLOT_SEGMENT_MIN_ITEMS)))
+
+    bounds = [start]
+    for i in range(1, count):
+        bound = math.floor((start + (end - start) * i / count) / granularity) * granularity
+        if bounds[-1] < bound < end:
+            bounds.append(float(bound))
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def iter_segmented_pages(bucket_name: str, start: float, end: float,
+                         tier: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    The window's samples as (timestamps, sizes) pages in no particular
+    order, as they arrive: the window is split into time segments (see
+    split_window) whose partitions are all queried concurrently, so a long
+    window takes about as long as its slowest segment rather than the sum
+    of its pages. A history with several partitions gets fewer segments,
+    keeping about one query per worker. Every sample is in exactly one page.
+    Closing the generator early stops the remaining queries.
+    """
+    partitions = len(sample_partitions(bucket_name)) + len(packed_partitions(bucket_name)) if tier == 'raw' else 1
+    workers = min(PLOT_QUERY_WORKERS, CLIENT_CONFIG.max_pool_connections)
+    max_segments = max(1, min(PLOT_QUERY_SEGMENTS, workers // partitions))
+
+    streams = []
+    for segment_start, segment_end in split_window(start, end, tier, max_segments):
+        for range_start, range_end, range_tier in window_ranges(segment_start, segment_end, tier):
+            streams.extend(sample_streams(bucket_name, range_start, range_end, range_tier,
+                                          exclusive_end=range_end < end))
+    if len(streams) == 1:
+        yield from iter_window_pages(bucket_name, start, end, tier)
+        return
+
+    pages = iter_concurrently(streams, workers)
+    try:
+        while True:
+            with metrics.stage('dynamodb_read'):
+                page = next(pages, None)
+            if page is None:
+                return
+            if len(page[0]):
+                yield page
+    finally:
+        pages.close()
+
+def plot_cache_key(bucket_name: str, aggregate: Dict[str, Any], start: float, end: float,
+                   max_points: int, renderer: str, tier: str) -> Optional[str]:
+    """
+    Cache key for a plot: changes whenever a new sample is written or the
+    request parameters differ. None when the bucket has no watermark yet.
+    """
+    if 'last_timestamp' not in aggregate:
+        return None
+
+    fingerprint = '|'.join([
+        PLOT_CACHE_VERSION,
+        bucket_name,
+        str(aggregate['last_timestamp']),
+        repr(start),
+        repr(end),
+        str(max_points),
+        renderer,
+        tier
+    ])
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+def get_request_header(event: Optional[Dict[str, Any]], name: str) -> Optional[str]:
+    """
+    Case-insensitive lookup of an HTTP request header.
+    """
+    headers = (event or {}).get('headers') or {}
+    for header, value in headers.items():
+        if header.lower() == name.lower():
+            return value
+    return None
+
+def get_cached_plot(cache_key: str, renderer: str, with_image: bool) -> Optional[Tuple[Dict[str, Any], Optional[bytes]]]:
+    """
+    Response body of a previously rendered plot, and its image if with_image,
+    from this container's memory or from the S3 plot cache.
+    """
+    body, image = plot_memory_cache.get(cache_key, (None, None))
+    if body is not None and (image is not None or not with_image):
+        plot_memory_cache.move_to_end(cache_key)
+        print(f"Plot cache hit (memory): {cache_key}")
+        return body, image
+
+    _, extension, _ = RENDERERS[renderer]
+    try:
+        with metrics.stage('cache_read'):
+            if body is None:
+                response = s3_client.get_object(
+                    Bucket=BUCKET_NAME,
+                    Key=f'{PLOT_CACHE_PREFIX}{cache_key}.json'
+                )
+                body = json.loads(response['Body'].read())
+            if with_image:
+                response = s3_client.get_object(
+                    Bucket=BUCKET_NAME,
+                    Key=f'{PLOT_CACHE_PREFIX}{cache_key}.{extension}'
+                )
+                image = response['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+    print(f"Plot cache hit (S3): {cache_key}")
+    remember_plot(cache_key, body, image)
+    return body, image
+
+def remember_plot(cache_key: str, body: Dict[str, Any], image: Optional[bytes] = None) -> None:
+    """
+    Keep a response body, and the image if known, in the in-memory LRU plot cache.
+    """
+    plot_memory_cache[cache_key] = (body, image)
+    plot_memory_cache.move_to_end(cache_key)
+    while len(plot_memory_cache) > PLOT_MEMORY_CACHE_ENTRIES:
+        plot_memory_cache.popitem(last=False)
+
+def store_cached_plot(cache_key: str, image: bytes, body: Dict[str, Any], renderer: str) -> None:
+    """
+    Write a rendered plot and its response body to the S3 plot cache.
+    Writes are conditional (If-None-Match: *), so concurrent renders of the
+    same key keep the first copy instead of overwriting it.
+    """
+    remember_plot(cache_key, body, image)
+    _, extension, image_content_type = RENDERERS[renderer]
+
+    for key, payload, content_type in [
+        (f'{PLOT_CACHE_PREFIX}{cache_key}.{extension}', image, image_content_type),
+        (f'{PLOT_CACHE_PREFIX}{cache_key}.json', json.dumps(body).encode('utf-8'), 'application/json'),
+    ]:
+        try:
+            s3_client.put_object(
+                Bucket=BUCKET_NAME,
+                Key=key,
+                Body=payload,
+                ContentType=content_type,
+                IfNoneMatch='*'
+            )
+        except s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'PreconditionFailed':
+                raise
+
+def plot_response(body: Dict[str, Any], cache_key: Optional[str]) -> Dict[str, Any]:
+    """
+    API response for a plot, with the cache key as its ETag. Cached renders
+    come with a presigned plot_url to their image.
+    """
+    if cache_key and body.get('plot_key'):
+        body = dict(body, plot_url=s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': BUCKET_NAME, 'Key': body['plot_key']},
+            ExpiresIn=PLOT_URL_EXPIRES_SECONDS
+        ))
+    response: Dict[str, Any] = {
+        'statusCode': 200,
+        'body': json.dumps(body)
+    }
+    if cache_key:
+        response['headers'] = {
+            'ETag': f'"{cache_key}"',
+            'Cache-Control': 'no-cache'
+        }
+    return response
+
+def image_response(image: bytes, renderer: str, cache_key: Optional[str]) -> Dict[str, Any]:
+    """
+    API response with the image itself as the body, base64-encoded for API
+    Gateway, which returns it as binary to clients that Accept its type.
+    """
+    _, _, content_type = RENDERERS[renderer]
+    headers = {'Content-Type': content_type}
+    if cache_key:
+        headers.update({'ETag': f'"{cache_key}"', 'Cache-Control': 'no-cache'})
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': base64.b64encode(image).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+class MinMaxDownsampler:
+    """
+    Shape-preserving streaming downsampler.
+    Splits [start, end] into max_points // 2 equal time buckets and keeps only
+    the minimum and maximum sample of each, so spikes and drops survive.
+    Memory is O(max_points) regardless of how many samples are fed in.
+    Ties go to the earliest minimum and the latest maximum, so the result
+    does not depend on the order pages are fed in.
+    """
+
+    def __init__(self, start: float, end: float, max_points: int):
+        self.start = start
+        self.n_buckets = max(1, max_points // 2)
+        self.width = (end - start) / self.n_buckets
+        self.count = 0
+        self.min_size = np.full(self.n_buckets, np.iinfo(np.int64).max, dtype=np.int64)
+        self.min_ts = np.zeros(self.n_buckets)
+        self.max_size = np.full(self.n_buckets, np.iinfo(np.int64).min, dtype=np.int64)
+        self.max_ts = np.zeros(self.n_buckets)
+
+    def add(self, timestamps: np.ndarray, sizes: np.ndarray) -> None:
+        """
+        Fold one page of samples into the per-bucket extremes.
+        """
+        self.count += len(sizes)
+        buckets = ((timestamps - self.start) / self.width).astype(np.int64)
+        np.clip(buckets, 0, self.n_buckets - 1, out=buckets)
+
+        # Order by (bucket, size, timestamp): the first/last entry of each
+        # bucket's run is its min/max
+        order = np.lexsort((timestamps, sizes, buckets))
+        sorted_buckets = buckets[order]
+        first = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        last = np.r_[first[1:] - 1, len(order) - 1]
+        touched = sorted_buckets[first]
+
+        page_min, page_max = order[first], order[last]
+
+        lower = ((sizes[page_min] < self.min_size[touched]) |
+                 ((sizes[page_min] == self.min_size[touched]) & (timestamps[page_min] < self.min_ts[touched])))
+        self.min_size[touched[lower]] = sizes[page_min][lower]
+        self.min_ts[touched[lower]] = timestamps[page_min][lower]
+
+        higher = ((sizes[page_max] > self.max_size[touched]) |
+                 ((sizes[page_max] == self.max_size[touched]) & (timestamps[page_max] > self.max_ts[touched])))
+        self.max_size[touched[higher]] = sizes[page_max][higher]
+        self.max_ts[touched[higher]] = timestamps[page_max][higher]
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The downsampled (timestamps, sizes), in timestamp order.
+        """
+        filled = self.min_size <= self.max_size
+        timestamps = np.concatenate([self.min_ts[filled], self.max_ts[filled]])
+        sizes = np.concatenate([self.min_size[filled], self.max_size[filled]])
+
+        # Buckets with a single distinct sample contribute it only once
+        timestamps, unique = np.unique(timestamps, return_index=True)
+        return timestamps, sizes[unique]
+
+def parse_query_request(event: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Read the /query parameters: start/end (as for plots), tier (default raw),
+    format (json, jsonl, csv, arrow), limit samples after cursor (the
+    previous page's next_cursor), aggregates (default true on the first
+    page, false on the pages after a cursor), quota and percentiles
+    (comma-separated). Raises ValueError on invalid parameters.
+    """
+    params = (event or {}).get('queryStringParameters') or {}
+    start, end = parse_window(params)
+    cursor = finite_float(params, 'cursor') if params.get('cursor') else None
+
+    tier = params.get('tier') or 'raw'
+    if tier not in ('raw', *ROLLUP_TIERS):
+        raise ValueError(f'tier must be one of raw, {", ".join(ROLLUP_TIERS)}')
+    output = params.get('format') or 'json'
+    if output not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    limit = int(params.get('limit') or QUERY_DEFAULT_LIMIT)
+    if not 1 <= limit <= QUERY_MAX_LIMIT:
+        raise ValueError(f'limit must be between 1 and {QUERY_MAX_LIMIT}')
+
+    query: Dict[str, Any] = {
+        'start': start,
+        'end': end,
+        'tier': tier,
+        'format': output,
+        'limit': limit,
+        'cursor': cursor,
+        # The aggregates cover the whole window, so they come with the
+        # first page; later pages only read their own samples
+        'aggregates': (params.get('aggregates') or ('false' if cursor is not None else 'true')).lower()
+                      not in ('false', '0', 'no'),
+        'quota': int(params.get('quota') or QUOTA_BYTES),
+    }
+    if params.get('percentiles'):
+        query['percentiles'] = [float(p) for p in params['percentiles'].split(',')]
+        if not all(0 <= p <= 100 for p in query['percentiles']):
+            raise ValueError('percentiles must be between 0 and 100')
+    return query
+
+def handle_query(event: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    GET /query: the window's samples in the requested format, a page of at
+    most limit samples at a time. The first page comes with aggregates
+    over the whole window; pages after a cursor do not unless asked for
+    (aggregates=true), so only their own samples are read.
+    JSON carries the page's metadata in its body; the other formats in
+    X-Next-Cursor and X-Aggregates headers (Arrow also in its schema metadata).
+    """
+    try:
+        query = parse_query_request(event)
+    except (TypeError, ValueError) as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(f'Invalid request parameters: {str(e)}')
+        }
+
+    start, end, cursor, limit = query['start'], query['end'], query['cursor'], query['limit']
+    aggregates = None
+    if query['aggregates']:
+        aggregates = WindowAggregates(start, end, query['quota'], **(
+            {'percentiles': query['percentiles']} if 'percentiles' in query else {}
+        ))
+
+    parts: List[Tuple[np.ndarray, np.ndarray]] = []
+    taken = 0
+    last_taken: Optional[float] = None
+    next_cursor = None
+    read_from = start if aggregates is not None or cursor is None else max(start, cursor)
+    pages = iter_window_pages(BUCKET_NAME, read_from, end, query['tier'])
+    try:
+        for timestamps, sizes in pages:
+            # Rollup pages list each window's min, max and last points in turn
+            timestamps, unique = np.unique(timestamps, return_index=True)
+            sizes = sizes[unique]
+            if aggregates is not None:
+                with metrics.stage('aggregate'):
+                    aggregates.add(timestamps, sizes)
+
+            if next_cursor is None:
+                if cursor is not None:
+                    after = timestamps > cursor
+                    timestamps, sizes = timestamps[after], sizes[after]
+                more = taken + len(timestamps) > limit
+                timestamps, sizes = timestamps[:limit - taken], sizes[:limit - taken]
+                if len(timestamps):
+                    parts.append((timestamps, sizes))
+                    taken += len(timestamps)
+                    last_taken = float(timestamps[-1])
+                if more:
+                    # More samples follow the ones returned
+                    next_cursor = last_taken
+                if next_cursor is not None and aggregates is None:
+                    break
     except Exception as e:
-        print(f"Error querying recent items: {e}")
+        print(f"Error querying samples: {e}")
         return {
             'statusCode': 500,
             'body': json.dumps(f'Error querying DynamoDB: {str(e)}')
         }
-    
-    # Query all items to find maximum size ever
+    finally:
+        pages.close()
+
+    timestamps = np.concatenate([part[0] for part in parts]) if parts else np.empty(0)
+    sizes = np.concatenate([part[1] for part in parts]) if parts else np.empty(0, dtype=np.int64)
+    metrics.count('samples_returned', len(timestamps))
+
+    meta = {
+        'bucket': BUCKET_NAME,
+        'tier': query['tier'],
+        'start': start,
+        'end': end,
+        'count': len(timestamps),
+        'next_cursor': next_cursor,
+        'aggregates': aggregates.result() if aggregates is not None else None
+    }
+
     try:
-        response_all = table.query(
-            KeyConditionExpression='bucketName = :bn',
-            ExpressionAttributeValues={
-                ':bn': BUCKET_NAME
-            }
-        )
-        
-        all_items = response_all['Items']
-        max_size = max([int(item['total_size']) for item in all_items]) if all_items else 0
-        print(f"Maximum size ever: {max_size} bytes")
-        
+        with metrics.stage('encode'):
+            payload = ENCODERS[query['format']](timestamps, sizes, meta)
+    except ImportError as e:
+        print(f"Format {query['format']} is not available: {e}")
+        return {
+            'statusCode': 501,
+            'body': json.dumps(f'Format {query["format"]} is not available: {str(e)}')
+        }
+
+    headers = {'Content-Type': FORMATS[query['format']]}
+    if query['format'] != 'json':
+        if next_cursor is not None:
+            headers['X-Next-Cursor'] = repr(next_cursor)
+        if meta['aggregates'] is not None:
+            headers['X-Aggregates'] = json.dumps(meta['aggregates'])
+    if query['format'] == 'arrow':
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': base64.b64encode(payload).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': payload.decode('utf-8')
+    }
+
+def is_query_request(event: Optional[Dict[str, Any]]) -> bool:
+    """
+    Whether an API Gateway event is for the /query resource.
+    """
+    event = event or {}
+    return event.get('resource') == '/query' or (event.get('path') or '').rstrip('/').endswith('/query')
+
+@metrics.instrument
+def lambda_handler(event, context):
+    """
+    Query bucket size history for a time window and create a plot.
+    Query string parameters: start, end (epoch seconds, default: last 5 minutes)
+    and max_points (the history is downsampled to at most this many points).
+    Long windows are read from the coarsest minute/hour/day rollup that still
+    gives max_points resolution; 'tier' (auto, raw, minute, hour, day) overrides it.
+    Plot includes recent sizes and a horizontal line for max size ever.
+    The image is returned as the response body with format=image (or an
+    image Accept header), else as a presigned plot_url in the JSON body.
+    Nothing is written to the monitored bucket outside the plot-cache/
+    prefix, which its event notifications filter out.
+    GET /query is served by handle_query instead.
+    """
+    if is_query_request(event):
+        return handle_query(event)
+
+    print("Starting plotting lambda...")
+
+    try:
+        start, end, max_points, renderer, requested_tier, output = parse_request(event)
+    except (TypeError, ValueError) as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(f'Invalid request parameters: {str(e)}')
+        }
+
+    window_seconds = end - start
+
+    # Read the watermark and the maximum size ever from the bucket's aggregate item
+    try:
+        aggregate = get_aggregate(BUCKET_NAME)
     except Exception as e:
-        print(f"Error querying all items: {e}")
+        print(f"Error reading aggregate: {e}")
         return {
             'statusCode': 500,
-            'body': json.dumps(f'Error finding max size: {str(e)}')
+            'body': json.dumps(f'Error querying DynamoDB: {str(e)}')
         }
+
+    # Serve unchanged plots from the cache instead of re-rendering them
+    cache_key = plot_cache_key(BUCKET_NAME, aggregate, start, end, max_points, renderer, requested_tier)
+    if cache_key:
+        if get_request_header(event, 'If-None-Match') == f'"{cache_key}"':
+            print(f"Plot not modified: {cache_key}")
+            return {
+                'statusCode': 304,
+                'headers': {'ETag': f'"{cache_key}"'},
+                'body': ''
+            }
+
+        try:
+            cached = get_cached_plot(cache_key, renderer, output == 'image')
+        except Exception as e:
+            print(f"Error reading plot cache, rendering instead: {e}")
+            cached = None
+
+        if cached is not None:
+            metrics.count('cache_hits')
+            cached_body, cached_image = cached
+            if output == 'image':
+                return image_response(cached_image, renderer, cache_key)
+            return plot_response(dict(cached_body, cached=True), cache_key)
+
+    tier = choose_tier(start, end, max_points) if requested_tier == 'auto' else requested_tier
+
+    # Buckets without an aggregate item have their max size scanned for,
+    # alongside the window's queries; the scan is stopped and joined if
+    # they fail
+    max_size_stopped = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as max_size_executor:
+        max_size_scan = None
+        if 'max_size' not in aggregate:
+            max_size_scan = max_size_executor.submit(get_max_size, BUCKET_NAME, aggregate, max_size_stopped)
+
+        # Stream every page of the window through the downsampler, which does
+        # not need them in order. Ranges from before rollups were maintained
+        # only have raw samples.
+        try:
+            for tier in ([tier] if tier == 'raw' else [tier, 'raw']):
+                downsampler = MinMaxDownsampler(start, end, max_points)
+                for page_timestamps, page_sizes in iter_segmented_pages(BUCKET_NAME, start, end, tier):
+                    with metrics.stage('downsample'):
+                        downsampler.add(page_timestamps, page_sizes)
+                if downsampler.count:
+                    break
+
+            print(f"Found {downsampler.count} {tier} items in last {window_seconds:g} seconds")
+            metrics.count('samples_read', downsampler.count)
+
+        except Exception as e:
+            print(f"Error querying recent items: {e}")
+            if max_size_scan:
+                max_size_scan.cancel()
+                max_size_stopped.set()
+            return {
+                'statusCode': 500,
+                'body': json.dumps(f'Error querying DynamoDB: {str(e)}')
+            }
+
+        try:
+            max_size = max_size_scan.result() if max_size_scan else get_max_size(BUCKET_NAME, aggregate)
+            print(f"Maximum size ever: {max_size} bytes")
+
+        except Exception as e:
+            print(f"Error reading max size: {e}")
+            return {
+                'statusCode': 500,
+                'body': json.dumps(f'Error finding max size: {str(e)}')
+            }
     
     # Check if we have data to plot
-    if not recent_items:
-        print("No data to plot in last 300 seconds")
+    if downsampler.count == 0:
+        print(f"No data to plot in last {window_seconds:g} seconds")
         return {
             'statusCode': 200,
-            'body': json.dumps('No data available in last 300 seconds to plot')
+            'body': json.dumps(f'No data available in last {window_seconds:g} seconds to plot')
         }
     
-    # Sort by timestamp - use ALL items, don't limit to 4
-    sorted_items = sorted(recent_items, key=lambda x: float(x['timestamp']))
-    # REMOVED: filtered_items = sorted_items[:4]  
-    filtered_items = sorted_items  # FIXED: Use all items from last 10 seconds
-    
-    print(f"Using {len(filtered_items)} items for plotting")
-    for item in filtered_items:
-        print(f"  Timestamp: {item['timestamp']}, Size: {item['total_size']}, Count: {item['object_count']}")
-    
-    # Prepare data for plotting
-    timestamps = [float(item['timestamp']) for item in filtered_items]
-    sizes = [int(item['total_size']) for item in filtered_items]
-    
-    print(f"Sizes to plot: {sizes}")
+    timestamps, size_array = downsampler.result()
+    print(f"Using {len(timestamps)} of {downsampler.count} items for plotting")
     
     # Convert timestamps to relative time (seconds from first timestamp)
-    min_timestamp = min(timestamps)
-    relative_times = [(ts - min_timestamp) for ts in timestamps]
-    
-    print(f"Relative times: {relative_times}")
-    
-    # Create the plot
-    plt.figure(figsize=(10, 6))
-    
-    # Plot bucket size changes
-    plt.plot(relative_times, sizes, 'bo-', label='Bucket Size', linewidth=2, markersize=8)
-    
-    # Plot maximum size line
-    plt.axhline(y=max_size, color='r', linestyle='--', linewidth=2, label=f'Max Size Ever: {max_size} bytes')
+    relative_times = (timestamps - timestamps[0]).tolist()
+    sizes = size_array.tolist()
     
-    # Labels and formatting
-    plt.xlabel('Time (seconds)', fontsize=12)
-    plt.ylabel('Size (bytes)', fontsize=12)
-    plt.title(f'S3 Bucket Size Change - Last 5 Minutes\n{BUCKET_NAME}', fontsize=14)
-    plt.legend(fontsize=10)
-    plt.grid(True, alpha=0.3)
+    # Render the plot
+    render, extension, _ = RENDERERS[renderer]
+    title = f'S3 Bucket Size Change - {window_seconds:g} Seconds\n{BUCKET_NAME}'
+    with metrics.stage('render'):
+        image = render(relative_times, sizes, max_size, title)
+    print(f"Rendered {len(image)} byte {extension} plot with {renderer} renderer")
     
-    # Set y-axis to start from 0 to clearly show the drop to 0 bytes
-    plt.ylim(bottom=-1, top=max_size + 5)
-    
-    # Save plot to buffer
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
-    
-    # Upload to S3
-    try:
-        s3_client.put_object(
-            Bucket=BUCKET_NAME,
-            Key='plot',
-            Body=buf.getvalue(),
-            ContentType='image/png'
-        )
-        
-        print("Plot uploaded successfully to S3")
-        
-    except Exception as e:
-        print(f"Error uploading plot to S3: {e}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps(f'Error uploading plot: {str(e)}')
-        }
-    
-    return {
-        'statusCode': 200,
-        'body': json.dumps({
-            'message': 'Plot generated and uploaded successfully',
-            'bucket': BUCKET_NAME,
-            'plot_key': 'plot',
-            'data_points': len(filtered_items),
-            'max_size': max_size,
-            'sizes': sizes,
-            'relative_times': relative_times
-        })
-    }
\ No newline at end of file
+    body = {
+        'message': 'Plot generated successfully',
+        'bucket': BUCKET_NAME,
+        'plot_key': f'{PLOT_CACHE_PREFIX}{cache_key}.{extension}' if cache_key else None,
+        'renderer': renderer,
+        'tier': tier,
+        'data_points': len(sizes),
+        'samples_read': downsampler.count,
+        'start': start,
+        'end': end,
+        'max_size': max_size,
+        'sizes': sizes,
+        'relative_times': relative_times
+    }
+
+    # Upload the cache entry; the plot itself is served from the response
+    if cache_key:
+        try:
+            with metrics.stage('upload'):
+                store_cached_plot(cache_key, image, body, renderer)
+            print("Plot uploaded successfully to S3")
+        except Exception as e:
+            print(f"Error uploading plot to S3: {e}")
+            if output == 'json':
+                return {
+                    'statusCode': 500,
+                    'body': json.dumps(f'Error uploading plot: {str(e)}')
+                }
+
+    if output == 'image':
+        return image_response(image, renderer, cache_key)
+    return plot_response(dict(body, cached=False), cache_key)
@@ -0,0 +1,193 @@
+"""
+Aggregates and export formats for the bucket size history served by the
+query endpoint. Samples arrive as pages of (timestamps, sizes) arrays, the
+same pages the plot is drawn from; aggregates are accumulated page by page
+with NumPy, so a window of any length is summarised in one pass and in
+constant memory.
+
+The size is a step function: each sample holds until the next one, and the
+last one until the end of the window. Durations (time above quota) follow
+that; percentiles and the mean are over samples. Percentiles are exact for
+up to PERCENTILE_SAMPLE_SIZE samples, and beyond that estimated from a
+uniform random sample of that many.
+
+The JSON lines and CSV encoders need nothing beyond NumPy; the Arrow IPC
+encoder imports pyarrow lazily, only when requested.
+"""
+import io
+import json
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+# format -> content type of the encoded samples
+FORMATS = {
+    'json': 'application/json',
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'arrow': ARROW_CONTENT_TYPE,
+}
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 99.0)
+
+# Sizes kept for the percentiles; the rank error of an estimate is about
+# 1 / sqrt(PERCENTILE_SAMPLE_SIZE), i.e. 1%
+PERCENTILE_SAMPLE_SIZE = 10000
+
+class WindowAggregates:
+    """
+    Streaming aggregates of the size over [start, end]:
+    count, first/last, min/max (with their times), mean, percentiles,
+    net change, growth rate (least-squares slope, bytes per second) and
+    the time spent above quota.
+    """
+
+    def __init__(self, start: float, end: float, quota: int,
+                 percentiles: Sequence[float] = DEFAULT_PERCENTILES):
+        self.start = start
+        self.end = end
+        self.quota = quota
+        self.percentiles = list(percentiles)
+        self.count = 0
+        self.first: Optional[tuple] = None
+        # The last sample seen: its duration is only known with the next one
+        self.last: Optional[tuple] = None
+        self.min: Optional[tuple] = None
+        self.max: Optional[tuple] = None
+        self.size_sum = 0
+        # Sums for the least-squares slope, with times relative to the first
+        # sample so their squares keep float precision
+        self.t_sum = 0.0
+        self.tt_sum = 0.0
+        self.ts_sum = 0.0
+        self.seconds_above_quota = 0.0
+        # Bottom-k sample: the sizes with the smallest random priorities seen
+        # so far are a uniform sample of all of them. Seeded, so the same
+        # window gives the same estimates.
+        self.rng = np.random.default_rng(0)
+        self.sample_sizes = np.empty(0, dtype=np.int64)
+        self.sample_priorities = np.empty(0)
+
+    def add(self, timestamps: np.ndarray, sizes: np.ndarray) -> None:
+        if not len(timestamps):
+            return
+        if self.first is None:
+            self.first = (float(timestamps[0]), int(sizes[0]))
+        else:
+            # The previous page's last sample lasted until this page's first
+            self.accumulate_durations(np.array([self.last[0], timestamps[0]]), np.array([self.last[1]]))
+        self.accumulate_durations(timestamps, sizes[:-1])
+        self.last = (float(timestamps[-1]), int(sizes[-1]))
+
+        low, high = int(np.argmin(sizes)), int(np.argmax(sizes))
+        if self.min is None or sizes[low] < self.min[1]:
+            self.min = (float(timestamps[low]), int(sizes[low]))
+        if self.max is None or sizes[high] > self.max[1]:
+            self.max = (float(timestamps[high]), int(sizes[high]))
+
+        relative = timestamps - self.first[0]
+        values = sizes.astype(np.float64)
+        self.count += len(timestamps)
+        self.size_sum += int(sizes.sum())
+        self.t_sum += float(relative.sum())
+        self.tt_sum += float(np.dot(relative, relative))
+        self.ts_sum += float(np.dot(relative, values))
+        self.sample(sizes)
+
+    def sample(self, sizes: np.ndarray) -> None:
+        """
+        Fold sizes into the sample kept for the percentiles.
+        """
+        sample_sizes = np.concatenate([self.sample_sizes, sizes])
+        priorities = np.concatenate([self.sample_priorities, self.rng.random(len(sizes))])
+        if len(sample_sizes) > PERCENTILE_SAMPLE_SIZE:
+            keep = np.argpartition(priorities, PERCENTILE_SAMPLE_SIZE)[:PERCENTILE_SAMPLE_SIZE]
+            sample_sizes, priorities = sample_sizes[keep], priorities[keep]
+        self.sample_sizes, self.sample_priorities = sample_sizes, priorities
+
+    def accumulate_durations(self, timestamps: np.ndarray, sizes: np.ndarray) -> None:
+        """
+        Add how long each of sizes held: from its timestamp to the next one.
+        """
+        durations = np.diff(timestamps)
+        self.seconds_above_quota += float(durations[sizes > self.quota].sum())
+
+    def result(self) -> Dict[str, Any]:
+        if not self.count:
+            return {'count': 0}
+
+        seconds_above_quota = self.seconds_above_quota
+        if self.last[1] > self.quota:
+            seconds_above_quota += max(0.0, self.end - self.last[0])
+        covered = max(0.0, self.end - self.first[0])
+
+        # Least-squares slope of size over time
+        denominator = self.count * self.tt_sum - self.t_sum ** 2
+        growth_rate = ((self.count * self.ts_sum - self.t_sum * self.size_sum) / denominator
+                       if self.count > 1 and denominator > 0 else 0.0)
+
+        values = np.percentile(self.sample_sizes, self.percentiles) if self.percentiles else []
+
+        return {
+            'count': self.count,
+            'first': {'timestamp': self.first[0], 'size': self.first[1]},
+            'last': {'timestamp': self.last[0], 'size': self.last[1]},
+            'min': {'timestamp': self.min[0], 'size': self.min[1]},
+            'max': {'timestamp': self.max[0], 'size': self.max[1]},
+            'mean': self.size_sum / self.count,
+            'percentiles': {f'p{p:g}': float(v) for p, v in zip(self.percentiles, values)},
+            'net_change': self.last[1] - self.first[1],
+            'growth_rate_bytes_per_second': growth_rate,
+            'quota': self.quota,
+            'seconds_above_quota': seconds_above_quota,
+            'fraction_above_quota': seconds_above_quota / covered if covered else 0.0,
+        }
+
+def encode_json(timestamps: np.ndarray, sizes: np.ndarray, meta: Dict[str, Any]) -> bytes:
+    """
+    One JSON object: meta plus the samples as columns.
+    """
+    return json.dumps(dict(meta, timestamps=timestamps.tolist(), sizes=sizes.tolist())).encode('utf-8')
+
+def encode_jsonl(timestamps: np.ndarray, sizes: np.ndarray, meta: Dict[str, Any]) -> bytes:
+    """
+    One {"timestamp", "total_size"} object per line.
+    """
+    return ''.join(
+        f'{{"timestamp": {timestamp!r}, "total_size": {size}}}\n'
+        for timestamp, size in zip(timestamps.tolist(), sizes.tolist())
+    ).encode('utf-8')
+
+def encode_csv(timestamps: np.ndarray, sizes: np.ndarray, meta: Dict[str, Any]) -> bytes:
+    """
+    timestamp,total_size with a header row.
+    """
+    lines = ['timestamp,total_size\n']
+    lines.extend(f'{timestamp!r},{size}\n' for timestamp, size in zip(timestamps.tolist(), sizes.tolist()))
+    return ''.join(lines).encode('utf-8')
+
+def encode_arrow(timestamps: np.ndarray, sizes: np.ndarray, meta: Dict[str, Any]) -> bytes:
+    """
+    An Arrow IPC stream with one record batch (timestamp: float64 epoch
+    seconds, total_size: int64); meta is in the schema metadata as JSON.
+    """
+    import pyarrow as pa
+
+    batch = pa.record_batch(
+        [pa.array(timestamps, type=pa.float64()), pa.array(sizes, type=pa.int64())],
+        names=['timestamp', 'total_size']
+    )
+    schema = batch.schema.with_metadata({'meta': json.dumps(meta)})
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+    return sink.getvalue()
+
+ENCODERS = {
+    'json': encode_json,
+    'jsonl': encode_jsonl,
+    'csv': encode_csv,
+    'arrow': encode_arrow,
+}
@@ -1,135 +1,1170 @@
-import boto3
+import bisect
 import json
 import os
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from decimal import Decimal
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
-s3_client = boto3.client('s3')
-dynamodb: Any = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['TABLE_NAME'])
+from aws_clients import lazy_client, lazy_resource, lazy_table
+from history_layout import ROLLUP_TIERS, packed_partitions, sample_partition, sample_partitions
+from instrumentation import METRICS_NAMESPACE, Metrics
+from listing import list_object_pages
+from packed_history import (HISTORY_LAYOUT, PACKED_BLOCK_SECONDS, block_start, decode_block,
+                            encode_block, from_micros, packed_partition, to_micros)
+from s3_events import TOMBSTONE_TTL_SECONDS, extract_s3_events_from_sqs, get_sequencer, is_plot_key
+
+metrics = Metrics('size-tracking')
+
+dynamodb: Any = lazy_resource('dynamodb')
+cloudwatch: Any = lazy_client('cloudwatch')
+lambda_client: Any = lazy_client('lambda')
+table = lazy_table(os.environ['TABLE_NAME'])
+object_index_table = lazy_table(os.environ['OBJECT_INDEX_TABLE_NAME'])
 
 # Extract bucket name from ARN (format: arn:aws:s3:::bucket-name)
 BUCKET_ARN = os.environ.get('BUCKET_ARN', '')
 BUCKET_NAME = BUCKET_ARN.split(':::')[-1] if BUCKET_ARN else os.environ.get('BUCKET_NAME', '')
 
-def extract_s3_event_from_sqs(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+# 'incremental' applies each event's size delta to a running aggregate item,
+# 'full' re-lists the whole bucket on every event (the original behavior).
+TRACKING_MODE = os.environ.get('TRACKING_MODE', 'incremental')
+
+# Keys whose changes are committed, with the aggregate delta, in one
+# TransactWriteItems call (at most 100 actions), and the attempts at
+# committing them before giving up when concurrent batches change them first
+INDEX_TRANSACTION_KEYS = 99
+COMMIT_ATTEMPTS = 5
+# Concurrent conditional writes of reconcile(), which cannot be batched
+RECONCILE_WRITE_WORKERS = int(os.environ.get('RECONCILE_WRITE_WORKERS', '16'))
+
+# Attempts at appending a sample to its packed block (HISTORY_LAYOUT=packed)
+# before giving up, when concurrent batches keep appending to it first
+PACKED_APPEND_ATTEMPTS = 5
+
+# Raw samples expire (expires_at, the table's TTL attribute) this long after
+# they are taken; 0 keeps them forever. Compaction must have folded them into
+# the rollups by then, so keep it well above COMPACT_AFTER_SECONDS.
+RAW_RETENTION_SECONDS = int(os.environ.get('RAW_RETENTION_SECONDS', '604800'))
+# Compaction folds whole days of raw samples once they are this old
+COMPACT_AFTER_SECONDS = int(os.environ.get('COMPACT_AFTER_SECONDS', '86400'))
+COMPACTION_DAY_SECONDS = ROLLUP_TIERS['day']
+# Compaction stops starting new days this close to the lambda's timeout
+COMPACTION_MARGIN_MILLIS = 5000
+
+# How every new total is published as the BucketSize metric, at one-second
+# resolution, for the size alarm: 'put' (PutMetricData), 'emf' (an embedded
+# metric format log line) or 'off'
+SIZE_METRIC_EMISSION = os.environ.get('SIZE_METRIC_EMISSION', 'put')
+SIZE_METRIC_NAME = 'BucketSize'
+# PutMetricData accepts at most 1000 datapoints per call
+PUT_METRIC_DATA_LIMIT = 1000
+
+# Buckets larger than this many bytes get the cleaner invoked as soon as
+# their new total is written (0 disables it; the size alarm still applies).
+# A bucket's aggregate item may override it with a quota_bytes attribute.
+QUOTA_BYTES = int(os.environ['QUOTA_BYTES'])
+CLEANER_FUNCTION_NAME = os.environ.get('CLEANER_FUNCTION_NAME', '')
+# Breaches within this long of a dispatched cleanup do not dispatch another,
+# unless the bucket got back within its quota in between
+CLEANUP_DEBOUNCE_SECONDS = int(os.environ.get('CLEANUP_DEBOUNCE_SECONDS', '30'))
+
+def aggregate_key(bucket_name: str) -> Dict[str, Any]:
     """
-    Extract S3 event from SQS message containing SNS notification.
-    Event structure: SQS -> SNS -> S3
+    Key of the per-bucket aggregate item holding the running totals,
+    the last sample and the all-time max/min.
+    It lives in the history table under its own partition so that
+    queries on the bucketName partition only ever see raw samples.
     """
-    try:
-        # Get SQS message body
-        sqs_record = event['Records'][0]
-        sqs_body = json.loads(sqs_record['body'])
+    return {
+        'bucketName': f'{bucket_name}#aggregate',
+        'timestamp': 0
+    }
 
-        # Get SNS message from SQS body
-        sns_message = json.loads(sqs_body['Message'])
+def rollup_key(bucket_name: str, tier: str, timestamp: Decimal) -> Dict[str, Any]:
+    """
+    Key of the tier's rollup item for the window containing timestamp.
+    Each tier has its own partition ({bucket}#{tier}), keyed by window start.
+    """
+    window = ROLLUP_TIERS[tier]
+    return {
+        'bucketName': f'{bucket_name}#{tier}',
+        'timestamp': int(timestamp // window) * window
+    }
 
-        # Return the S3 event
-        return sns_message
-    except (KeyError, IndexError, json.JSONDecodeError) as e:
-        print(f"Error extracting S3 event: {e}")
-        print(f"Event structure: {json.dumps(event)}")
-        return None
+def list_bucket_objects(bucket_name: str):
+    """
+    Yield (key, size, last_modified) for every object in the bucket, excluding plot files.
+    Shards of the key space are listed concurrently, so keys are not in order.
+    """
+    pages = list_object_pages(bucket_name)
 
-def lambda_handler(event, context):
+    while True:
+        with metrics.stage('listing'):
+            page = next(pages, None)
+        if page is None:
+            return
+        for object_key, object_size, last_modified in page:
+            if is_plot_key(object_key):
+                continue
+            yield object_key, object_size, last_modified
+
+def calculate_bucket_totals(bucket_name: str) -> Tuple[int, int]:
     """
-    Triggered by SQS messages (which contain SNS messages with S3 events).
-    Computes total size of all objects in the bucket and stores in DynamoDB.
+    Compute total size and object count by listing the whole bucket.
+    Costs one LIST call per 1000 objects.
     """
+    total_size = 0
+    object_count = 0
 
-    print(f"Event received: {json.dumps(event)}")
+    for _, size, _ in list_bucket_objects(bucket_name):
+        total_size += size
+        object_count += 1
 
-    # Extract S3 event from SQS/SNS envelope
-    s3_event = extract_s3_event_from_sqs(event)
-    if not s3_event:
-        return {
-            'statusCode': 400,
-            'body': json.dumps('Invalid event format')
+    print(f"Total size: {total_size} bytes, Object count: {object_count}")
+    return total_size, object_count
+
+def fold_changes(item: Optional[Dict[str, Any]], changes: List[Dict[str, Any]],
+                 now: int) -> Tuple[Optional[Dict[str, Any]], List[Tuple[int, int, Optional[str]]]]:
+    """
+    Apply a key's changes, in order, to its index record (None if it has
+    none). Returns the resulting record and, per change, its
+    (size_delta, count_delta, outcome), outcome naming the metric of a
+    change that had no effect.
+
+    Created objects get live_size, which only live objects carry, keeping
+    the bySize index sparse; created_at survives overwrites of the key,
+    last_modified does not, and overwriting a live object only contributes
+    the difference between the new and the previous size. Removed objects
+    leave a tombstone that keeps their size until the table's TTL expires it.
+    With a sequencer, a change only takes effect if it is newer than the
+    last one applied to the key, so redelivered and overtaken events
+    contribute nothing, and a removal that overtook its object's creation
+    still leaves a tombstone, so the late creation is recognized as stale.
+    """
+    results: List[Tuple[int, int, Optional[str]]] = []
+    for change in changes:
+        sequencer = change['sequencer']
+        if sequencer and item is not None and item.get('sequencer', '') >= sequencer:
+            results.append((0, 0, 'stale_events'))
+            continue
+        live = item is not None and 'deleted_at' not in item
+
+        if change['event'] == 'created':
+            size = change['size']
+            results.append((size - int(item['size']), 0, None) if live else (size, 1, None))
+            created = dict(item or {}, size=size, live_size=size, last_modified=change['event_time'])
+            created.setdefault('created_at', change['event_time'])
+            created.pop('deleted_at', None)
+            created.pop('expires_at', None)
+            item = created
+        else:
+            if not sequencer and not live:
+                results.append((0, 0, 'unknown_removals'))
+                continue
+            if item is None:
+                results.append((0, 0, 'unknown_removals'))
+            elif live:
+                results.append((-int(item['size']), -1, None))
+            else:
+                results.append((0, 0, None))
+            removed = dict(item or {}, deleted_at=now, expires_at=now + TOMBSTONE_TTL_SECONDS)
+            removed.pop('live_size', None)
+            removed.pop('created_at', None)
+            item = removed
+
+        if sequencer:
+            item['sequencer'] = sequencer
+    return item, results
+
+def read_index_records(bucket_name: str, object_keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Consistent reads of the index records of up to 100 keys.
+    """
+    records: Dict[str, Dict[str, Any]] = {}
+    request = {object_index_table.name: {
+        'Keys': [{'bucketName': bucket_name, 'objectKey': object_key} for object_key in object_keys],
+        'ConsistentRead': True
+    }}
+    while request:
+        with metrics.stage('dynamodb_read'):
+            response = dynamodb.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(object_index_table.name, []):
+            records[item['objectKey']] = item
+        request = response.get('UnprocessedKeys') or {}
+    return records
+
+def index_update(bucket_name: str, object_key: str, read: Optional[Dict[str, Any]],
+                 written: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Transaction action replacing the record read for object_key with
+    written, only if it has not changed since in any way the fold depends on.
+    """
+    attributes = {name: value for name, value in written.items() if name not in ('bucketName', 'objectKey')}
+    removed = sorted(set(read or {}) - set(written))
+    names = {f'#{name}': name for name in list(attributes) + removed}
+    values = {f':{name}': value for name, value in attributes.items()}
+
+    update_expression = 'SET ' + ', '.join(f'#{name} = :{name}' for name in attributes)
+    if removed:
+        update_expression += ' REMOVE ' + ', '.join(f'#{name}' for name in removed)
+
+    if read is None:
+        condition = 'attribute_not_exists(objectKey)'
+    else:
+        conditions = ['attribute_exists(objectKey)']
+        for name in ('sequencer', 'size'):
+            names[f'#{name}'] = name
+            if name in read:
+                conditions.append(f'#{name} = :read_{name}')
+                values[f':read_{name}'] = read[name]
+            else:
+                conditions.append(f'attribute_not_exists(#{name})')
+        names['#deleted_at'] = 'deleted_at'
+        conditions.append(f'attribute_{"exists" if "deleted_at" in read else "not_exists"}(#deleted_at)')
+        condition = ' AND '.join(conditions)
+
+    update: Dict[str, Any] = {
+        'TableName': object_index_table.name,
+        'Key': {'bucketName': bucket_name, 'objectKey': object_key},
+        'UpdateExpression': update_expression,
+        'ConditionExpression': condition,
+        'ExpressionAttributeNames': names
+    }
+    if values:
+        update['ExpressionAttributeValues'] = values
+    return {'Update': update}
+
+def aggregate_update(bucket_name: str, size_delta: int, count_delta: int) -> Dict[str, Any]:
+    """
+    Transaction action adding the deltas to the running aggregate, which
+    fails while the aggregate has not been initialized yet. Every commit
+    bumps its revision, which tells reconcile() its totals are outdated.
+    """
+    return {'Update': {
+        'TableName': table.name,
+        'Key': aggregate_key(bucket_name),
+        'UpdateExpression': 'ADD total_size :size_delta, object_count :count_delta, revision :one',
+        'ConditionExpression': 'attribute_exists(total_size)',
+        'ExpressionAttributeValues': {
+            ':size_delta': size_delta,
+            ':count_delta': count_delta,
+            ':one': 1
         }
+    }}
 
-    # Extract bucket name and object key from the S3 event
-    try:
-        bucket_name = s3_event['Records'][0]['s3']['bucket']['name']
-        object_key = s3_event['Records'][0]['s3']['object']['key']
-    except (KeyError, IndexError) as e:
-        print(f"Error extracting event info: {e}")
+def commit_changes(bucket_name: str,
+                   changes: Dict[str, List[Dict[str, Any]]]) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Apply the changes of up to INDEX_TRANSACTION_KEYS keys to the object
+    index and their deltas to the running aggregate in one transaction, so
+    either both are written or neither is and a retry applies them again.
+    The records are read first and the transaction only commits if none of
+    them changed since; otherwise they are read and folded again. An
+    uninitialized aggregate is reconciled first, which indexes the listed
+    objects, so the changes are then folded onto those records.
+    Returns the (size_delta, count_delta) of every change, per key.
+    """
+    object_keys = list(changes)
+    exceptions = dynamodb.meta.client.exceptions
+    for attempt in range(COMMIT_ATTEMPTS):
+        records = read_index_records(bucket_name, object_keys)
+        indexed_at = Decimal(str(time.time()))
+        now = int(indexed_at)
+
+        actions = []
+        folded: Dict[str, List[Tuple[int, int, Optional[str]]]] = {}
+        for object_key in object_keys:
+            read = records.get(object_key)
+            written, folded[object_key] = fold_changes(read, changes[object_key], now)
+            if written is not None and written != read:
+                # When the record changed last, so reconcile() leaves it alone
+                written['indexed_at'] = indexed_at
+                actions.append(index_update(bucket_name, object_key, read, written))
+        size_delta = sum(size for results in folded.values() for size, _, _ in results)
+        count_delta = sum(count for results in folded.values() for _, count, _ in results)
+
+        if actions:
+            actions.append(aggregate_update(bucket_name, size_delta, count_delta))
+            try:
+                with metrics.stage('dynamodb_write'):
+                    dynamodb.meta.client.transact_write_items(TransactItems=actions)
+            except exceptions.TransactionCanceledException as e:
+                reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+                if reasons and reasons[-1] == 'ConditionalCheckFailed':
+                    print(f"Aggregate for {bucket_name} not initialized")
+                    reconcile(bucket_name)
+                else:
+                    metrics.count('commit_conflicts')
+                    if attempt + 1 < COMMIT_ATTEMPTS:
+                        time.sleep(0.05 * 2 ** attempt)
+                continue
+
+        for results in folded.values():
+            for _, _, outcome in results:
+                if outcome:
+                    metrics.count(outcome)
         return {
-            'statusCode': 400,
-            'body': json.dumps('Invalid S3 event format')
+            object_key: [(size, count) for size, count, _ in results]
+            for object_key, results in folded.items()
         }
-    
-    print(f"Processing bucket: {bucket_name}")
-    print(f"Triggering object: {object_key}")
-    
-    # CRITICAL: Ignore events for the plot file itself
-    if object_key in ['plot', 'plot.png']:
-        print(f"⚠ Ignoring event for plot file: {object_key}")
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Ignored plot file event')
+
+    raise RuntimeError(f"Index records of {bucket_name} kept changing during {COMMIT_ATTEMPTS} commit attempts")
+
+def read_aggregate(bucket_name: str) -> Optional[Dict[str, Any]]:
+    """
+    The running aggregate, or None when it has not been initialized yet.
+    """
+    with metrics.stage('dynamodb_read'):
+        item = table.get_item(Key=aggregate_key(bucket_name), ConsistentRead=True).get('Item')
+    return item if item and 'total_size' in item else None
+
+def index_totals(bucket_name: str) -> Tuple[Dict[str, int], int, int]:
+    """
+    Consistent read of the live sizes recorded in the index: key -> size,
+    and their total size and count.
+    """
+    indexed: Dict[str, int] = {}
+    query_kwargs: Dict[str, Any] = {
+        'KeyConditionExpression': 'bucketName = :bn',
+        'ExpressionAttributeNames': {'#size': 'size'},
+        'ExpressionAttributeValues': {':bn': bucket_name},
+        'ProjectionExpression': 'objectKey, #size, deleted_at',
+        'ConsistentRead': True
+    }
+    while True:
+        with metrics.stage('dynamodb_read'):
+            response = object_index_table.query(**query_kwargs)
+        for item in response['Items']:
+            if 'deleted_at' not in item:
+                indexed[item['objectKey']] = int(item['size'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return indexed, sum(indexed.values()), len(indexed)
+
+def update_unless_indexed_since(update: Dict[str, Any]) -> bool:
+    """
+    One conditional UpdateItem of the object index; False if its condition
+    failed because an event was indexed in the meantime.
+    """
+    try:
+        dynamodb.meta.client.update_item(TableName=object_index_table.name, **update)
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+def reconcile(bucket_name: str) -> Dict[str, Any]:
+    """
+    Rebuild the key->size index and the running aggregate from a full listing.
+    This is the slow O(objects) path; it bootstraps buckets that existed
+    before incremental tracking was enabled and corrects any drift.
+
+    Events keep being applied while it runs. Records indexed after the
+    listing started are newer than the listing and left alone; the others
+    are corrected in place, keeping their sequencer so stale redeliveries
+    are still recognized. The totals are then summed from the index and
+    only stored if no batch committed a delta in between (the aggregate's
+    revision is unchanged), otherwise summed again.
+    """
+    print(f"Reconciling bucket: {bucket_name}")
+
+    listing_started = Decimal(str(time.time()))
+    listed = {
+        object_key: (object_size, last_modified)
+        for object_key, object_size, last_modified in list_bucket_objects(bucket_name)
+    }
+    indexed, _, _ = index_totals(bucket_name)
+
+    # Tombstone records for keys that are no longer in the bucket and
+    # (re)write only the ones that are missing or have the wrong size
+    not_indexed_since = 'attribute_not_exists(indexed_at) OR indexed_at < :listing_started'
+    now = int(time.time())
+    updates = []
+    stale_keys = [object_key for object_key in indexed if object_key not in listed]
+    for object_key in stale_keys:
+        updates.append({
+            'Key': {'bucketName': bucket_name, 'objectKey': object_key},
+            'UpdateExpression': 'SET deleted_at = :now, expires_at = :expires_at REMOVE live_size, created_at',
+            'ConditionExpression': f'attribute_not_exists(deleted_at) AND ({not_indexed_since})',
+            'ExpressionAttributeValues': {
+                ':now': now,
+                ':expires_at': now + TOMBSTONE_TTL_SECONDS,
+                ':listing_started': listing_started
+            }
+        })
+    for object_key, (object_size, last_modified) in listed.items():
+        if indexed.get(object_key) == object_size:
+            continue
+        updates.append({
+            'Key': {'bucketName': bucket_name, 'objectKey': object_key},
+            'UpdateExpression': 'SET #size = :size, live_size = :size, last_modified = :last_modified, '
+                                'created_at = if_not_exists(created_at, :last_modified) '
+                                'REMOVE deleted_at, expires_at',
+            'ConditionExpression': not_indexed_since,
+            'ExpressionAttributeNames': {'#size': 'size'},
+            'ExpressionAttributeValues': {
+                ':size': object_size,
+                ':last_modified': Decimal(str(last_modified)),
+                ':listing_started': listing_started
+            }
+        })
+
+    with metrics.stage('dynamodb_write'), ThreadPoolExecutor(max_workers=RECONCILE_WRITE_WORKERS) as executor:
+        applied = list(executor.map(update_unless_indexed_since, updates))
+    metrics.count('reconcile_skipped_records', applied.count(False))
+
+    for attempt in range(COMMIT_ATTEMPTS):
+        with metrics.stage('dynamodb_read'):
+            revision = table.get_item(
+                Key=aggregate_key(bucket_name), ConsistentRead=True
+            ).get('Item', {}).get('revision')
+        _, total_size, object_count = index_totals(bucket_name)
+
+        values: Dict[str, Any] = {':total_size': total_size, ':object_count': object_count, ':one': 1}
+        if revision is None:
+            condition = 'attribute_not_exists(revision)'
+        else:
+            condition = 'revision = :revision'
+            values[':revision'] = revision
+        try:
+            with metrics.stage('dynamodb_write'):
+                response = table.update_item(
+                    Key=aggregate_key(bucket_name),
+                    UpdateExpression='SET total_size = :total_size, object_count = :object_count '
+                                     'ADD revision :one',
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues=values,
+                    ReturnValues='ALL_NEW'
+                )
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            metrics.count('commit_conflicts')
+            continue
+
+        print(f"Reconciled: {total_size} bytes, {object_count} objects "
+              f"({len(stale_keys)} stale index records removed)")
+        return response['Attributes']
+
+    raise RuntimeError(f"Aggregate of {bucket_name} kept changing during {COMMIT_ATTEMPTS} reconcile attempts")
+
+def update_if(key: Dict[str, Any], attributes: Dict[str, Any], condition: str) -> bool:
+    """
+    SET the given attributes only if the condition holds.
+    The condition may refer to the new values as :<attribute name>.
+    Returns False when another writer got there first.
+    """
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression='SET ' + ', '.join(f'#{name} = :{name}' for name in attributes),
+            ConditionExpression=condition,
+            ExpressionAttributeNames={f'#{name}': name for name in attributes},
+            ExpressionAttributeValues={f':{name}': value for name, value in attributes.items()}
+        )
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def update_extremes(key: Dict[str, Any], item: Dict[str, Any], timestamp: Decimal,
+                    high: int, low: int) -> None:
+    """
+    Raise max_size to high and lower min_size to low on the given item.
+    Only written when they move, guarded by conditions so concurrent
+    writers can never lower the max or raise the min.
+    """
+    if 'max_size' not in item or high > item['max_size']:
+        update_if(
+            key,
+            {'max_size': high, 'max_timestamp': timestamp},
+            'attribute_not_exists(max_size) OR max_size < :max_size'
+        )
+
+    if 'min_size' not in item or low < item['min_size']:
+        update_if(
+            key,
+            {'min_size': low, 'min_timestamp': timestamp},
+            'attribute_not_exists(min_size) OR min_size > :min_size'
+        )
+
+def update_aggregate_sample(bucket_name: str, aggregate: Dict[str, Any], timestamp: Decimal,
+                            high: int, low: int) -> None:
+    """
+    Record the last sample and the all-time max/min on the aggregate item.
+    high/low are the extremes the total went through during the batch.
+    """
+    key = aggregate_key(bucket_name)
+
+    update_if(
+        key,
+        {
+            'last_timestamp': timestamp,
+            'last_size': int(aggregate['total_size']),
+            'last_object_count': int(aggregate['object_count'])
+        },
+        'attribute_not_exists(last_timestamp) OR last_timestamp < :last_timestamp'
+    )
+
+    update_extremes(key, aggregate, timestamp, high, low)
+
+def update_rollups(bucket_name: str, total_size: int, object_count: int,
+                   timestamp: Decimal, high: int, low: int) -> None:
+    """
+    Fold a sample into the minute, hour and day rollup items covering it.
+    Normally one UpdateItem per tier; the conditional max/min updates
+    only run when the sample moves them.
+    """
+    extremes = (
+        'min_size = if_not_exists(min_size, :low), '
+        'min_timestamp = if_not_exists(min_timestamp, :ts), '
+        'max_size = if_not_exists(max_size, :high), '
+        'max_timestamp = if_not_exists(max_timestamp, :ts)'
+    )
+    values = {':one': 1, ':ts': timestamp, ':high': high, ':low': low}
+
+    for tier in ROLLUP_TIERS:
+        key = rollup_key(bucket_name, tier, timestamp)
+        try:
+            response = table.update_item(
+                Key=key,
+                UpdateExpression=(
+                    'ADD sample_count :one '
+                    'SET last_timestamp = :ts, last_size = :size, '
+                    f'last_object_count = :count, {extremes}'
+                ),
+                ConditionExpression='attribute_not_exists(last_timestamp) OR last_timestamp < :ts',
+                ExpressionAttributeValues=dict(values, **{':size': total_size, ':count': object_count}),
+                ReturnValues='ALL_NEW'
+            )
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            # A later sample already landed in this window, keep its last_*
+            response = table.update_item(
+                Key=key,
+                UpdateExpression=f'ADD sample_count :one SET {extremes}',
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW'
+            )
+
+        update_extremes(key, response['Attributes'], timestamp, high, low)
+
+def append_packed_sample(bucket_name: str, total_size: int, object_count: int,
+                         current_timestamp: Decimal) -> None:
+    """
+    Insert a raw size sample into its packed block, rewriting the block.
+    The write is conditional on the block's sample_count, so a concurrent
+    append makes this one re-read the block and try again.
+    """
+    key = {
+        'bucketName': packed_partition(sample_partition(bucket_name, current_timestamp)),
+        'timestamp': block_start(current_timestamp)
+    }
+    for _ in range(PACKED_APPEND_ATTEMPTS):
+        block = table.get_item(Key=key, ConsistentRead=True).get('Item')
+        samples = decode_block(block) if block else []
+        bisect.insort(samples, (to_micros(current_timestamp), total_size, object_count))
+
+        item = dict(key, **encode_block(samples))
+        if RAW_RETENTION_SECONDS:
+            item['expires_at'] = key['timestamp'] + PACKED_BLOCK_SECONDS + RAW_RETENTION_SECONDS
+        try:
+            if block is None:
+                table.put_item(Item=item, ConditionExpression='attribute_not_exists(sample_count)')
+            else:
+                table.put_item(
+                    Item=item,
+                    ConditionExpression='sample_count = :sample_count',
+                    ExpressionAttributeValues={':sample_count': block['sample_count']}
+                )
+            return
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            metrics.count('packed_append_conflicts')
+    raise RuntimeError(f"Gave up appending to block {key['timestamp']} of {key['bucketName']} "
+                       f"after {PACKED_APPEND_ATTEMPTS} attempts")
+
+def write_sample(bucket_name: str, total_size: int, object_count: int,
+                 current_timestamp: Decimal) -> None:
+    """
+    Append a raw size sample to the history table, in its shard's partition
+    (or its packed block, with HISTORY_LAYOUT=packed).
+    It expires after RAW_RETENTION_SECONDS, by when it is part of the rollups.
+    """
+    if HISTORY_LAYOUT == 'packed':
+        append_packed_sample(bucket_name, total_size, object_count, current_timestamp)
+        print(f"Successfully appended to packed block: timestamp={current_timestamp}")
+        return
+
+    item = {
+        'bucketName': sample_partition(bucket_name, current_timestamp),
+        'timestamp': current_timestamp,
+        'total_size': total_size,
+        'object_count': object_count
+    }
+    if RAW_RETENTION_SECONDS:
+        item['expires_at'] = int(current_timestamp) + RAW_RETENTION_SECONDS
+    table.put_item(Item=item)
+
+    print(f"Successfully wrote to DynamoDB: timestamp={current_timestamp}")
+
+def publish_bucket_sizes(samples: List[Dict[str, Any]]) -> None:
+    """
+    Publish the totals of this invocation's samples (as returned in its
+    response: bucketName, total_size, timestamp) as the BucketSize gauge.
+    The alarm then sees the bucket's actual size seconds after the batch,
+    without waiting for log ingestion and a metric filter.
+    Publishing is best effort: the totals are already stored, and the next
+    batch publishes them again.
+    """
+    if SIZE_METRIC_EMISSION == 'off' or not samples:
+        return
+
+    if SIZE_METRIC_EMISSION == 'emf':
+        for sample in samples:
+            print(json.dumps({
+                '_aws': {
+                    'Timestamp': int(sample['timestamp'] * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['BucketName']],
+                        'Metrics': [{'Name': SIZE_METRIC_NAME, 'Unit': 'Bytes', 'StorageResolution': 1}]
+                    }]
+                },
+                'BucketName': sample['bucketName'],
+                SIZE_METRIC_NAME: sample['total_size']
+            }))
+        return
+
+    metric_data = [
+        {
+            'MetricName': SIZE_METRIC_NAME,
+            'Dimensions': [{'Name': 'BucketName', 'Value': sample['bucketName']}],
+            'Timestamp': datetime.fromtimestamp(sample['timestamp'], tz=timezone.utc),
+            'Value': sample['total_size'],
+            'Unit': 'Bytes',
+            'StorageResolution': 1
         }
-    
-    # Calculate total size and object count
-    total_size = 0
-    object_count = 0
-    
+        for sample in samples
+    ]
+    try:
+        with metrics.stage('cloudwatch_write'):
+            for start in range(0, len(metric_data), PUT_METRIC_DATA_LIMIT):
+                cloudwatch.put_metric_data(
+                    Namespace=METRICS_NAMESPACE,
+                    MetricData=metric_data[start:start + PUT_METRIC_DATA_LIMIT]
+                )
+    except Exception as e:
+        print(f"Error publishing bucket sizes: {e}")
+        metrics.count('metric_publish_errors')
+
+def enforce_quota(bucket_name: str, aggregate: Dict[str, Any], total_size: int,
+                  current_timestamp: Decimal) -> bool:
+    """
+    Invoke the cleaner asynchronously when the new total is over the
+    bucket's quota. A conditional write of cleanup_retry_at to the aggregate
+    item lets only one of concurrent breaches through; once the bucket is
+    back within its quota the marker is cleared, so the next breach
+    dispatches at once. Best effort: the size alarm is the backstop.
+    Returns whether a cleanup was dispatched.
+    """
+    quota = int(aggregate.get('quota_bytes', QUOTA_BYTES))
+    if not quota or not CLEANER_FUNCTION_NAME:
+        return False
+
+    try:
+        if total_size <= quota:
+            if 'cleanup_retry_at' in aggregate:
+                with metrics.stage('dynamodb_write'):
+                    table.update_item(
+                        Key=aggregate_key(bucket_name),
+                        UpdateExpression='REMOVE cleanup_requested_at, cleanup_retry_at',
+                        ConditionExpression='cleanup_retry_at = :seen',
+                        ExpressionAttributeValues={':seen': aggregate['cleanup_retry_at']}
+                    )
+            return False
+
+        with metrics.stage('dynamodb_write'):
+            claimed = update_if(
+                aggregate_key(bucket_name),
+                {
+                    'cleanup_requested_at': current_timestamp,
+                    'cleanup_retry_at': current_timestamp + CLEANUP_DEBOUNCE_SECONDS
+                },
+                'attribute_not_exists(cleanup_retry_at) OR cleanup_retry_at <= :cleanup_requested_at'
+            )
+        if not claimed:
+            metrics.count('debounced_cleanups')
+            return False
+
+        print(f"Bucket {bucket_name} is {total_size - quota} bytes over its quota of {quota} bytes, "
+              f"invoking {CLEANER_FUNCTION_NAME}")
+        with metrics.stage('cleaner_dispatch'):
+            lambda_client.invoke(
+                FunctionName=CLEANER_FUNCTION_NAME,
+                InvocationType='Event',
+                Payload=json.dumps({
+                    'source': 'size-tracking',
+                    'bucketName': bucket_name,
+                    'target_size': quota,
+                    'overage': total_size - quota
+                })
+            )
+        metrics.count('dispatched_cleanups')
+        return True
+    except Exception as e:
+        print(f"Error enforcing quota for bucket {bucket_name}: {e}")
+        metrics.count('quota_errors')
+        return False
+
+def handle_reconcile(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Direct invocation (e.g. scheduled): {"action": "reconcile", "bucketName": "..."}
+    """
+    bucket_name = event.get('bucketName') or BUCKET_NAME
+
     try:
-        # Use paginator to handle buckets with many objects
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket_name)
-        
-        for page in pages:
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    # EXCLUDE plot files from calculation
-                    if obj['Key'] not in ['plot', 'plot.png']:
-                        total_size += obj['Size']
-                        object_count += 1
-                        print(f"  Including: {obj['Key']} - {obj['Size']} bytes")
-                    else:
-                        print(f"  Excluding plot file: {obj['Key']}")
-        
-        print(f"Total size: {total_size} bytes, Object count: {object_count}")
-        
+        aggregate = reconcile(bucket_name)
+        total_size = int(aggregate['total_size'])
+        object_count = int(aggregate['object_count'])
+        current_timestamp = Decimal(str(time.time()))
+        with metrics.stage('dynamodb_write'):
+            write_sample(bucket_name, total_size, object_count, current_timestamp)
+            update_rollups(bucket_name, total_size, object_count, current_timestamp, total_size, total_size)
+            update_aggregate_sample(bucket_name, aggregate, current_timestamp, total_size, total_size)
     except Exception as e:
-        print(f"Error listing objects: {e}")
+        print(f"Error reconciling bucket: {e}")
         return {
             'statusCode': 500,
-            'body': json.dumps(f'Error calculating bucket size: {str(e)}')
+            'body': json.dumps(f'Error reconciling bucket: {str(e)}')
+        }
+
+    publish_bucket_sizes([{
+        'bucketName': bucket_name,
+        'total_size': total_size,
+        'timestamp': float(current_timestamp)
+    }])
+    enforce_quota(bucket_name, aggregate, total_size, current_timestamp)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Reconciliation completed',
+            'bucketName': bucket_name,
+            'total_size': total_size,
+            'object_count': object_count,
+            'timestamp': float(current_timestamp)
+        })
+    }
+
+def query_history(partition: str, start: float, end: float, projection: str,
+                  limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Items of a history partition with start <= timestamp < end, in order.
+    With a limit, only that many items are read.
+    """
+    query_kwargs: Dict[str, Any] = {
+        'KeyConditionExpression': 'bucketName = :bn AND #ts BETWEEN :start AND :end',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'},
+        'ExpressionAttributeValues': {
+            ':bn': partition,
+            ':start': Decimal(str(start)),
+            ':end': Decimal(str(end))
+        },
+        'ProjectionExpression': projection
+    }
+    if limit is not None:
+        query_kwargs['Limit'] = limit
+
+    while True:
+        with metrics.stage('dynamodb_read'):
+            response = table.query(**query_kwargs)
+        for item in response['Items']:
+            if item['timestamp'] < end:
+                yield item
+        if limit is not None or 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def query_packed_samples(partition: str, start: float, end: float) -> Iterator[Dict[str, Any]]:
+    """
+    Samples of a packed partition with start <= timestamp < end, in order,
+    as items of the per-sample layout.
+    """
+    for block in query_history(partition, block_start(start), end, '#ts, timestamps, sizes, object_counts'):
+        for micros, total_size, object_count in decode_block(block):
+            timestamp = from_micros(micros)
+            if start <= timestamp < end:
+                yield {'timestamp': timestamp, 'total_size': total_size, 'object_count': object_count}
+
+def next_sample_time(bucket_name: str, after: float, before: float) -> Optional[float]:
+    """
+    Timestamp of the bucket's first raw sample in [after, before), if any.
+    """
+    first = [
+        float(item['timestamp'])
+        for partition in sample_partitions(bucket_name)
+        for item in query_history(partition, after, before, '#ts', limit=1)
+    ]
+    for partition in packed_partitions(bucket_name):
+        sample = next(query_packed_samples(partition, after, before), None)
+        if sample is not None:
+            first.append(float(sample['timestamp']))
+    return min(first) if first else None
+
+def fold_samples(samples: List[Dict[str, Any]]) -> Dict[Tuple[str, int], Dict[str, Any]]:
+    """
+    The rollup items of every tier for the given raw samples, by (tier, window start).
+    """
+    rollups: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    for sample in sorted(samples, key=lambda sample: sample['timestamp']):
+        timestamp = sample['timestamp']
+        size = int(sample['total_size'])
+        for tier, window in ROLLUP_TIERS.items():
+            window_start = int(timestamp // window) * window
+            rollup = rollups.get((tier, window_start))
+            if rollup is None:
+                rollup = rollups[(tier, window_start)] = {
+                    'sample_count': 0,
+                    'min_size': size, 'min_timestamp': timestamp,
+                    'max_size': size, 'max_timestamp': timestamp
+                }
+            rollup['sample_count'] += 1
+            rollup.update(last_timestamp=timestamp, last_size=size,
+                          last_object_count=int(sample['object_count']))
+            if size < rollup['min_size']:
+                rollup.update(min_size=size, min_timestamp=timestamp)
+            if size > rollup['max_size']:
+                rollup.update(max_size=size, max_timestamp=timestamp)
+    return rollups
+
+def merge_rollup(stored: Optional[Dict[str, Any]], folded: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    A stored rollup item with a rollup folded from raw samples merged in.
+    Extremes only widen: the stored ones also cover the sizes the total
+    went through within a batch, which raw samples do not record.
+    """
+    if stored is None:
+        return dict(folded)
+
+    merged = dict(stored)
+    merged['sample_count'] = max(int(stored.get('sample_count', 0)), folded['sample_count'])
+    if 'min_size' not in stored or folded['min_size'] < stored['min_size']:
+        merged.update(min_size=folded['min_size'], min_timestamp=folded['min_timestamp'])
+    if 'max_size' not in stored or folded['max_size'] > stored['max_size']:
+        merged.update(max_size=folded['max_size'], max_timestamp=folded['max_timestamp'])
+    if 'last_timestamp' not in stored or folded['last_timestamp'] > stored['last_timestamp']:
+        merged.update(last_timestamp=folded['last_timestamp'], last_size=folded['last_size'],
+                      last_object_count=folded['last_object_count'])
+    return merged
+
+def compact_day(bucket_name: str, day_start: int) -> Dict[str, int]:
+    """
+    Fold one day of raw samples into the rollups and make sure they expire.
+    Only rollup items the raw samples change are written, normally none:
+    samples are folded in as they are written. Samples from before raw
+    samples expired get their expires_at; packed blocks get theirs when
+    they are written.
+    """
+    day_end = day_start + COMPACTION_DAY_SECONDS
+    samples = [
+        dict(item, bucketName=partition)
+        for partition in sample_partitions(bucket_name)
+        for item in query_history(partition, day_start, day_end, '#ts, total_size, object_count, expires_at')
+    ]
+    packed_samples = [
+        sample
+        for partition in packed_partitions(bucket_name)
+        for sample in query_packed_samples(partition, day_start, day_end)
+    ]
+    stats = {'samples': len(samples) + len(packed_samples), 'rollups_written': 0, 'samples_expired': 0}
+    if not stats['samples']:
+        return stats
+
+    folded = fold_samples(samples + packed_samples)
+    for tier in ROLLUP_TIERS:
+        partition = f'{bucket_name}#{tier}'
+        stored = {
+            int(item['timestamp']): item
+            for item in query_history(partition, day_start, day_end,
+                                      '#ts, sample_count, min_size, min_timestamp, max_size, '
+                                      'max_timestamp, last_timestamp, last_size, last_object_count')
         }
-    
-    # Get current timestamp
-    current_timestamp = Decimal(str(time.time()))
-    
-    # Write to DynamoDB
+        for (folded_tier, window_start), rollup in folded.items():
+            if folded_tier != tier:
+                continue
+            merged = merge_rollup(stored.get(window_start), rollup)
+            if merged == stored.get(window_start):
+                continue
+            attributes = {name: value for name, value in merged.items() if name != 'timestamp'}
+            with metrics.stage('dynamodb_write'):
+                table.update_item(
+                    Key={'bucketName': partition, 'timestamp': window_start},
+                    UpdateExpression='SET ' + ', '.join(f'#{name} = :{name}' for name in attributes),
+                    ExpressionAttributeNames={f'#{name}': name for name in attributes},
+                    ExpressionAttributeValues={f':{name}': value for name, value in attributes.items()}
+                )
+            stats['rollups_written'] += 1
+
+    if RAW_RETENTION_SECONDS:
+        # The projected attributes are all a raw sample has, so the samples
+        # are rewritten whole, 25 per BatchWriteItem call
+        unexpired = [sample for sample in samples if 'expires_at' not in sample]
+        with metrics.stage('dynamodb_write'), table.batch_writer() as batch:
+            for sample in unexpired:
+                batch.put_item(Item=dict(sample, expires_at=int(sample['timestamp']) + RAW_RETENTION_SECONDS))
+        stats['samples_expired'] = len(unexpired)
+
+    return stats
+
+def compact(bucket_name: str, context: Any = None) -> Dict[str, Any]:
+    """
+    Compact every whole day of raw samples older than COMPACT_AFTER_SECONDS
+    that earlier runs have not, recording progress on the aggregate item
+    (compacted_until) after each day. Days without samples are skipped;
+    when the lambda is about to time out, the next run picks up from there.
+    """
+    cutoff = int((time.time() - COMPACT_AFTER_SECONDS) // COMPACTION_DAY_SECONDS) * COMPACTION_DAY_SECONDS
+    with metrics.stage('dynamodb_read'):
+        aggregate = table.get_item(
+            Key=aggregate_key(bucket_name),
+            ProjectionExpression='compacted_until'
+        ).get('Item', {})
+    compacted_until = int(aggregate.get('compacted_until', 0))
+
+    totals = {'days': 0, 'samples': 0, 'rollups_written': 0, 'samples_expired': 0}
+    while compacted_until < cutoff:
+        if context is not None and context.get_remaining_time_in_millis() < COMPACTION_MARGIN_MILLIS:
+            print(f"Stopping compaction at {compacted_until} before the timeout")
+            break
+
+        first = next_sample_time(bucket_name, compacted_until, cutoff)
+        if first is None:
+            day_end = cutoff
+        else:
+            day_start = int(first // COMPACTION_DAY_SECONDS) * COMPACTION_DAY_SECONDS
+            day_end = day_start + COMPACTION_DAY_SECONDS
+            stats = compact_day(bucket_name, day_start)
+            totals['days'] += 1
+            for name, value in stats.items():
+                totals[name] += value
+
+        with metrics.stage('dynamodb_write'):
+            update_if(
+                aggregate_key(bucket_name),
+                {'compacted_until': day_end},
+                'attribute_not_exists(compacted_until) OR compacted_until < :compacted_until'
+            )
+        compacted_until = day_end
+
+    print(f"Compacted {totals['samples']} samples over {totals['days']} days up to {compacted_until}: "
+          f"{totals['rollups_written']} rollup items written, {totals['samples_expired']} samples set to expire")
+    return dict(totals, compacted_until=compacted_until)
+
+def handle_compact(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Direct invocation (e.g. scheduled): {"action": "compact", "bucketName": "..."}
+    """
+    bucket_name = event.get('bucketName') or BUCKET_NAME
+
     try:
-        table.put_item(
-            Item={
-                'bucketName': bucket_name,
-                'timestamp': current_timestamp,
-                'total_size': total_size,
-                'object_count': object_count
-            }
-        )
-        
-        print(f"Successfully wrote to DynamoDB: timestamp={current_timestamp}")
-        
+        result = compact(bucket_name, context)
     except Exception as e:
-        print(f"Error writing to DynamoDB: {e}")
+        print(f"Error compacting history: {e}")
         return {
             'statusCode': 500,
-            'body': json.dumps(f'Error writing to DynamoDB: {str(e)}')
+            'body': json.dumps(f'Error compacting history: {str(e)}')
         }
-    
+
     return {
         'statusCode': 200,
-        'body': json.dumps({
-            'message': 'Size tracking completed',
+        'body': json.dumps(dict(result, message='Compaction completed', bucketName=bucket_name))
+    }
+
+def parse_event_time(s3_record: Dict[str, Any]) -> Decimal:
+    """
+    Epoch seconds of an S3 record's eventTime (e.g. 2024-01-01T00:00:00.000Z).
+    """
+    event_time = s3_record.get('eventTime')
+    if not event_time:
+        return Decimal(str(time.time()))
+    return Decimal(str(datetime.fromisoformat(event_time.replace('Z', '+00:00')).timestamp()))
+
+def parse_record(s3_record: Dict[str, Any]) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    """
+    The (bucket_name, object_key, change) of a single S3 record; change is
+    None for records that do not change the object index.
+    """
+    event_name = s3_record['eventName']
+    bucket_name = s3_record['s3']['bucket']['name']
+    # Keys arrive URL-encoded in S3 notifications
+    object_key = urllib.parse.unquote_plus(s3_record['s3']['object']['key'])
+
+    # CRITICAL: Ignore events for the plot file itself
+    if is_plot_key(object_key):
+        metrics.count('ignored_records')
+        return bucket_name, object_key, None
+
+    if event_name.startswith('ObjectCreated'):
+        change = {
+            'event': 'created',
+            'size': s3_record['s3']['object'].get('size', 0),
+            'event_time': parse_event_time(s3_record)
+        }
+    elif event_name.startswith('ObjectRemoved'):
+        change = {'event': 'removed'}
+    else:
+        return bucket_name, object_key, None
+    change['sequencer'] = get_sequencer(s3_record)
+    return bucket_name, object_key, change
+
+@metrics.instrument
+def lambda_handler(event, context):
+    """
+    Triggered by batches of SQS messages (which contain SNS messages with S3 events).
+    Applies every object's size delta to the bucket's running total and
+    stores one sample per bucket per batch in DynamoDB, folding it into
+    the minute/hour/day rollups, and publishes the new totals as the
+    BucketSize metric. Buckets over their quota get the cleaner invoked.
+    Failed messages are reported through batchItemFailures so only they are retried.
+    A record only takes effect if its S3 sequencer is newer than the last one
+    applied to its key, so duplicate and out-of-order deliveries cannot
+    corrupt the totals.
+    Per-record outcomes are counted in the invocation's metrics, not logged.
+    """
+
+    if event.get('action') == 'reconcile':
+        print(f"Event received: {json.dumps(event)}")
+        return handle_reconcile(event)
+
+    if event.get('action') == 'compact':
+        print(f"Event received: {json.dumps(event)}")
+        return handle_compact(event, context)
+
+    print(f"Received {len(event.get('Records', []))} messages")
+
+    failed_message_ids = set()
+    # bucket -> key -> its changes in order, and the messages they came from
+    pending: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+    message_ids: Dict[str, Set[str]] = {}
+    # bucket -> (key, position in the key's changes) of every record, in order
+    record_order: Dict[str, List[Tuple[str, int]]] = {}
+
+    # Parse every record first; a message whose records cannot all be
+    # parsed is retried as a whole and contributes nothing now
+    for message_id, s3_event in extract_s3_events_from_sqs(event):
+        if s3_event is None:
+            failed_message_ids.add(message_id)
+            continue
+
+        try:
+            parsed = []
+            for s3_record in s3_event.get('Records', []):
+                metrics.count('records')
+                parsed.append(parse_record(s3_record))
+        except Exception as e:
+            print(f"Error processing record in message {message_id}: {e}")
+            failed_message_ids.add(message_id)
+            continue
+
+        for bucket_name, object_key, change in parsed:
+            # Ignored records (plot artifacts, events that neither create nor
+            # remove an object) must not cause a sample to be written
+            if change is None:
+                continue
+            changes = pending.setdefault(bucket_name, {})
+            message_ids.setdefault(bucket_name, set()).add(message_id)
+            order = record_order.setdefault(bucket_name, [])
+            if TRACKING_MODE == 'full':
+                continue
+            change['message_id'] = message_id
+            key_changes = changes.setdefault(object_key, [])
+            order.append((object_key, len(key_changes)))
+            key_changes.append(change)
+
+    # Index records and aggregate deltas are committed together per chunk of
+    # keys; then one sample per bucket for the whole batch
+    results = []
+    for bucket_name, changes in pending.items():
+        try:
+            if TRACKING_MODE == 'full':
+                size_deltas: List[int] = []
+                count_delta = 0
+                total_size, object_count = calculate_bucket_totals(bucket_name)
+                aggregate = {'total_size': total_size, 'object_count': object_count}
+            else:
+                object_keys = list(changes)
+                deltas: Dict[str, List[Tuple[int, int]]] = {}
+                for start in range(0, len(object_keys), INDEX_TRANSACTION_KEYS):
+                    chunk = {object_key: changes[object_key]
+                             for object_key in object_keys[start:start + INDEX_TRANSACTION_KEYS]}
+                    try:
+                        deltas.update(commit_changes(bucket_name, chunk))
+                    except Exception as e:
+                        # Committed chunks stay committed; a retry finds their
+                        # records already applied and only commits the rest
+                        print(f"Error committing records of bucket {bucket_name}: {e}")
+                        failed_message_ids.update(
+                            change['message_id'] for key_changes in chunk.values() for change in key_changes
+                        )
+
+                aggregate = read_aggregate(bucket_name)
+                if aggregate is None:
+                    aggregate = reconcile(bucket_name)
+                total_size = int(aggregate['total_size'])
+                object_count = int(aggregate['object_count'])
+                # Every committed record's size delta, in the order of the records
+                size_deltas = [
+                    deltas[object_key][position][0]
+                    for object_key, position in record_order[bucket_name] if object_key in deltas
+                ]
+                count_delta = sum(count for key_deltas in deltas.values() for _, count in key_deltas)
+
+            size_delta = sum(size_deltas)
+            print(f"Bucket {bucket_name}: applied {size_delta:+d} bytes, {count_delta:+d} objects")
+            print(f"Total size: {total_size} bytes, Object count: {object_count}")
+
+            # Replay the batch's deltas to find the extremes the total went
+            # through, so spikes inside a batch still reach max/min
+            running_size = total_size - size_delta
+            high = low = total_size
+            for delta in size_deltas:
+                running_size += delta
+                high = max(high, running_size)
+                low = min(low, running_size)
+
+            current_timestamp = Decimal(str(time.time()))
+            with metrics.stage('dynamodb_write'):
+                write_sample(bucket_name, total_size, object_count, current_timestamp)
+                update_rollups(bucket_name, total_size, object_count, current_timestamp, high, low)
+                # Last, since the aggregate's last_timestamp is the plot cache watermark
+                update_aggregate_sample(bucket_name, aggregate, current_timestamp, high, low)
+
+        except Exception as e:
+            print(f"Error updating totals for bucket {bucket_name}: {e}")
+            failed_message_ids.update(message_ids[bucket_name])
+            continue
+
+        results.append({
             'bucketName': bucket_name,
             'total_size': total_size,
             'object_count': object_count,
-            'timestamp': float(current_timestamp)
+            'timestamp': float(current_timestamp),
+            'cleanup_dispatched': enforce_quota(bucket_name, aggregate, total_size, current_timestamp)
         })
-    }
\ No newline at end of file
+
+    # One metric call for every bucket of the batch
+    publish_bucket_sizes(results)
+
+    if failed_message_ids:
+        metrics.count('failed_messages', len(failed_message_ids))
+        print(f"Reporting {len(failed_message_ids)} failed messages for retry")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Size tracking completed',
+            'buckets': results
+        }),
+        'batchItemFailures': [
+            {'itemIdentifier': message_id} for message_id in sorted(failed_message_ids)
+        ]
+    }
@@ -12,6 +12,8 @@ import * as logs from "aws-cdk-lib/aws-logs";
 import * as cloudwatch from "aws-cdk-lib/aws-cloudwatch";
 import * as cloudwatchActions from "aws-cdk-lib/aws-cloudwatch-actions";
 import * as iam from "aws-cdk-lib/aws-iam";
+import * as events from "aws-cdk-lib/aws-events";
+import * as eventTargets from "aws-cdk-lib/aws-events-targets";
 
 // Use ARN strings instead of resource objects to avoid circular dependencies
 interface LambdaStackProps extends cdk.StackProps {
@@ -19,6 +21,8 @@ interface LambdaStackProps extends cdk.StackProps {
   bucketName: string;
   tableArn: string;
   tableName: string;
+  objectIndexTableArn: string;
+  objectIndexTableName: string;
   // REMOVED: apiUrl?: string;
   // We will add the API URL in the bin/assignment3.ts file after ApiStack is created.
 }
@@ -41,6 +45,15 @@ export class LambdaStack extends cdk.Stack {
       props.bucketArn
     );
     const table = Table.fromTableArn(this, "ImportedTable", props.tableArn);
+    // Declare the GSI so that grants also cover index/bySize
+    const objectIndexTable = Table.fromTableAttributes(
+      this,
+      "ImportedObjectIndexTable",
+      {
+        tableArn: props.objectIndexTableArn,
+        globalIndexes: ["bySize"],
+      }
+    );
 
     // ============================================================================
     // SNS Topic for S3 Event Fanout (Assignment 4)
@@ -61,6 +74,21 @@ export class LambdaStack extends cdk.Stack {
       new s3n.SnsDestination(s3EventTopic)
     );
 
+    // Plot renders are cached in the bucket under plot-cache/. S3 notification
+    // filters cannot exclude a prefix, so the subscriptions drop those events
+    // by message body: renders reach neither queue nor any lambda
+    const trackedObjectsFilter = {
+      Records: sns.FilterOrPolicy.policy({
+        s3: sns.FilterOrPolicy.policy({
+          object: sns.FilterOrPolicy.policy({
+            key: sns.FilterOrPolicy.filter(
+              new sns.SubscriptionFilter([{ "anything-but": { prefix: "plot-cache/" } }])
+            ),
+          }),
+        }),
+      }),
+    };
+
     // ============================================================================
     // SQS Queues for Size Tracking and Logging Lambdas
     // ============================================================================
@@ -74,7 +102,8 @@ export class LambdaStack extends cdk.Stack {
     // Queue for Size Tracking Lambda
     const sizeTrackingQueue = new sqs.Queue(this, "SizeTrackingQueue", {
       queueName: "Assignment4-SizeTrackingQueue",
-      visibilityTimeout: cdk.Duration.seconds(60),
+      // 6x the consumer timeout, as recommended for batched SQS event sources
+      visibilityTimeout: cdk.Duration.seconds(180),
       deadLetterQueue: {
         queue: sizeTrackingDLQ,
         maxReceiveCount: 3,
@@ -83,7 +112,9 @@ export class LambdaStack extends cdk.Stack {
 
     // Subscribe Size Tracking Queue to SNS Topic
     s3EventTopic.addSubscription(
-      new subscriptions.SqsSubscription(sizeTrackingQueue)
+      new subscriptions.SqsSubscription(sizeTrackingQueue, {
+        filterPolicyWithMessageBody: trackedObjectsFilter,
+      })
     );
 
     // Dead Letter Queue for Logging
@@ -95,7 +126,8 @@ export class LambdaStack extends cdk.Stack {
     // Queue for Logging Lambda
     const loggingQueue = new sqs.Queue(this, "LoggingQueue", {
       queueName: "Assignment4-LoggingQueue",
-      visibilityTimeout: cdk.Duration.seconds(60),
+      // 6x the consumer timeout, as recommended for batched SQS event sources
+      visibilityTimeout: cdk.Duration.seconds(180),
       deadLetterQueue: {
         queue: loggingDLQ,
         maxReceiveCount: 3,
@@ -104,9 +136,52 @@ export class LambdaStack extends cdk.Stack {
 
     // Subscribe Logging Queue to SNS Topic
     s3EventTopic.addSubscription(
-      new subscriptions.SqsSubscription(loggingQueue)
+      new subscriptions.SqsSubscription(loggingQueue, {
+        filterPolicyWithMessageBody: trackedObjectsFilter,
+      })
     );
 
+    // ============================================================================
+    // Layer shared by all lambdas: lazily created, pooled AWS clients,
+    // per-stage timings, cold starts and API call counts, logged in
+    // CloudWatch embedded metric format, and a parallel bucket lister
+    // ============================================================================
+    const sharedLayer = new lambda.LayerVersion(this, "SharedLayer", {
+      code: lambda.Code.fromAsset("lambda/layers/shared"),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_11],
+      compatibleArchitectures: [lambda.Architecture.ARM_64],
+      description:
+        "Shared AWS clients, embedded-format timing metrics, S3 event parsing and plot key filtering, concurrent page streams, bucket listing, the history layout and the packed history codec",
+    });
+
+    const sharedEnvironment = {
+      // Fraction of invocations that log their metrics
+      METRICS_SAMPLE_RATE: "1",
+      // Fail fast and retry instead of waiting out botocore's 60 s defaults
+      CLIENT_CONNECT_TIMEOUT_SECONDS: "3",
+      CLIENT_READ_TIMEOUT_SECONDS: "10",
+      // Key-space shards listed concurrently by full bucket scans
+      LISTING_MAX_WORKERS: "8",
+      // Removed keys are remembered as tombstones for a day, so late or
+      // redelivered events for them are still recognized
+      TOMBSTONE_TTL_SECONDS: "86400",
+      // Partitions raw history samples are spread over (written by the Size
+      // Tracking Lambda, read back by the Plotting Lambda)
+      HISTORY_SHARDS: "1",
+      // Raw history samples expire after 7 days; compaction has folded them
+      // into the minute/hour/day rollups by then
+      RAW_RETENTION_SECONDS: "604800",
+      // "packed" appends raw samples to one item per PACKED_BLOCK_SECONDS
+      // (delta-encoded binary columns) instead of writing an item each
+      HISTORY_LAYOUT: "items",
+      PACKED_BLOCK_SECONDS: "300",
+      // Bucket size quota in bytes: the Size Tracking Lambda invokes the
+      // Cleaner Lambda as soon as a new total exceeds it (at most once per
+      // debounce window), /query reports the time spent above it and each
+      // driver step waits until the bucket is tracked back within it
+      QUOTA_BYTES: "20",
+    };
+
     // ============================================================================
     // Size Tracking Lambda (now consumes from SQS)
     // ============================================================================
@@ -119,17 +194,61 @@ export class LambdaStack extends cdk.Stack {
       environment: {
         BUCKET_ARN: props.bucketArn,
         TABLE_NAME: props.tableName,
+        OBJECT_INDEX_TABLE_NAME: props.objectIndexTableName,
+        TRACKING_MODE: "incremental",
+        COMPACT_AFTER_SECONDS: "86400",
+        // Concurrent conditional index writes of a reconciliation
+        RECONCILE_WRITE_WORKERS: "16",
+        // Every new total is published as the BucketSize metric the size
+        // alarm watches: "put" (PutMetricData), "emf" (log line) or "off"
+        SIZE_METRIC_EMISSION: "put",
+        CLEANUP_DEBOUNCE_SECONDS: "30",
+        ...sharedEnvironment,
       },
+      layers: [sharedLayer],
     });
 
     // Grant permissions
     bucket.grantRead(this.sizeTrackingLambda);
     table.grantReadWriteData(this.sizeTrackingLambda);
+    objectIndexTable.grantReadWriteData(this.sizeTrackingLambda);
+    cloudwatch.Metric.grantPutMetricData(this.sizeTrackingLambda);
+
+    // Daily full-listing reconciliation to correct any drift in the running
+    // totals; safe while events flow, it leaves records indexed after its
+    // listing started alone and only stores totals no batch has changed since
+    new events.Rule(this, "SizeTrackingReconcileRule", {
+      schedule: events.Schedule.rate(cdk.Duration.days(1)),
+      targets: [
+        new eventTargets.LambdaFunction(this.sizeTrackingLambda, {
+          event: events.RuleTargetInput.fromObject({
+            action: "reconcile",
+            bucketName: props.bucketName,
+          }),
+        }),
+      ],
+    });
+
+    // Daily compaction of raw history samples older than a day into the
+    // rollups, before they expire
+    new events.Rule(this, "SizeTrackingCompactionRule", {
+      schedule: events.Schedule.rate(cdk.Duration.days(1)),
+      targets: [
+        new eventTargets.LambdaFunction(this.sizeTrackingLambda, {
+          event: events.RuleTargetInput.fromObject({
+            action: "compact",
+            bucketName: props.bucketName,
+          }),
+        }),
+      ],
+    });
 
     // Add SQS as event source for Size Tracking Lambda
     this.sizeTrackingLambda.addEventSource(
       new lambdaEventSources.SqsEventSource(sizeTrackingQueue, {
-        batchSize: 1,
+        batchSize: 100,
+        maxBatchingWindow: cdk.Duration.seconds(5),
+        reportBatchItemFailures: true,
       })
     );
 
@@ -152,27 +271,29 @@ export class LambdaStack extends cdk.Stack {
       timeout: cdk.Duration.seconds(30),
       environment: {
         BUCKET_NAME: props.bucketName,
-        LOG_GROUP_NAME: loggingLambdaLogGroup.logGroupName,
+        OBJECT_INDEX_TABLE_NAME: props.objectIndexTableName,
+        ...sharedEnvironment,
       },
+      layers: [sharedLayer],
       logGroup: loggingLambdaLogGroup,
     });
 
-    // Grant CloudWatch Logs permissions to query logs for deleted object sizes
-    this.loggingLambda.addToRolePolicy(
-      new iam.PolicyStatement({
-        actions: ["logs:FilterLogEvents"],
-        resources: [loggingLambdaLogGroup.logGroupArn],
-      })
-    );
+    // Events are deduplicated and ordered against the lambda's own records in
+    // the object index ({bucket}#logging partition); sizes of objects it has
+    // no record of are read from the Size Tracking Lambda's records
+    objectIndexTable.grantReadWriteData(this.loggingLambda);
 
     // Add SQS as event source for Logging Lambda
     this.loggingLambda.addEventSource(
       new lambdaEventSources.SqsEventSource(loggingQueue, {
-        batchSize: 1,
+        batchSize: 100,
+        maxBatchingWindow: cdk.Duration.seconds(5),
+        reportBatchItemFailures: true,
       })
     );
 
-    // Plotting Lambda with matplotlib layer
+    // Plotting Lambda. The layer provides NumPy for the built-in renderers;
+    // matplotlib from it is only imported when renderer=matplotlib is requested.
     const matplotlibLayer = lambda.LayerVersion.fromLayerVersionArn(
       this,
       "MatplotlibLayer",
@@ -189,12 +310,16 @@ export class LambdaStack extends cdk.Stack {
       environment: {
         BUCKET_ARN: props.bucketArn,
         TABLE_NAME: props.tableName,
+        PLOT_RENDERER: "png",
+        ...sharedEnvironment,
       },
-      layers: [matplotlibLayer],
+      layers: [matplotlibLayer, sharedLayer],
     });
 
     table.grantReadData(this.plottingLambda);
-    bucket.grantWrite(this.plottingLambda);
+    // Renders are cached under plot-cache/ and served from there, directly or
+    // through presigned URLs
+    bucket.grantReadWrite(this.plottingLambda, "plot-cache/*");
 
     // API Gateway
     const api = new apigateway.RestApi(this, "PlottingApi", {
@@ -207,6 +332,13 @@ export class LambdaStack extends cdk.Stack {
         allowOrigins: apigateway.Cors.ALL_ORIGINS,
         allowMethods: apigateway.Cors.ALL_METHODS,
       },
+      // Plots and Arrow exports are returned as binary to requests that
+      // Accept these types
+      binaryMediaTypes: [
+        "image/png",
+        "image/svg+xml",
+        "application/vnd.apache.arrow.stream",
+      ],
     });
 
     const plottingIntegration = new apigateway.LambdaIntegration(
@@ -217,6 +349,8 @@ export class LambdaStack extends cdk.Stack {
     );
 
     api.root.addMethod("GET", plottingIntegration);
+    // Raw samples and aggregates over a window, paginated with a cursor
+    api.root.addResource("query").addMethod("GET", plottingIntegration);
 
     this.apiUrl = api.url;
 
@@ -230,18 +364,25 @@ export class LambdaStack extends cdk.Stack {
       environment: {
         BUCKET_ARN: props.bucketArn,
         TABLE_NAME: props.tableName,
+        OBJECT_INDEX_TABLE_NAME: props.objectIndexTableName,
         API_URL: this.apiUrl,
+        ...sharedEnvironment,
       },
+      layers: [sharedLayer],
     });
 
     bucket.grantReadWrite(this.driverLambda);
+    // Load mode polls the index and the aggregate item for end-to-end latency
+    table.grantReadData(this.driverLambda);
+    objectIndexTable.grantReadData(this.driverLambda);
     this.plottingLambda.grantInvoke(this.driverLambda);
 
     // ============================================================================
     // CloudWatch Metric Filter for Logging Lambda (Assignment 4)
     // ============================================================================
 
-    // Create metric filter to extract size_delta from logs
+    // Create metric filter to extract size_delta from logs. The alarm watches
+    // the BucketSize gauge instead; this keeps the per-minute change in size
     const metricFilter = new logs.MetricFilter(this, "SizeDeltaMetricFilter", {
       logGroup: loggingLambdaLogGroup,
       metricNamespace: "Assignment4App",
@@ -251,15 +392,18 @@ export class LambdaStack extends cdk.Stack {
     });
 
     // ============================================================================
-    // CloudWatch Alarm for TotalObjectSize Metric (Assignment 4)
+    // CloudWatch Alarm on the bucket's total size (Assignment 4)
     // ============================================================================
 
-    // Create metric for the alarm
-    const totalObjectSizeMetric = new cloudwatch.Metric({
+    // High-resolution gauge published by the Size Tracking Lambda after every
+    // batch, so the alarm sees the bucket's actual size within seconds rather
+    // than a sum of logged deltas after log ingestion
+    const bucketSizeMetric = new cloudwatch.Metric({
       namespace: "Assignment4App",
-      metricName: "TotalObjectSize",
-      statistic: "Sum",
-      period: cdk.Duration.minutes(1),
+      metricName: "BucketSize",
+      dimensionsMap: { BucketName: props.bucketName },
+      statistic: "Maximum",
+      period: cdk.Duration.seconds(10),
     });
 
     // ============================================================================
@@ -274,21 +418,41 @@ export class LambdaStack extends cdk.Stack {
       timeout: cdk.Duration.seconds(30),
       environment: {
         BUCKET_NAME: props.bucketName,
+        TABLE_NAME: props.tableName,
+        OBJECT_INDEX_TABLE_NAME: props.objectIndexTableName,
+        OBJECT_SIZE_INDEX_NAME: "bySize",
+        // Evict objects until the bucket is back at or below the alarm threshold
+        TARGET_SIZE_BYTES: "20",
+        EVICTION_POLICY: "largest",
+        ...sharedEnvironment,
       },
+      layers: [sharedLayer],
     });
 
     // Grant permissions to list and delete objects
     bucket.grantRead(this.cleanerLambda);
     bucket.grantDelete(this.cleanerLambda);
+    // Largest objects are read from the size-ordered object index
+    objectIndexTable.grantReadData(this.cleanerLambda);
+    // Current bucket size is read from the aggregate item in the history table
+    table.grantReadData(this.cleanerLambda);
+
+    // Quota breaches seen by the Size Tracking Lambda invoke the cleaner
+    // asynchronously; the alarm below is the backstop
+    this.sizeTrackingLambda.addEnvironment("CLEANER_FUNCTION_NAME", this.cleanerLambda.functionName);
+    this.cleanerLambda.grantInvoke(this.sizeTrackingLambda);
 
     // Create CloudWatch Alarm
     const alarm = new cloudwatch.Alarm(this, "TotalObjectSizeAlarm", {
       alarmName: "Assignment4-TotalObjectSize-Alarm",
-      alarmDescription: "Alarm when total object size sum exceeds 20 bytes",
-      metric: totalObjectSizeMetric,
+      alarmDescription: "Alarm when the bucket's total object size exceeds 20 bytes",
+      metric: bucketSizeMetric,
       threshold: 20,
       evaluationPeriods: 1,
       comparisonOperator: cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+      // The gauge is only published when the size changes. Periods without
+      // updates clear the alarm, so the next breach fires its action again
+      // even if a period held both a breach and the size after its cleanup
       treatMissingData: cloudwatch.TreatMissingData.NOT_BREACHING,
     });
 
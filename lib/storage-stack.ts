@@ -5,6 +5,7 @@ import { Bucket } from "aws-cdk-lib/aws-s3";
 export class StorageStack extends cdk.Stack {
   public readonly bucket: Bucket;
   public readonly table: dynamodb.Table;
+  public readonly objectIndexTable: dynamodb.Table;
 
   constructor(scope: cdk.App, id: string, props?: cdk.StackProps) {
     super(scope, id, props);
@@ -13,14 +14,43 @@ export class StorageStack extends cdk.Stack {
       versioned: true,
       removalPolicy: cdk.RemovalPolicy.DESTROY,
       autoDeleteObjects: true,
+      lifecycleRules: [
+        {
+          // Cached plot renders are only useful while their data is current
+          prefix: "plot-cache/",
+          expiration: cdk.Duration.days(1),
+          noncurrentVersionExpiration: cdk.Duration.days(1),
+        },
+      ],
     });
 
+    // Size history: raw samples expire at expires_at, once they have been
+    // compacted into the minute/hour/day rollups
     this.table = new dynamodb.Table(this, "assignment3-table", {
       partitionKey: { name: "bucketName", type: dynamodb.AttributeType.STRING },
       sortKey: { name: "timestamp", type: dynamodb.AttributeType.NUMBER },
+      timeToLiveAttribute: "expires_at",
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
+    // Key -> size record for every live object, so deletes can be accounted
+    // for without listing the bucket. Removed keys are kept as tombstones
+    // until expires_at so the logging lambda can still read their size.
+    this.objectIndexTable = new dynamodb.Table(this, "assignment3-object-index", {
+      partitionKey: { name: "bucketName", type: dynamodb.AttributeType.STRING },
+      sortKey: { name: "objectKey", type: dynamodb.AttributeType.STRING },
+      timeToLiveAttribute: "expires_at",
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // Sparse size-ordered index over live objects (tombstones drop live_size),
+    // so the cleaner can read the largest objects without listing the bucket
+    this.objectIndexTable.addGlobalSecondaryIndex({
+      indexName: "bySize",
+      partitionKey: { name: "bucketName", type: dynamodb.AttributeType.STRING },
+      sortKey: { name: "live_size", type: dynamodb.AttributeType.NUMBER },
+    });
+
     // Output the bucket and table names for reference
     new cdk.CfnOutput(this, "BucketName", {
       value: this.bucket.bucketName,
@@ -41,5 +71,10 @@ export class StorageStack extends cdk.Stack {
       value: this.table.tableArn,
       description: "DynamoDB Table ARN",
     });
+
+    new cdk.CfnOutput(this, "ObjectIndexTableName", {
+      value: this.objectIndexTable.tableName,
+      description: "DynamoDB Object Index Table Name",
+    });
   }
 }
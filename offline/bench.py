@@ -0,0 +1,383 @@
+"""
+Local micro-benchmarks for the lambda handlers.
+
+Every scenario loads a handler against the in-process fakes, seeds a
+synthetic bucket or size history, and then times a single invocation,
+reporting wall time, AWS API calls by operation, peak memory and log volume:
+
+    python -m offline.bench
+    python -m offline.bench --objects 1000000 --samples 1000000
+    python -m offline.bench --only cleaner,plotting --json
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from offline.events import s3_record, sqs_batch
+from offline.fakes import FakeAWS
+from offline.stack import BUCKET, LAMBDA_ENVIRONMENTS, OBJECT_INDEX_TABLE_NAME, TABLE_NAME, new_account
+
+DEFAULT_OBJECTS = '1000,10000,100000'
+DEFAULT_SAMPLES = 100000
+
+# Messages per SQS batch, as configured on the event sources
+BATCH_SIZE = 100
+
+def object_key(i: int) -> str:
+    return f'data/{i % 100:02d}/object-{i:07d}.bin'
+
+def seed_objects(aws: FakeAWS, count: int, indexed: bool = True) -> int:
+    """
+    count objects with log-normal sizes, modified over the last 30 days.
+    Optionally mirrors them in the object index and the aggregate item.
+    Returns the total size.
+    """
+    rng = random.Random(count)
+    now = time.time()
+    index_items = []
+    total_size = 0
+
+    for i in range(count):
+        size = int(rng.lognormvariate(7, 1.5))
+        modified = now - rng.uniform(0, 30 * 86400)
+        aws.s3.add_object(BUCKET, object_key(i), size,
+                          datetime.fromtimestamp(modified, tz=timezone.utc))
+        total_size += size
+        if indexed:
+            index_items.append({
+                'bucketName': BUCKET,
+                'objectKey': object_key(i),
+                'size': size,
+                'live_size': size,
+                'created_at': Decimal(str(modified)),
+                'last_modified': Decimal(str(modified))
+            })
+
+    if indexed:
+        aws.dynamodb.tables[OBJECT_INDEX_TABLE_NAME].load(index_items)
+        aws.dynamodb.tables[TABLE_NAME].put({
+            'bucketName': f'{BUCKET}#aggregate',
+            'timestamp': 0,
+            'total_size': total_size,
+            'object_count': count,
+            'max_size': total_size,
+            'min_size': 0,
+            'last_timestamp': Decimal(str(now)),
+            'last_size': total_size
+        })
+    return total_size
+
+def seed_history(aws: FakeAWS, samples: int, shards: int = 1,
+                 end: Optional[float] = None, packed: bool = False) -> Tuple[float, float]:
+    """
+    samples raw size samples one second apart, as a random walk ending at
+    end (default: now), plus the rollup items and aggregate item the
+    size-tracking lambda keeps. With shards > 1, the raw samples are spread
+    over that many partitions; with packed, they are written as the
+    HISTORY_LAYOUT=packed blocks. Like samples written before they expired,
+    they have no expires_at.
+    Returns the (first, last) sample timestamps.
+    """
+    rng = random.Random(samples)
+    end = float(int(time.time() if end is None else end))
+    start = end - samples + 1
+    size = 10 ** 6
+    items = []
+    rollups: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    # (partition, block start) -> the block's samples
+    blocks: Dict[Tuple[str, int], List[Tuple[int, int, int]]] = {}
+    # The partition names, tiers and block codec are the size-tracking lambda's
+    writer = aws.load_lambda('size-tracking-lambda',
+                             dict(LAMBDA_ENVIRONMENTS['size-tracking-lambda'], HISTORY_SHARDS=str(shards)))
+    shard_partitions = writer.sample_partitions(BUCKET)[-shards:]
+
+    for i in range(samples):
+        timestamp = start + i
+        size = max(0, size + rng.randint(-5000, 5000))
+        partition = shard_partitions[i % shards]
+        if packed:
+            blocks.setdefault((writer.packed_partition(partition), writer.block_start(timestamp)), []).append(
+                (int(timestamp) * 1000000, size, size // 1000))
+        else:
+            items.append({'bucketName': partition, 'timestamp': Decimal(str(timestamp)),
+                          'total_size': size, 'object_count': size // 1000})
+
+        for tier, window in writer.ROLLUP_TIERS.items():
+            window_start = int(timestamp // window) * window
+            rollup = rollups.setdefault((tier, window_start), {
+                'bucketName': f'{BUCKET}#{tier}', 'timestamp': window_start, 'sample_count': 0,
+                'min_size': size, 'min_timestamp': timestamp, 'max_size': size, 'max_timestamp': timestamp
+            })
+            rollup['sample_count'] += 1
+            rollup.update(last_size=size, last_timestamp=timestamp, last_object_count=size // 1000)
+            if size < rollup['min_size']:
+                rollup.update(min_size=size, min_timestamp=timestamp)
+            if size > rollup['max_size']:
+                rollup.update(max_size=size, max_timestamp=timestamp)
+
+    for (partition, block_start), block in blocks.items():
+        items.append(dict(writer.encode_block(block), bucketName=partition, timestamp=block_start))
+
+    for rollup in rollups.values():
+        for name in ('min_timestamp', 'max_timestamp', 'last_timestamp'):
+            rollup[name] = Decimal(str(rollup[name]))
+        items.append(rollup)
+
+    items.append({
+        'bucketName': f'{BUCKET}#aggregate', 'timestamp': 0,
+        'total_size': size, 'object_count': size // 1000,
+        'max_size': max(int(rollup['max_size']) for rollup in rollups.values()),
+        'last_timestamp': Decimal(str(end)), 'last_size': size
+    })
+    aws.dynamodb.tables[TABLE_NAME].load(items)
+    return start, end
+
+# ============================================================================
+# Scenarios: (aws, objects, samples) -> (lambda name, invocation)
+# ============================================================================
+
+Scenario = Callable[[FakeAWS, int, int], Tuple[str, Callable[[], Dict[str, Any]]]]
+
+def size_tracking_event_batch(aws: FakeAWS, objects: int, samples: int):
+    """
+    A full batch of new-object events applied incrementally.
+    """
+    seed_objects(aws, objects)
+    module = aws.load_lambda('size-tracking-lambda', LAMBDA_ENVIRONMENTS['size-tracking-lambda'])
+    messages = []
+    for i in range(BATCH_SIZE):
+        key = f'incoming/object-{i:04d}.bin'
+        aws.s3.add_object(BUCKET, key, 100 + i)
+        messages.append([s3_record('ObjectCreated:Put', BUCKET, key, 100 + i, time.time())])
+    return 'size-tracking-lambda', lambda: module.lambda_handler(sqs_batch(messages), None)
+
+def size_tracking_reconcile(aws: FakeAWS, objects: int, samples: int):
+    """
+    Bootstrap reconciliation: list the bucket and rebuild the object index.
+    """
+    seed_objects(aws, objects, indexed=False)
+    module = aws.load_lambda('size-tracking-lambda', LAMBDA_ENVIRONMENTS['size-tracking-lambda'])
+    return 'size-tracking-lambda', lambda: module.lambda_handler(
+        {'action': 'reconcile', 'bucketName': BUCKET}, None
+    )
+
+def size_tracking_compact(aws: FakeAWS, objects: int, samples: int):
+    """
+    Compact a history that ended two days ago and predates raw sample expiry.
+    """
+    seed_history(aws, samples, end=time.time() - 2 * 86400)
+    module = aws.load_lambda('size-tracking-lambda', LAMBDA_ENVIRONMENTS['size-tracking-lambda'])
+    return 'size-tracking-lambda', lambda: module.lambda_handler(
+        {'action': 'compact', 'bucketName': BUCKET}, None
+    )
+
+def size_tracking_full_mode(aws: FakeAWS, objects: int, samples: int):
+    """
+    The original behavior: every batch re-lists the whole bucket.
+    """
+    seed_objects(aws, objects, indexed=False)
+    module = aws.load_lambda('size-tracking-lambda',
+                             dict(LAMBDA_ENVIRONMENTS['size-tracking-lambda'], TRACKING_MODE='full'))
+    messages = [
+        [s3_record('ObjectCreated:Put', BUCKET, object_key(i), 100, time.time())]
+        for i in range(min(objects, BATCH_SIZE))
+    ]
+    return 'size-tracking-lambda', lambda: module.lambda_handler(sqs_batch(messages), None)
+
+def logging_event_batch(aws: FakeAWS, objects: int, samples: int):
+    """
+    Half creations, half removals of indexed objects, on a cold size cache.
+    """
+    seed_objects(aws, objects)
+    module = aws.load_lambda('logging-lambda', LAMBDA_ENVIRONMENTS['logging-lambda'])
+    index = aws.dynamodb.tables[OBJECT_INDEX_TABLE_NAME]
+    messages = []
+    for i in range(min(objects, BATCH_SIZE)):
+        key = object_key(i)
+        size = int(index.get({'bucketName': BUCKET, 'objectKey': key})['size'])
+        if i % 2:
+            index.put(dict(index.get({'bucketName': BUCKET, 'objectKey': key}), deleted_at=Decimal(1)))
+            messages.append([s3_record('ObjectRemoved:Delete', BUCKET, key)])
+        else:
+            messages.append([s3_record('ObjectCreated:Put', BUCKET, key, size, time.time())])
+    return 'logging-lambda', lambda: module.lambda_handler(sqs_batch(messages), None)
+
+def cleaner_scenario(policy: str, use_index: bool = True) -> Scenario:
+    def scenario(aws: FakeAWS, objects: int, samples: int):
+        total_size = seed_objects(aws, objects)
+        environment = dict(LAMBDA_ENVIRONMENTS['cleaner-lambda'], EVICTION_POLICY=policy)
+        if not use_index:
+            environment['OBJECT_INDEX_TABLE_NAME'] = ''
+        module = aws.load_lambda('cleaner-lambda', environment)
+        # Reclaim 1% of the bucket
+        event = {'target_size': total_size - total_size // 100}
+        return 'cleaner-lambda', lambda: module.lambda_handler(event, None)
+    scenario.__doc__ = (f'Evict 1% of the bucket, {policy} first'
+                        f'{"" if use_index else ", without the object index"}.')
+    return scenario
+
+def plotting_scenario(tier: str, cached: bool = False, shards: int = 1, packed: bool = False) -> Scenario:
+    def scenario(aws: FakeAWS, objects: int, samples: int):
+        start, end = seed_history(aws, samples, shards, packed=packed)
+        module = aws.load_lambda('plotting-lambda',
+                                 dict(LAMBDA_ENVIRONMENTS['plotting-lambda'], HISTORY_SHARDS=str(shards),
+                                      HISTORY_LAYOUT='packed' if packed else 'items'))
+        event = {'queryStringParameters': {'start': str(start - 1), 'end': str(end + 1), 'tier': tier}}
+        if cached:
+            with aws.logs.capture('/aws/lambda/plotting-lambda'):
+                module.lambda_handler(event, None)
+        return 'plotting-lambda', lambda: module.lambda_handler(event, None)
+    scenario.__doc__ = (f'Plot the whole history ({tier} tier{", cache hit" if cached else ""}'
+                        f'{f", {shards} shards" if shards > 1 else ""}{", packed" if packed else ""}).')
+    return scenario
+
+def query_scenario(output: str) -> Scenario:
+    def scenario(aws: FakeAWS, objects: int, samples: int):
+        start, end = seed_history(aws, samples)
+        module = aws.load_lambda('plotting-lambda', LAMBDA_ENVIRONMENTS['plotting-lambda'])
+        event = {'resource': '/query',
+                 'queryStringParameters': {'start': str(start - 1), 'end': str(end + 1), 'format': output}}
+        return 'plotting-lambda', lambda: module.lambda_handler(event, None)
+    scenario.__doc__ = f'Query the first page of the raw history with aggregates, as {output}.'
+    return scenario
+
+# name -> (scenario, whether it scales with the object count)
+SCENARIOS: Dict[str, Tuple[Scenario, bool]] = {
+    'size-tracking/event-batch': (size_tracking_event_batch, True),
+    'size-tracking/reconcile': (size_tracking_reconcile, True),
+    'size-tracking/full-mode': (size_tracking_full_mode, True),
+    'size-tracking/compact': (size_tracking_compact, False),
+    'logging/event-batch': (logging_event_batch, True),
+    'cleaner/largest': (cleaner_scenario('largest'), True),
+    'cleaner/oldest': (cleaner_scenario('oldest'), True),
+    'cleaner/lru': (cleaner_scenario('lru'), True),
+    'cleaner/largest-listing': (cleaner_scenario('largest', use_index=False), True),
+    'plotting/raw': (plotting_scenario('raw'), False),
+    'plotting/raw-sharded': (plotting_scenario('raw', shards=4), False),
+    'plotting/raw-packed': (plotting_scenario('raw', packed=True), False),
+    'plotting/auto-tier': (plotting_scenario('auto'), False),
+    'plotting/cache-hit': (plotting_scenario('auto', cached=True), False),
+    'plotting/query-json': (query_scenario('json'), False),
+    'plotting/query-csv': (query_scenario('csv'), False),
+}
+
+# ============================================================================
+# Runner
+# ============================================================================
+
+def invoke(scenario: Scenario, objects: int, samples: int, trace_memory: bool,
+           s3_latency: float = 0.0,
+           dynamodb_latency: float = 0.0) -> Tuple[FakeAWS, str, Dict[str, Any], float, Optional[int]]:
+    """
+    Seed a fresh account and time one invocation of the scenario's handler,
+    with the given seconds added to every S3 and DynamoDB call it makes.
+    Returns (aws, lambda name, response, seconds, peak traced bytes).
+    """
+    aws = new_account()
+    name, call = scenario(aws, objects, samples)
+    aws.api_calls.clear()
+    aws.s3.latency = s3_latency
+    aws.dynamodb.latency = dynamodb_latency
+    gc.collect()
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with aws.logs.capture(f'/aws/lambda/{name}'):
+            started = time.perf_counter()
+            response = call()
+            elapsed = time.perf_counter() - started
+    finally:
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return aws, name, response, elapsed, peak
+
+def run_scenario(name: str, objects: int, samples: int, measure_memory: bool,
+                 s3_latency: float = 0.0, dynamodb_latency: float = 0.0) -> Dict[str, Any]:
+    """
+    Wall time and API calls come from an untraced run; peak memory from a
+    second, traced run on a fresh account, since tracing slows Python down.
+    """
+    scenario, _ = SCENARIOS[name]
+    aws, lambda_name, response, elapsed, _ = invoke(scenario, objects, samples, False, s3_latency, dynamodb_latency)
+    peak = None
+    if measure_memory:
+        peak = invoke(scenario, objects, samples, trace_memory=True)[4]
+
+    return {
+        'scenario': name,
+        'objects': objects,
+        'samples': samples,
+        'status': response.get('statusCode'),
+        'wall_ms': round(elapsed * 1000, 2),
+        'peak_memory_mib': round(peak / 2 ** 20, 2) if peak is not None else None,
+        'api_calls': sum(aws.api_calls.values()),
+        'api_calls_by_operation': dict(sorted(aws.api_calls.items())),
+        'log_kib': round(aws.logs.bytes_logged(f'/aws/lambda/{lambda_name}') / 1024, 1)
+    }
+
+def format_table(results: List[Dict[str, Any]]) -> str:
+    lines = [f'{"scenario":<28} {"objects":>9} {"samples":>9} {"status":>6} {"wall ms":>10} '
+             f'{"peak MiB":>9} {"calls":>7} {"log KiB":>8}  calls by operation']
+    for result in results:
+        peak = result['peak_memory_mib']
+        calls = ' '.join(f'{op}={count}' for op, count in result['api_calls_by_operation'].items())
+        lines.append(
+            f'{result["scenario"]:<28} {result["objects"] or "-":>9} {result["samples"] or "-":>9} '
+            f'{result["status"]:>6} {result["wall_ms"]:>10.2f} {"-" if peak is None else f"{peak:.2f}":>9} '
+            f'{result["api_calls"]:>7} {result["log_kib"]:>8.1f}  {calls}'
+        )
+    return '\n'.join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m offline.bench', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--objects', default=DEFAULT_OBJECTS,
+                        help=f'comma-separated bucket sizes (default: {DEFAULT_OBJECTS})')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help=f'history samples for the plotting scenarios (default: {DEFAULT_SAMPLES})')
+    parser.add_argument('--only', default='',
+                        help='comma-separated scenario name substrings to run')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the traced run that measures peak memory')
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0,
+                        help='round-trip time added to every S3 call (default: 0)')
+    parser.add_argument('--dynamodb-latency-ms', type=float, default=0.0,
+                        help='round-trip time added to every DynamoDB call (default: 0)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    args = parser.parse_args(argv)
+
+    object_counts = [int(count) for count in args.objects.split(',') if count]
+    filters = [name for name in args.only.split(',') if name]
+    names = [name for name in SCENARIOS if not filters or any(f in name for f in filters)]
+    if not names:
+        parser.error(f'no scenario matches --only {args.only}; available: {", ".join(SCENARIOS)}')
+
+    results = []
+    for name in names:
+        _, scales_with_objects = SCENARIOS[name]
+        runs = [(objects, 0) for objects in object_counts] if scales_with_objects else [(0, args.samples)]
+        for objects, samples in runs:
+            result = run_scenario(name, objects, samples, not args.no_memory,
+                                  args.s3_latency_ms / 1000, args.dynamodb_latency_ms / 1000)
+            results.append(result)
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print(f'{name} objects={objects or "-"} samples={samples or "-"}: '
+                      f'{result["wall_ms"]:.2f} ms', file=sys.stderr, flush=True)
+
+    if not args.json:
+        print(format_table(results))
+    return 0 if all(result['status'] == 200 for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
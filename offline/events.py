@@ -0,0 +1,53 @@
+"""
+Builders for the events the lambdas receive: S3 notification records and
+the SQS batches that carry them (S3 -> SNS -> SQS).
+"""
+import json
+import urllib.parse
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+def s3_record(event_name: str, bucket: str, key: str, size: int = 0,
+              event_time: Optional[float] = None, sequencer: str = '') -> Dict[str, Any]:
+    """
+    One S3 notification record. Keys are URL-encoded as S3 sends them.
+    """
+    record: Dict[str, Any] = {
+        'eventVersion': '2.1',
+        'eventSource': 'aws:s3',
+        'eventName': event_name,
+        's3': {
+            'bucket': {'name': bucket, 'arn': f'arn:aws:s3:::{bucket}'},
+            'object': {'key': urllib.parse.quote_plus(key, safe='/'), 'sequencer': sequencer}
+        }
+    }
+    if event_name.startswith('ObjectCreated'):
+        record['s3']['object']['size'] = size
+    if event_time is not None:
+        timestamp = datetime.fromtimestamp(event_time, tz=timezone.utc)
+        record['eventTime'] = timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + f'{timestamp.microsecond // 1000:03d}Z'
+    return record
+
+def sns_envelope(records: List[Dict[str, Any]]) -> str:
+    """
+    SQS message body for an S3 event delivered through an SNS subscription.
+    """
+    return json.dumps({
+        'Type': 'Notification',
+        'Message': json.dumps({'Records': records})
+    })
+
+def sqs_batch(messages: List[List[Dict[str, Any]]], first_id: int = 0) -> Dict[str, Any]:
+    """
+    An SQS event source batch with one message per list of S3 records.
+    """
+    return {
+        'Records': [
+            {
+                'messageId': f'message-{first_id + i}',
+                'eventSource': 'aws:sqs',
+                'body': sns_envelope(records)
+            }
+            for i, records in enumerate(messages)
+        ]
+    }
@@ -0,0 +1,1328 @@
+"""
+In-process fakes of the AWS services the lambdas talk to (S3, DynamoDB,
+CloudWatch Logs, CloudWatch metrics and Lambda), so handlers can be benchmarked and simulated without AWS.
+
+Only the API surface the handlers use is implemented, with boto3's request
+and response shapes, DynamoDB's 1 MB query pages, S3's 1000-key listing
+pages and the same error codes. Every API call is counted in
+FakeAWS.api_calls as '<service>:<Operation>'.
+"""
+import bisect
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import re
+import sys
+import time
+import types
+from collections import Counter
+from datetime import datetime, timezone
+from decimal import Decimal
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+LAMBDA_DIR = Path(__file__).resolve().parent.parent / 'lambda'
+# Layers shared by the functions, importable from their python/ directories
+LAYER_DIRS = sorted((LAMBDA_DIR / 'layers').glob('*/python'))
+
+# DynamoDB stops reading a query page at 1 MB of items
+QUERY_PAGE_BYTES = 1024 * 1024
+# BatchWriteItem accepts at most 25 requests
+BATCH_WRITE_SIZE = 25
+# ListObjectsV2 returns at most 1000 keys per page
+LIST_PAGE_SIZE = 1000
+
+class Top:
+    """
+    Sorts after every other value; pads tuples for inclusive upper bounds.
+    """
+
+    def __lt__(self, other: Any) -> bool:
+        return False
+
+    def __gt__(self, other: Any) -> bool:
+        return True
+
+TOP = Top()
+
+class ClientError(Exception):
+    """
+    Mirrors botocore's ClientError: the error code is in response['Error']['Code'].
+    """
+    code = 'ClientError'
+
+    def __init__(self, message: str, operation_name: str = '', code: Optional[str] = None):
+        super().__init__(f'An error occurred ({code or self.code}) when calling the '
+                         f'{operation_name} operation: {message}')
+        self.response = {'Error': {'Code': code or self.code, 'Message': message}}
+        self.operation_name = operation_name
+
+class ConditionalCheckFailedException(ClientError):
+    code = 'ConditionalCheckFailedException'
+
+class ResourceNotFoundException(ClientError):
+    code = 'ResourceNotFoundException'
+
+class ValidationException(ClientError):
+    code = 'ValidationException'
+
+class TransactionCanceledException(ClientError):
+    """
+    Carries one {'Code': ...} per action in response['CancellationReasons'],
+    'None' for the actions that did not cancel the transaction.
+    """
+    code = 'TransactionCanceledException'
+
+    def __init__(self, reasons: List[str], operation_name: str = 'TransactWriteItems'):
+        super().__init__('Transaction cancelled, please refer cancellation reasons for specific reasons '
+                         f'[{", ".join(reasons)}]', operation_name)
+        self.response['CancellationReasons'] = [{'Code': reason} for reason in reasons]
+
+class NoSuchKey(ClientError):
+    code = 'NoSuchKey'
+
+class NoSuchBucket(ClientError):
+    code = 'NoSuchBucket'
+
+def exceptions_namespace(*classes: type) -> types.SimpleNamespace:
+    """
+    The client.exceptions attribute: ClientError plus the service's error classes.
+    """
+    return types.SimpleNamespace(ClientError=ClientError, **{cls.__name__: cls for cls in classes})
+
+class FakeEvents:
+    """
+    client.meta.events: handlers registered for 'before-call' (or a narrower
+    'before-call.<service>[.<Operation>]') are called before every API call,
+    as botocore calls them, with the event name as a keyword argument.
+    """
+
+    def __init__(self):
+        self.handlers: List[Tuple[str, Callable[..., Any]]] = []
+
+    def register(self, event_name: str, handler: Callable[..., Any], unique_id: Optional[str] = None) -> None:
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name: str, **kwargs) -> None:
+        for prefix, handler in self.handlers:
+            if event_name == prefix or event_name.startswith(prefix + '.'):
+                handler(event_name=event_name, **kwargs)
+
+# ============================================================================
+# DynamoDB expressions
+# ============================================================================
+
+TOKEN_PATTERN = re.compile(
+    r'\s*(?:(?P<number>\d+)|(?P<name>#?[A-Za-z_][A-Za-z0-9_]*)'
+    r'|(?P<value>:[A-Za-z0-9_]+)|(?P<op><>|<=|>=|[=<>(),+\-]))'
+)
+KEYWORDS = {'AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'SET', 'ADD', 'REMOVE', 'DELETE'}
+
+def tokenize(expression: str) -> List[str]:
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if not match:
+            raise ValidationException(f'Invalid expression near: {expression[position:]!r}')
+        token = match.group(match.lastgroup)
+        tokens.append(token.upper() if token.upper() in KEYWORDS else token)
+        position = match.end()
+    return tokens
+
+class ExpressionParser:
+    """
+    Recursive-descent parser producing a tuple AST:
+    ('or'|'and', a, b), ('not', a), ('cmp', op, a, b), ('between', a, lo, hi),
+    ('in', a, [..]), ('func', name, [args]), ('arith', op, a, b),
+    ('path', name) and ('value', placeholder).
+    """
+
+    def __init__(self, expression: str):
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValidationException(f'Expected {expected or "a token"}, got {token!r}')
+        self.position += 1
+        return token
+
+    def done(self) -> None:
+        if self.peek() is not None:
+            raise ValidationException(f'Unexpected token {self.peek()!r}')
+
+    def condition(self) -> tuple:
+        node = self.conjunction()
+        while self.peek() == 'OR':
+            self.take()
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self) -> tuple:
+        node = self.negation()
+        while self.peek() == 'AND':
+            self.take()
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self) -> tuple:
+        if self.peek() == 'NOT':
+            self.take()
+            return ('not', self.negation())
+        return self.comparison()
+
+    def comparison(self) -> tuple:
+        if self.peek() == '(':
+            self.take()
+            node = self.condition()
+            self.take(')')
+            return node
+
+        left = self.operand()
+        token = self.peek()
+        if token in ('=', '<>', '<', '<=', '>', '>='):
+            self.take()
+            return ('cmp', token, left, self.operand())
+        if token == 'BETWEEN':
+            self.take()
+            low = self.operand()
+            self.take('AND')
+            return ('between', left, low, self.operand())
+        if token == 'IN':
+            self.take()
+            self.take('(')
+            options = [self.operand()]
+            while self.peek() == ',':
+                self.take()
+                options.append(self.operand())
+            self.take(')')
+            return ('in', left, options)
+        if left[0] == 'func':
+            return left
+        raise ValidationException(f'Expected a comparison, got {token!r}')
+
+    def operand(self) -> tuple:
+        token = self.take()
+        if token.startswith(':'):
+            return ('value', token)
+        if self.peek() == '(':
+            self.take()
+            args = [self.operand()]
+            while self.peek() == ',':
+                self.take()
+                args.append(self.operand())
+            self.take(')')
+            return ('func', token, args)
+        return ('path', token)
+
+    def value_expression(self) -> tuple:
+        node = self.operand()
+        if self.peek() in ('+', '-'):
+            op = self.take()
+            return ('arith', op, node, self.operand())
+        return node
+
+    def update(self) -> Dict[str, list]:
+        clauses: Dict[str, list] = {'SET': [], 'ADD': [], 'REMOVE': [], 'DELETE': []}
+        while self.peek() is not None:
+            clause = self.take()
+            if clause not in clauses:
+                raise ValidationException(f'Unknown update clause {clause!r}')
+            while True:
+                path = self.operand()
+                if clause == 'SET':
+                    self.take('=')
+                    clauses[clause].append((path, self.value_expression()))
+                elif clause == 'REMOVE':
+                    clauses[clause].append((path, None))
+                else:
+                    clauses[clause].append((path, self.operand()))
+                if self.peek() != ',':
+                    break
+                self.take()
+        return clauses
+
+@lru_cache(maxsize=None)
+def parse_condition(expression: str) -> tuple:
+    parser = ExpressionParser(expression)
+    node = parser.condition()
+    parser.done()
+    return node
+
+@lru_cache(maxsize=None)
+def parse_update(expression: str) -> Dict[str, list]:
+    return ExpressionParser(expression).update()
+
+@lru_cache(maxsize=None)
+def parse_projection(expression: str) -> Tuple[str, ...]:
+    return tuple(name.strip() for name in expression.split(','))
+
+def resolve_name(token: str, names: Dict[str, str]) -> str:
+    if token.startswith('#'):
+        if token not in names:
+            raise ValidationException(f'Undefined attribute name placeholder {token}')
+        return names[token]
+    return token
+
+def evaluate(node: tuple, item: Dict[str, Any], names: Dict[str, str], values: Dict[str, Any]) -> Any:
+    """
+    Evaluate an operand or condition AST against an item.
+    Missing attributes evaluate to None; comparisons involving them are false.
+    """
+    kind = node[0]
+
+    if kind == 'path':
+        return item.get(resolve_name(node[1], names))
+    if kind == 'value':
+        if node[1] not in values:
+            raise ValidationException(f'Undefined attribute value placeholder {node[1]}')
+        return values[node[1]]
+    if kind == 'and':
+        return evaluate(node[1], item, names, values) and evaluate(node[2], item, names, values)
+    if kind == 'or':
+        return evaluate(node[1], item, names, values) or evaluate(node[2], item, names, values)
+    if kind == 'not':
+        return not evaluate(node[1], item, names, values)
+    if kind == 'cmp':
+        left = evaluate(node[2], item, names, values)
+        right = evaluate(node[3], item, names, values)
+        if left is None or right is None:
+            return False
+        if node[1] == '=':
+            return left == right
+        if node[1] == '<>':
+            return left != right
+        if type(left) is not type(right):
+            return False
+        return {'<': left < right, '<=': left <= right,
+                '>': left > right, '>=': left >= right}[node[1]]
+    if kind == 'between':
+        target = evaluate(node[1], item, names, values)
+        low = evaluate(node[2], item, names, values)
+        high = evaluate(node[3], item, names, values)
+        return target is not None and type(target) is type(low) and low <= target <= high
+    if kind == 'in':
+        target = evaluate(node[1], item, names, values)
+        return target is not None and any(target == evaluate(option, item, names, values) for option in node[2])
+    if kind == 'arith':
+        left = evaluate(node[2], item, names, values)
+        right = evaluate(node[3], item, names, values)
+        if not isinstance(left, Decimal) or not isinstance(right, Decimal):
+            raise ValidationException('An operand in the update expression has an incorrect data type')
+        return left + right if node[1] == '+' else left - right
+    if kind == 'func':
+        name, args = node[1], node[2]
+        if name == 'attribute_exists':
+            return resolve_name(args[0][1], names) in item
+        if name == 'attribute_not_exists':
+            return resolve_name(args[0][1], names) not in item
+        if name == 'begins_with':
+            target = evaluate(args[0], item, names, values)
+            prefix = evaluate(args[1], item, names, values)
+            return isinstance(target, str) and target.startswith(prefix)
+        if name == 'if_not_exists':
+            current = evaluate(args[0], item, names, values)
+            return current if current is not None else evaluate(args[1], item, names, values)
+        if name == 'size':
+            target = evaluate(args[0], item, names, values)
+            return None if target is None else Decimal(len(target))
+        raise ValidationException(f'Unknown function {name}')
+
+    raise ValidationException(f'Cannot evaluate {node!r}')
+
+def to_dynamodb(value: Any) -> Any:
+    """
+    Convert a Python value the way boto3's serializer would accept it:
+    ints become Decimal, floats are rejected.
+    """
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        return {k: to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_dynamodb(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {to_dynamodb(v) for v in value}
+    raise TypeError(f'Unsupported type {type(value).__name__}')
+
+def item_size(item: Dict[str, Any]) -> int:
+    """
+    Approximate DynamoDB item size: attribute names plus value sizes.
+    """
+    size = 0
+    for name, value in item.items():
+        size += len(name)
+        if isinstance(value, Decimal):
+            size += len(str(value)) // 2 + 1
+        elif isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += len(str(value))
+    return size
+
+def project(item: Dict[str, Any], projection: Optional[str], names: Dict[str, str]) -> Dict[str, Any]:
+    if not projection:
+        return dict(item)
+    result = {}
+    for token in parse_projection(projection):
+        name = resolve_name(token, names)
+        if name in item:
+            result[name] = item[name]
+    return result
+
+# ============================================================================
+# DynamoDB
+# ============================================================================
+
+class FakeTable:
+    """
+    A table with a hash key, an optional range key, optional GSIs and TTL.
+    Range keys are kept sorted per partition, so queries cost O(log n + page).
+    """
+
+    def __init__(self, name: str, hash_key: str, range_key: Optional[str] = None,
+                 indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                 ttl_attribute: Optional[str] = None):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.ttl_attribute = ttl_attribute
+        # hash value -> {range value -> item} and the sorted (range value,) tuples
+        self.items: Dict[Any, Dict[Any, Dict[str, Any]]] = {}
+        self.sorted_keys: Dict[Any, List[tuple]] = {}
+        # (hash value, range value) -> approximate item size, for query paging
+        self.sizes: Dict[Tuple[Any, Any], int] = {}
+        # index name -> (hash attribute, range attribute)
+        self.indexes = dict(indexes or {})
+        # index name -> index hash value -> {(index range, table hash, table range)},
+        # sorted lazily on the next query since index keys arrive in random order
+        self.index_entries: Dict[str, Dict[Any, set]] = {name: {} for name in self.indexes}
+        self.index_sorted: Dict[str, Dict[Any, List[tuple]]] = {name: {} for name in self.indexes}
+
+    def __len__(self) -> int:
+        return sum(len(partition) for partition in self.items.values())
+
+    def key_of(self, item: Dict[str, Any]) -> Tuple[Any, Any]:
+        try:
+            return item[self.hash_key], item[self.range_key] if self.range_key else None
+        except KeyError:
+            raise ValidationException('The provided key element does not match the schema')
+
+    def get(self, key: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        hash_value, range_value = self.key_of(to_dynamodb(key))
+        return self.items.get(hash_value, {}).get(range_value)
+
+    def index_entry(self, index_name: str, item: Dict[str, Any]) -> Optional[Tuple[Any, tuple]]:
+        hash_attribute, range_attribute = self.indexes[index_name]
+        if hash_attribute not in item or range_attribute not in item:
+            return None  # Sparse: items without the index keys are not indexed
+        return item[hash_attribute], (item[range_attribute], *self.key_of(item))
+
+    def store(self, item: Optional[Dict[str, Any]], old: Optional[Dict[str, Any]],
+              key: Tuple[Any, Any]) -> None:
+        """
+        Replace old with item (None deletes), keeping the sort orders and GSIs current.
+        """
+        hash_value, range_value = key
+        partition = self.items.setdefault(hash_value, {})
+        keys = self.sorted_keys.setdefault(hash_value, [])
+
+        if item is None:
+            if old is not None:
+                del partition[range_value]
+                del keys[bisect.bisect_left(keys, (range_value,))]
+                del self.sizes[key]
+        else:
+            if old is None:
+                bisect.insort(keys, (range_value,))
+            partition[range_value] = item
+            self.sizes[key] = item_size(item)
+
+        for index_name, entries in self.index_entries.items():
+            old_entry = self.index_entry(index_name, old) if old else None
+            new_entry = self.index_entry(index_name, item) if item else None
+            if old_entry == new_entry:
+                continue
+            if old_entry:
+                entries[old_entry[0]].discard(old_entry[1])
+                self.index_sorted[index_name].pop(old_entry[0], None)
+            if new_entry:
+                entries.setdefault(new_entry[0], set()).add(new_entry[1])
+                self.index_sorted[index_name].pop(new_entry[0], None)
+
+    def index_positions(self, index_name: str, hash_value: Any) -> List[tuple]:
+        """
+        The index partition's entries in sort order.
+        """
+        cache = self.index_sorted[index_name]
+        if hash_value not in cache:
+            cache[hash_value] = sorted(self.index_entries[index_name].get(hash_value, ()))
+        return cache[hash_value]
+
+    def put(self, item: Dict[str, Any]) -> None:
+        """
+        Write an item directly, bypassing the API (seeding, not counted).
+        """
+        item = to_dynamodb(item)
+        key = self.key_of(item)
+        self.store(item, self.items.get(key[0], {}).get(key[1]), key)
+
+    def load(self, items: Iterator[Dict[str, Any]]) -> None:
+        """
+        Bulk-load items directly (seeding, not counted), sorting each
+        partition and index once instead of per item.
+        """
+        for item in items:
+            item = to_dynamodb(item)
+            hash_value, range_value = self.key_of(item)
+            self.items.setdefault(hash_value, {})[range_value] = item
+            self.sizes[(hash_value, range_value)] = item_size(item)
+
+        self.sorted_keys = {
+            hash_value: sorted((range_value,) for range_value in partition)
+            for hash_value, partition in self.items.items()
+        }
+        for index_name in self.indexes:
+            entries: Dict[Any, set] = {}
+            for partition in self.items.values():
+                for item in partition.values():
+                    entry = self.index_entry(index_name, item)
+                    if entry:
+                        entries.setdefault(entry[0], set()).add(entry[1])
+            self.index_entries[index_name] = entries
+            self.index_sorted[index_name] = {
+                hash_value: sorted(index_keys) for hash_value, index_keys in entries.items()
+            }
+
+    def expire(self, now: float) -> int:
+        """
+        Delete items whose TTL attribute is in the past, like DynamoDB TTL.
+        Returns the number of expired items.
+        """
+        if not self.ttl_attribute:
+            return 0
+        expired = [
+            item for partition in self.items.values() for item in partition.values()
+            if isinstance(item.get(self.ttl_attribute), Decimal) and item[self.ttl_attribute] < now
+        ]
+        for item in expired:
+            self.store(None, item, self.key_of(item))
+        return len(expired)
+
+class FakeBatchWriter:
+    """
+    Table.batch_writer(): buffers writes and flushes them 25 at a time.
+    """
+
+    def __init__(self, table: 'FakeTableResource'):
+        self.table = table
+        self.buffer: List[Tuple[str, Dict[str, Any]]] = []
+
+    def put_item(self, Item: Dict[str, Any]) -> None:
+        self.buffer.append(('put', Item))
+        if len(self.buffer) >= BATCH_WRITE_SIZE:
+            self.flush()
+
+    def delete_item(self, Key: Dict[str, Any]) -> None:
+        self.buffer.append(('delete', Key))
+        if len(self.buffer) >= BATCH_WRITE_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        self.table.service.record('BatchWriteItem')
+        table = self.table.backing()
+        for action, payload in self.buffer:
+            payload = to_dynamodb(payload)
+            key = table.key_of(payload)
+            old = table.items.get(key[0], {}).get(key[1])
+            table.store(payload if action == 'put' else None, old, key)
+        self.buffer = []
+
+    def __enter__(self) -> 'FakeBatchWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+def apply_update(current: Dict[str, Any], key_item: Dict[str, Any], clauses: Dict[str, list],
+                 names: Dict[str, str], values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The item an UpdateExpression's clauses make of current. Every
+    right-hand side sees the item as it was before the update.
+    """
+    item = dict(current, **key_item)
+    for path, value in clauses['SET']:
+        item[resolve_name(path[1], names)] = evaluate(value, current, names, values)
+    for path, _ in clauses['REMOVE']:
+        item.pop(resolve_name(path[1], names), None)
+    for path, value in clauses['ADD']:
+        name = resolve_name(path[1], names)
+        increment = evaluate(value, current, names, values)
+        if isinstance(increment, set):
+            item[name] = set(current.get(name, set())) | increment
+        else:
+            item[name] = current.get(name, Decimal(0)) + increment
+    for path, value in clauses['DELETE']:
+        name = resolve_name(path[1], names)
+        item[name] = set(current.get(name, set())) - evaluate(value, current, names, values)
+    return item
+
+class FakeTableResource:
+    """
+    dynamodb.Table(name): the boto3 resource API on top of a FakeTable.
+    """
+
+    def __init__(self, service: 'FakeDynamoDB', name: str):
+        self.service = service
+        self.name = name
+
+    def backing(self, operation: str = '') -> FakeTable:
+        if self.name not in self.service.tables:
+            raise ResourceNotFoundException(f'Requested resource not found: Table: {self.name} not found',
+                                            operation)
+        return self.service.tables[self.name]
+
+    def check_condition(self, item: Optional[Dict[str, Any]], condition: Optional[str],
+                        names: Dict[str, str], values: Dict[str, Any], operation: str) -> None:
+        if condition and not evaluate(parse_condition(condition), item or {}, names, values):
+            raise ConditionalCheckFailedException('The conditional request failed', operation)
+
+    def get_item(self, Key: Dict[str, Any], ProjectionExpression: Optional[str] = None,
+                 ExpressionAttributeNames: Optional[Dict[str, str]] = None,
+                 ConsistentRead: bool = False) -> Dict[str, Any]:
+        self.service.record('GetItem')
+        item = self.backing('GetItem').get(Key)
+        if item is None:
+            return {}
+        return {'Item': project(item, ProjectionExpression, ExpressionAttributeNames or {})}
+
+    def put_item(self, Item: Dict[str, Any], ConditionExpression: Optional[str] = None,
+                 ExpressionAttributeNames: Optional[Dict[str, str]] = None,
+                 ExpressionAttributeValues: Optional[Dict[str, Any]] = None,
+                 ReturnValues: str = 'NONE') -> Dict[str, Any]:
+        self.service.record('PutItem')
+        table = self.backing('PutItem')
+        item = to_dynamodb(Item)
+        key = table.key_of(item)
+        old = table.items.get(key[0], {}).get(key[1])
+        self.check_condition(old, ConditionExpression, ExpressionAttributeNames or {},
+                             to_dynamodb(ExpressionAttributeValues or {}), 'PutItem')
+        table.store(item, old, key)
+        return {'Attributes': dict(old)} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def delete_item(self, Key: Dict[str, Any], ConditionExpression: Optional[str] = None,
+                    ExpressionAttributeNames: Optional[Dict[str, str]] = None,
+                    ExpressionAttributeValues: Optional[Dict[str, Any]] = None,
+                    ReturnValues: str = 'NONE') -> Dict[str, Any]:
+        self.service.record('DeleteItem')
+        table = self.backing('DeleteItem')
+        key = table.key_of(to_dynamodb(Key))
+        old = table.items.get(key[0], {}).get(key[1])
+        self.check_condition(old, ConditionExpression, ExpressionAttributeNames or {},
+                             to_dynamodb(ExpressionAttributeValues or {}), 'DeleteItem')
+        table.store(None, old, key)
+        return {'Attributes': dict(old)} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def update_item(self, Key: Dict[str, Any], UpdateExpression: str,
+                    ConditionExpression: Optional[str] = None,
+                    ExpressionAttributeNames: Optional[Dict[str, str]] = None,
+                    ExpressionAttributeValues: Optional[Dict[str, Any]] = None,
+                    ReturnValues: str = 'NONE') -> Dict[str, Any]:
+        self.service.record('UpdateItem')
+        table = self.backing('UpdateItem')
+        key_item = to_dynamodb(Key)
+        key = table.key_of(key_item)
+        names = ExpressionAttributeNames or {}
+        values = to_dynamodb(ExpressionAttributeValues or {})
+        old = table.items.get(key[0], {}).get(key[1])
+        self.check_condition(old, ConditionExpression, names, values, 'UpdateItem')
+
+        current = old or {}
+        clauses = parse_update(UpdateExpression)
+        item = apply_update(current, key_item, clauses, names, values)
+        table.store(item, old, key)
+
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': dict(item)}
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': dict(old)} if old else {}
+        if ReturnValues in ('UPDATED_NEW', 'UPDATED_OLD'):
+            source = item if ReturnValues == 'UPDATED_NEW' else current
+            updated = {resolve_name(path[1], names) for clause in clauses.values() for path, _ in clause}
+            return {'Attributes': {name: source[name] for name in updated if name in source}}
+        return {}
+
+    def query(self, KeyConditionExpression: str, IndexName: Optional[str] = None,
+              FilterExpression: Optional[str] = None, ProjectionExpression: Optional[str] = None,
+              ExpressionAttributeNames: Optional[Dict[str, str]] = None,
+              ExpressionAttributeValues: Optional[Dict[str, Any]] = None,
+              ScanIndexForward: bool = True, Limit: Optional[int] = None,
+              ExclusiveStartKey: Optional[Dict[str, Any]] = None,
+              ConsistentRead: bool = False, Select: Optional[str] = None) -> Dict[str, Any]:
+        self.service.record('Query')
+        table = self.backing('Query')
+        names = ExpressionAttributeNames or {}
+        values = to_dynamodb(ExpressionAttributeValues or {})
+
+        if IndexName is not None:
+            if IndexName not in table.indexes:
+                raise ValidationException(f'The table does not have the specified index: {IndexName}', 'Query')
+            hash_attribute, range_attribute = table.indexes[IndexName]
+        else:
+            hash_attribute, range_attribute = table.hash_key, table.range_key
+
+        hash_value, range_node = self.split_key_condition(
+            parse_condition(KeyConditionExpression), hash_attribute, range_attribute, names, values
+        )
+
+        # Sorted positions of the partition, as (range value, ...) tuples
+        if IndexName is not None:
+            positions = table.index_positions(IndexName, hash_value)
+            def key_at(position):
+                return position[1], position[2]
+            def position_of(key):
+                key = to_dynamodb(key)
+                return (key[range_attribute], *table.key_of(key))
+        else:
+            positions = table.sorted_keys.get(hash_value, [])
+            def key_at(position):
+                return hash_value, position[0]
+            def position_of(key):
+                return (to_dynamodb(key)[range_attribute],)
+
+        low, high = 0, len(positions)
+        if range_node is not None:
+            low, high = self.range_bounds(positions, range_node, names, values)
+
+        if ExclusiveStartKey is not None:
+            start = position_of(ExclusiveStartKey)
+            if ScanIndexForward:
+                low = max(low, bisect.bisect_right(positions, start))
+            else:
+                high = min(high, bisect.bisect_left(positions, start))
+
+        order = range(low, high) if ScanIndexForward else range(high - 1, low - 1, -1)
+        filter_node = parse_condition(FilterExpression) if FilterExpression else None
+
+        items = []
+        scanned = 0
+        page_bytes = 0
+        last_position = None
+        for i in order:
+            key = key_at(positions[i])
+            item = table.items[key[0]][key[1]]
+            scanned += 1
+            page_bytes += table.sizes[key]
+            last_position = positions[i]
+            if filter_node is None or evaluate(filter_node, item, names, values):
+                items.append(project(item, ProjectionExpression, names))
+            if (Limit is not None and scanned >= Limit) or page_bytes >= QUERY_PAGE_BYTES:
+                break
+        else:
+            last_position = None
+
+        response: Dict[str, Any] = {'Items': items, 'Count': len(items), 'ScannedCount': scanned}
+        if Select == 'COUNT':
+            del response['Items']
+        if last_position is not None:
+            last_key = key_at(last_position)
+            last_item = table.items[last_key[0]][last_key[1]]
+            key_attributes = {table.hash_key, hash_attribute, range_attribute}
+            if table.range_key:
+                key_attributes.add(table.range_key)
+            response['LastEvaluatedKey'] = {name: last_item[name] for name in key_attributes}
+        return response
+
+    @staticmethod
+    def split_key_condition(node: tuple, hash_attribute: str, range_attribute: Optional[str],
+                            names: Dict[str, str], values: Dict[str, Any]) -> Tuple[Any, Optional[tuple]]:
+        """
+        Split a key condition into the partition value and the optional range condition.
+        """
+        conditions = []
+        while node[0] == 'and':
+            conditions.append(node[2])
+            node = node[1]
+        conditions.append(node)
+
+        hash_value, range_node = None, None
+        for condition in conditions:
+            if (condition[0] == 'cmp' and condition[1] == '=' and condition[2][0] == 'path'
+                    and resolve_name(condition[2][1], names) == hash_attribute):
+                hash_value = evaluate(condition[3], {}, names, values)
+            elif range_node is None:
+                range_node = condition
+            else:
+                raise ValidationException('Invalid KeyConditionExpression', 'Query')
+        if hash_value is None:
+            raise ValidationException('Query condition missed key schema element', 'Query')
+        return hash_value, range_node
+
+    @staticmethod
+    def range_bounds(positions: List[tuple], node: tuple, names: Dict[str, str],
+                     values: Dict[str, Any]) -> Tuple[int, int]:
+        """
+        [low, high) slice of the sorted positions that satisfies a range key condition.
+        """
+        if node[0] == 'between':
+            low_value = evaluate(node[2], {}, names, values)
+            high_value = evaluate(node[3], {}, names, values)
+            return (bisect.bisect_left(positions, (low_value,)),
+                    bisect.bisect_right(positions, (high_value, TOP)))
+        if node[0] == 'func' and node[1] == 'begins_with':
+            prefix = evaluate(node[2][1], {}, names, values)
+            return (bisect.bisect_left(positions, (prefix,)),
+                    bisect.bisect_left(positions, (prefix + chr(0x10FFFF),)))
+        if node[0] == 'cmp':
+            value = evaluate(node[3], {}, names, values)
+            first = bisect.bisect_left(positions, (value,))
+            after = bisect.bisect_right(positions, (value, TOP))
+            return {
+                '=': (first, after),
+                '<': (0, first),
+                '<=': (0, after),
+                '>': (after, len(positions)),
+                '>=': (first, len(positions)),
+            }[node[1]]
+        raise ValidationException('Invalid range key condition', 'Query')
+
+    def batch_writer(self) -> FakeBatchWriter:
+        return FakeBatchWriter(self)
+
+class FakeDynamoDB:
+    """
+    The DynamoDB service: tables by name, exposed through resource() as
+    boto3's DynamoDB service resource.
+    """
+
+    def __init__(self, calls: Counter):
+        self.calls = calls
+        self.tables: Dict[str, FakeTable] = {}
+        self.exceptions = exceptions_namespace(
+            ConditionalCheckFailedException, ResourceNotFoundException, ValidationException,
+            TransactionCanceledException
+        )
+        self.meta = types.SimpleNamespace(client=self, events=FakeEvents())
+        # Seconds every API call takes, to model round trips (0: none)
+        self.latency = 0.0
+
+    def record(self, operation: str) -> None:
+        self.calls[f'dynamodb:{operation}'] += 1
+        self.meta.events.emit(f'before-call.dynamodb.{operation}')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_table(self, name: str, hash_key: str, range_key: Optional[str] = None,
+                     indexes: Optional[Dict[str, Tuple[str, str]]] = None,
+                     ttl_attribute: Optional[str] = None) -> FakeTable:
+        self.tables[name] = FakeTable(name, hash_key, range_key, indexes, ttl_attribute)
+        return self.tables[name]
+
+    def Table(self, name: str) -> FakeTableResource:
+        return FakeTableResource(self, name)
+
+    def table(self, name: str, operation: str) -> FakeTable:
+        return FakeTableResource(self, name).backing(operation)
+
+    def update_item(self, TableName: str, **kwargs) -> Dict[str, Any]:
+        """
+        The client call, with the resource's native types.
+        """
+        return self.Table(TableName).update_item(**kwargs)
+
+    def batch_get_item(self, RequestItems: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Up to 100 keys, always all processed.
+        """
+        self.record('BatchGetItem')
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise ValidationException('Too many items requested for the BatchGetItem call', 'BatchGetItem')
+        responses: Dict[str, List[Dict[str, Any]]] = {}
+        for name, request in RequestItems.items():
+            table = self.table(name, 'BatchGetItem')
+            names = request.get('ExpressionAttributeNames') or {}
+            responses[name] = [
+                project(item, request.get('ProjectionExpression'), names)
+                for item in (table.get(key) for key in request['Keys']) if item is not None
+            ]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def transact_write_items(self, TransactItems: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Update and ConditionCheck actions on up to 100 distinct items, applied
+        together only if every condition holds.
+        """
+        self.record('TransactWriteItems')
+        if len(TransactItems) > 100:
+            raise ValidationException('Member must have length less than or equal to 100', 'TransactWriteItems')
+
+        actions = []
+        reasons = []
+        for transact_item in TransactItems:
+            (kind, action), = transact_item.items()
+            table = self.table(action['TableName'], 'TransactWriteItems')
+            key_item = to_dynamodb(action['Key'])
+            key = table.key_of(key_item)
+            names = action.get('ExpressionAttributeNames') or {}
+            values = to_dynamodb(action.get('ExpressionAttributeValues') or {})
+            old = table.items.get(key[0], {}).get(key[1])
+            condition = action.get('ConditionExpression')
+            holds = not condition or evaluate(parse_condition(condition), old or {}, names, values)
+            reasons.append('None' if holds else 'ConditionalCheckFailed')
+            actions.append((kind, action, table, key_item, key, names, values, old))
+        if len({(id(action[2]), action[4]) for action in actions}) < len(actions):
+            raise ValidationException('Transaction request cannot include multiple operations on one item',
+                                      'TransactWriteItems')
+        if any(reason != 'None' for reason in reasons):
+            raise TransactionCanceledException(reasons)
+
+        for kind, action, table, key_item, key, names, values, old in actions:
+            if kind == 'Update':
+                clauses = parse_update(action['UpdateExpression'])
+                table.store(apply_update(old or {}, key_item, clauses, names, values), old, key)
+        return {}
+
+# ============================================================================
+# S3
+# ============================================================================
+
+class FakeObject:
+    """
+    An S3 object. Seeded objects only store their size; their body is
+    materialized as zero bytes when read.
+    """
+    __slots__ = ('size', 'last_modified', 'body', 'content_type')
+
+    def __init__(self, size: int, last_modified: datetime, body: Optional[bytes] = None,
+                 content_type: str = 'binary/octet-stream'):
+        self.size = size
+        self.last_modified = last_modified
+        self.body = body
+        self.content_type = content_type
+
+class FakePaginator:
+    def __init__(self, s3: 'FakeS3', operation: str):
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(f'No fake paginator for {operation}')
+        self.s3 = s3
+
+    def paginate(self, **kwargs) -> Iterator[Dict[str, Any]]:
+        while True:
+            page = self.s3.list_objects_v2(**kwargs)
+            yield page
+            if not page['IsTruncated']:
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+class FakeS3:
+    """
+    The S3 client: buckets of objects, listed in key order.
+    Event listeners are called with (event_name, bucket, key, size) after
+    every successful put or delete, so S3 notifications can be simulated.
+    """
+
+    def __init__(self, calls: Counter, clock: Callable[[], float] = time.time):
+        self.calls = calls
+        self.clock = clock
+        self.buckets: Dict[str, Dict[str, FakeObject]] = {}
+        # Sorted key lists, rebuilt lazily after a put of a new key
+        self.sorted_keys: Dict[str, List[str]] = {}
+        self.listeners: List[Callable[[str, str, str, int], None]] = []
+        self.exceptions = exceptions_namespace(NoSuchKey, NoSuchBucket)
+        self.meta = types.SimpleNamespace(events=FakeEvents())
+        # Seconds every API call takes, to model round trips (0: none)
+        self.latency = 0.0
+
+    def record(self, operation: str) -> None:
+        self.calls[f's3:{operation}'] += 1
+        self.meta.events.emit(f'before-call.s3.{operation}')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_bucket(self, name: str) -> None:
+        self.buckets.setdefault(name, {})
+
+    def bucket(self, name: str, operation: str) -> Dict[str, FakeObject]:
+        if name not in self.buckets:
+            raise NoSuchBucket('The specified bucket does not exist', operation)
+        return self.buckets[name]
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.clock(), tz=timezone.utc)
+
+    def add_object(self, bucket: str, key: str, size: int, last_modified: Optional[datetime] = None) -> None:
+        """
+        Create an object directly, bypassing the API (seeding, not counted).
+        """
+        objects = self.buckets.setdefault(bucket, {})
+        if key not in objects:
+            self.sorted_keys.pop(bucket, None)
+        objects[key] = FakeObject(size, last_modified or self.now())
+
+    def keys(self, bucket: str) -> List[str]:
+        if bucket not in self.sorted_keys:
+            self.sorted_keys[bucket] = sorted(self.buckets[bucket])
+        return self.sorted_keys[bucket]
+
+    def notify(self, event_name: str, bucket: str, key: str, size: int) -> None:
+        for listener in self.listeners:
+            listener(event_name, bucket, key, size)
+
+    def put_object(self, Bucket: str, Key: str, Body: Any = b'', ContentType: Optional[str] = None,
+                   IfNoneMatch: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        self.record('PutObject')
+        objects = self.bucket(Bucket, 'PutObject')
+        if IfNoneMatch == '*' and Key in objects:
+            raise ClientError('At least one of the pre-conditions you specified did not hold',
+                              'PutObject', code='PreconditionFailed')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        if Key not in objects:
+            self.sorted_keys.pop(Bucket, None)
+        objects[Key] = FakeObject(len(Body), self.now(), Body, ContentType or 'binary/octet-stream')
+        self.notify('ObjectCreated:Put', Bucket, Key, len(Body))
+        return {'ETag': f'"{abs(hash(Body)):032x}"'}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self.record('GetObject')
+        obj = self.bucket(Bucket, 'GetObject').get(Key)
+        if obj is None:
+            raise NoSuchKey('The specified key does not exist.', 'GetObject')
+        body = obj.body if obj.body is not None else bytes(obj.size)
+        return {
+            'Body': io.BytesIO(body),
+            'ContentLength': obj.size,
+            'ContentType': obj.content_type,
+            'LastModified': obj.last_modified
+        }
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self.record('HeadObject')
+        obj = self.bucket(Bucket, 'HeadObject').get(Key)
+        if obj is None:
+            raise ClientError('Not Found', 'HeadObject', code='404')
+        return {'ContentLength': obj.size, 'ContentType': obj.content_type, 'LastModified': obj.last_modified}
+
+    def remove(self, bucket: str, key: str) -> None:
+        objects = self.buckets[bucket]
+        if key in objects:
+            del objects[key]
+            keys = self.sorted_keys.get(bucket)
+            if keys is not None:
+                del keys[bisect.bisect_left(keys, key)]
+        # S3 emits the event even for keys that did not exist
+        self.notify('ObjectRemoved:Delete', bucket, key, 0)
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self.record('DeleteObject')
+        self.bucket(Bucket, 'DeleteObject')
+        self.remove(Bucket, Key)
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        self.record('DeleteObjects')
+        self.bucket(Bucket, 'DeleteObjects')
+        objects = Delete['Objects']
+        if len(objects) > 1000:
+            raise ClientError('The XML you provided was not well-formed', 'DeleteObjects', code='MalformedXML')
+        for obj in objects:
+            self.remove(Bucket, obj['Key'])
+        if Delete.get('Quiet'):
+            return {}
+        return {'Deleted': [{'Key': obj['Key']} for obj in objects]}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', MaxKeys: int = LIST_PAGE_SIZE,
+                        ContinuationToken: Optional[str] = None, StartAfter: Optional[str] = None,
+                        Delimiter: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        self.record('ListObjectsV2')
+        objects = self.bucket(Bucket, 'ListObjectsV2')
+        keys = self.keys(Bucket)
+
+        # The continuation token is the next key to list
+        start = bisect.bisect_left(keys, Prefix)
+        if ContinuationToken:
+            start = max(start, bisect.bisect_left(keys, ContinuationToken))
+        elif StartAfter:
+            start = max(start, bisect.bisect_right(keys, StartAfter))
+
+        page: List[str] = []
+        common_prefixes: List[str] = []
+        i = start
+        while i < len(keys) and len(page) + len(common_prefixes) < min(MaxKeys, LIST_PAGE_SIZE):
+            if not keys[i].startswith(Prefix):
+                break
+            position = keys[i].find(Delimiter, len(Prefix)) if Delimiter else -1
+            if position < 0:
+                page.append(keys[i])
+                i += 1
+                continue
+            # Keys sharing a prefix up to the delimiter roll up into one entry
+            common_prefix = keys[i][:position + len(Delimiter)]
+            common_prefixes.append(common_prefix)
+            i = bisect.bisect_left(keys, common_prefix[:-1] + chr(ord(common_prefix[-1]) + 1), i)
+        truncated = i < len(keys) and keys[i].startswith(Prefix)
+
+        response: Dict[str, Any] = {
+            'Name': Bucket,
+            'Prefix': Prefix,
+            'KeyCount': len(page) + len(common_prefixes),
+            'IsTruncated': truncated,
+            'Contents': [
+                {'Key': key, 'Size': objects[key].size, 'LastModified': objects[key].last_modified}
+                for key in page
+            ]
+        }
+        if not page:
+            del response['Contents']
+        if common_prefixes:
+            response['CommonPrefixes'] = [{'Prefix': common_prefix} for common_prefix in common_prefixes]
+        if truncated:
+            response['NextContinuationToken'] = keys[i]
+        return response
+
+    def get_paginator(self, operation: str) -> FakePaginator:
+        return FakePaginator(self, operation)
+
+    def generate_presigned_url(self, ClientMethod: str, Params: Dict[str, Any], ExpiresIn: int = 3600) -> str:
+        # Signed locally by boto3, so not an API call
+        return (f'https://{Params["Bucket"]}.s3.amazonaws.com/{Params["Key"]}'
+                f'?X-Amz-Expires={ExpiresIn}&X-Amz-Signature=fake')
+
+# ============================================================================
+# CloudWatch Logs
+# ============================================================================
+
+class LogStream(io.TextIOBase):
+    """
+    File-like sink that turns printed lines into log events.
+    """
+
+    def __init__(self, events: List[Tuple[float, str]], clock: Callable[[], float]):
+        self.events = events
+        self.clock = clock
+        self.partial = ''
+
+    def write(self, text: str) -> int:
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        now = self.clock()
+        self.events.extend((now, line) for line in lines)
+        return len(text)
+
+    def flush(self) -> None:
+        if self.partial:
+            self.events.append((self.clock(), self.partial))
+            self.partial = ''
+
+class FakeLogs:
+    """
+    CloudWatch Logs as Lambda uses it: everything a function prints becomes
+    a log event in its log group. Listeners are called with
+    (log_group, timestamp, message) for every event, which is how metric
+    filters are simulated.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.groups: Dict[str, List[Tuple[float, str]]] = {}
+        self.listeners: List[Callable[[str, float, str], None]] = []
+
+    @contextlib.contextmanager
+    def capture(self, log_group: str) -> Iterator[None]:
+        """
+        Redirect stdout into the log group for the duration of the block.
+        """
+        events = self.groups.setdefault(log_group, [])
+        first = len(events)
+        stream = LogStream(events, self.clock)
+        try:
+            with contextlib.redirect_stdout(stream):
+                yield
+        finally:
+            stream.flush()
+            for timestamp, message in events[first:]:
+                for listener in self.listeners:
+                    listener(log_group, timestamp, message)
+
+    def bytes_logged(self, log_group: str) -> int:
+        return sum(len(message) for _, message in self.groups.get(log_group, []))
+
+# ============================================================================
+# CloudWatch metrics
+# ============================================================================
+
+class FakeCloudWatch:
+    """
+    CloudWatch's PutMetricData. Datapoints are kept per metric, and
+    listeners are called with (namespace, metric name, dimensions,
+    timestamp, value) for each, which is how alarms on them are simulated.
+    """
+
+    def __init__(self, calls: Counter, clock: Callable[[], float] = time.time):
+        self.calls = calls
+        self.clock = clock
+        # (namespace, metric name, ((dimension, value), ...)) -> [(timestamp, value)]
+        self.datapoints: Dict[Tuple[str, str, tuple], List[Tuple[float, float]]] = {}
+        self.listeners: List[Callable[[str, str, Dict[str, str], float, float], None]] = []
+        self.meta = types.SimpleNamespace(events=FakeEvents())
+        # Seconds every API call takes, to model round trips (0: none)
+        self.latency = 0.0
+
+    def record(self, operation: str) -> None:
+        self.calls[f'cloudwatch:{operation}'] += 1
+        self.meta.events.emit(f'before-call.cloudwatch.{operation}')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_metric_data(self, Namespace: str, MetricData: List[Dict[str, Any]]) -> Dict[str, Any]:
+        self.record('PutMetricData')
+        if len(MetricData) > 1000:
+            raise ValidationException('MetricData can hold at most 1000 datapoints', 'PutMetricData')
+        for datum in MetricData:
+            dimensions = {dimension['Name']: dimension['Value'] for dimension in datum.get('Dimensions', [])}
+            timestamp = datum.get('Timestamp', self.clock())
+            if isinstance(timestamp, datetime):
+                timestamp = timestamp.timestamp()
+            values = datum['Values'] if 'Values' in datum else [datum['Value']]
+            key = (Namespace, datum['MetricName'], tuple(sorted(dimensions.items())))
+            for value in values:
+                self.datapoints.setdefault(key, []).append((float(timestamp), float(value)))
+                for listener in self.listeners:
+                    listener(Namespace, datum['MetricName'], dimensions, float(timestamp), float(value))
+        return {}
+
+# ============================================================================
+# Lambda
+# ============================================================================
+
+class FakeLambda:
+    """
+    Lambda's asynchronous Invoke. Invocations are only recorded; listeners
+    are called with (function name, payload) for each, which is how the
+    invoked function is run in the simulator.
+    """
+
+    def __init__(self, calls: Counter):
+        self.calls = calls
+        self.invocations: List[Tuple[str, Dict[str, Any]]] = []
+        self.listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        self.meta = types.SimpleNamespace(events=FakeEvents())
+        # Seconds every API call takes, to model round trips (0: none)
+        self.latency = 0.0
+
+    def record(self, operation: str) -> None:
+        self.calls[f'lambda:{operation}'] += 1
+        self.meta.events.emit(f'before-call.lambda.{operation}')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def invoke(self, FunctionName: str, InvocationType: str = 'RequestResponse',
+               Payload: Any = b'{}') -> Dict[str, Any]:
+        self.record('Invoke')
+        if InvocationType != 'Event':
+            raise NotImplementedError('Only asynchronous (Event) invocations are faked')
+        payload = json.loads(Payload)
+        self.invocations.append((FunctionName, payload))
+        for listener in self.listeners:
+            listener(FunctionName, payload)
+        return {'StatusCode': 202}
+
+# ============================================================================
+# Wiring
+# ============================================================================
+
+class FakeAWS:
+    """
+    One fake account: S3, DynamoDB and CloudWatch sharing an API call
+    counter and a clock (real time unless a virtual clock is passed in).
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.api_calls: Counter = Counter()
+        self.s3 = FakeS3(self.api_calls, clock)
+        self.dynamodb = FakeDynamoDB(self.api_calls)
+        self.logs = FakeLogs(clock)
+        self.cloudwatch = FakeCloudWatch(self.api_calls, clock)
+        self.lambda_ = FakeLambda(self.api_calls)
+
+    def client(self, service: str, **kwargs) -> Any:
+        if service == 's3':
+            return self.s3
+        if service == 'cloudwatch':
+            return self.cloudwatch
+        if service == 'lambda':
+            return self.lambda_
+        raise NotImplementedError(f'No fake client for {service}')
+
+    def resource(self, service: str, **kwargs) -> Any:
+        if service == 'dynamodb':
+            return self.dynamodb
+        raise NotImplementedError(f'No fake resource for {service}')
+
+    def boto3_module(self) -> types.ModuleType:
+        """
+        A stand-in boto3 module whose client()/resource(), also through a
+        session, return these fakes.
+        """
+        module = types.ModuleType('boto3')
+        module.client = self.client
+        module.resource = self.resource
+        # boto3.session.Session() hands out the same fakes
+        module.session = types.SimpleNamespace(Session=lambda **kwargs: module)
+        return module
+
+    def load_lambda(self, name: str, environment: Dict[str, str]) -> types.ModuleType:
+        """
+        Import lambda/<name>/index.py against these fakes.
+        The environment only applies while the module is imported, which is
+        when the handlers read it. Modules next to index.py (e.g. charts.py)
+        and in the layers stay importable.
+        """
+        directory = LAMBDA_DIR / name
+        search_path = [str(directory)] + [str(layer) for layer in LAYER_DIRS]
+        saved_environment = dict(os.environ)
+        os.environ.update(environment)
+
+        # Modules cached by an earlier load still use that load's fakes and
+        # state; every function gets its own copy, as in its own container
+        for module_name, module in list(sys.modules.items()):
+            if str(Path(getattr(module, '__file__', None) or '/').parent) in search_path:
+                del sys.modules[module_name]
+
+        saved_boto3 = sys.modules.get('boto3')
+        sys.modules['boto3'] = self.boto3_module()
+        sys.path[:0] = search_path
+        try:
+            spec = importlib.util.spec_from_file_location(f'{name.replace("-", "_")}_index',
+                                                          directory / 'index.py')
+            module = importlib.util.module_from_spec(spec)
+            with self.logs.capture(f'/aws/lambda/{name}'):
+                spec.loader.exec_module(module)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environment)
+            for path in search_path:
+                sys.path.remove(path)
+            if saved_boto3 is not None:
+                sys.modules['boto3'] = saved_boto3
+            else:
+                del sys.modules['boto3']
+        return module
@@ -0,0 +1,534 @@
+"""
+Discrete-event simulation of the deployed pipeline on a virtual clock.
+
+The unmodified handlers are wired together the way lib/lambda-stack.ts does:
+
+    S3 -> SNS -+-> size-tracking queue -> size-tracking lambda -> DynamoDB
+               |                                               -> BucketSize
+               |                             (over quota, async) -> cleaner lambda
+               +-> logging queue -> logging lambda -> log group
+    log group -> size_delta metric filter -> TotalObjectSize
+    BucketSize (Maximum, 10 seconds) -> alarm -> cleaner lambda
+    cleaner lambda -> S3 deletes (and back through S3)
+
+Nothing sleeps: callbacks run in virtual-time order, so hours of traffic and
+many alarm cycles replay in seconds. SNS->SQS delivery delay, jitter (which
+reorders messages) and duplicate deliveries are configurable.
+
+    python -m offline.simulator
+    python -m offline.simulator --scenario random --objects 5000 --rate 20 \\
+        --jitter 10 --duplicates 0.05
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+import sys
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from offline.events import s3_record, sns_envelope
+from offline.stack import (BUCKET, LAMBDA_ENVIRONMENTS, LOGGING_LOG_GROUP,
+                           NOTIFICATION_EXCLUDED_PREFIXES, SIZE_METRIC_NAME, SIZE_METRIC_NAMESPACE,
+                           TABLE_NAME, new_account)
+
+# Event source mappings and queues, as configured in the lambda stack
+BATCH_SIZE = 100
+MAX_BATCHING_WINDOW_SECONDS = 5.0
+VISIBILITY_TIMEOUT_SECONDS = 180.0
+MAX_RECEIVE_COUNT = 3
+
+# BucketSize alarm: Maximum over 10 seconds > 20 bytes, 1 evaluation period,
+# missing data is not breaching
+ALARM_PERIOD_SECONDS = 10.0
+ALARM_THRESHOLD = 20.0
+
+# Asynchronous invocations start this long after the Invoke call
+ASYNC_INVOKE_DELAY_SECONDS = 0.5
+
+# Bodies written by the driver lambda's assignment workflow
+DRIVER_STEPS = [
+    (0.0, 'assignment1.txt', 'Empty Assignment 1'),
+    (5.0, 'assignment2.txt', 'Empty Assignment 2222222222'),
+    (140.0, 'assignment3.txt', '33333'),
+]
+
+class VirtualClock:
+    def __init__(self, start: float):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+class VirtualTime:
+    """
+    Stand-in for a handler module's `time` import that reads the virtual clock.
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+
+    def time(self) -> float:
+        return self.clock.now
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(time, name)
+
+class Queue:
+    """
+    An SQS queue with visibility timeouts and a redrive policy to a DLQ.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.visible: Deque[Dict[str, Any]] = deque()
+        self.in_flight = 0
+        self.dead_letters: List[Dict[str, Any]] = []
+        self.sent = 0
+
+class EventSource:
+    """
+    Lambda's SQS event source mapping: waits up to the batching window for a
+    full batch, invokes the function and deletes every message that is not
+    reported in batchItemFailures. Failed messages become visible again after
+    the visibility timeout. One batch is processed at a time.
+    """
+
+    def __init__(self, simulator: 'Simulator', queue: Queue, function: str):
+        self.simulator = simulator
+        self.queue = queue
+        self.function = function
+        self.poll_at: Optional[float] = None
+
+    def notify(self) -> None:
+        """
+        A message became visible: poll now if a batch is full, else at the end
+        of the batching window.
+        """
+        now = self.simulator.clock.now
+        at = now if len(self.queue.visible) >= BATCH_SIZE else now + MAX_BATCHING_WINDOW_SECONDS
+        if self.poll_at is None or at < self.poll_at:
+            self.poll_at = at
+            self.simulator.schedule(at, self.poll)
+
+    def poll(self) -> None:
+        now = self.simulator.clock.now
+        if self.poll_at != now:
+            return  # Superseded by an earlier poll
+        self.poll_at = None
+
+        batch = []
+        while self.queue.visible and len(batch) < BATCH_SIZE:
+            message = self.queue.visible.popleft()
+            message['receive_count'] += 1
+            if message['receive_count'] > MAX_RECEIVE_COUNT:
+                self.queue.dead_letters.append(message)
+                continue
+            batch.append(message)
+
+        if batch:
+            self.queue.in_flight += len(batch)
+            event = {
+                'Records': [
+                    {'messageId': message['id'], 'eventSource': 'aws:sqs', 'body': message['body']}
+                    for message in batch
+                ]
+            }
+            response = self.simulator.invoke(self.function, event)
+            if response is None:
+                failed_ids = {message['id'] for message in batch}
+            else:
+                failed_ids = {failure['itemIdentifier'] for failure in response.get('batchItemFailures', [])}
+
+            self.queue.in_flight -= len(batch)
+            for message in batch:
+                if message['id'] in failed_ids:
+                    self.simulator.schedule(now + VISIBILITY_TIMEOUT_SECONDS, self.make_visible, message)
+
+        if self.queue.visible:
+            self.notify()
+
+    def make_visible(self, message: Dict[str, Any]) -> None:
+        self.queue.visible.append(message)
+        self.notify()
+
+class Simulator:
+    """
+    The pipeline on a virtual clock. Schedule S3 operations with put_object /
+    delete_object, then run() to replay them.
+    """
+
+    def __init__(self, start: Optional[float] = None, seed: int = 0, delivery_delay: float = 0.1,
+                 delivery_jitter: float = 0.0, duplicate_probability: float = 0.0,
+                 alarm_action_delay: float = 1.0):
+        self.clock = VirtualClock(start if start is not None else float(int(time.time())))
+        self.start = self.clock.now
+        self.rng = random.Random(seed)
+        self.delivery_delay = delivery_delay
+        self.delivery_jitter = delivery_jitter
+        self.duplicate_probability = duplicate_probability
+        self.alarm_action_delay = alarm_action_delay
+
+        # (time, sequence, callback, args); the sequence keeps same-time callbacks in FIFO order
+        self.events: List[Tuple[float, int, Callable, tuple, bool]] = []
+        self.sequence = itertools.count()
+        self.pending = 0  # Scheduled callbacks other than alarm evaluations
+
+        self.aws = new_account(self.clock.time)
+        self.functions = {
+            name: self.load(name)
+            for name in ('size-tracking-lambda', 'logging-lambda', 'cleaner-lambda')
+        }
+        # The logging lambda is deployed before the workload starts, so it
+        # keeps records of every object created from here on
+        self.functions['logging-lambda'].get_tracking_since(BUCKET)
+        self.queues = {name: Queue(name) for name in ('size-tracking', 'logging')}
+        self.event_sources = [
+            EventSource(self, self.queues['size-tracking'], 'size-tracking-lambda'),
+            EventSource(self, self.queues['logging'], 'logging-lambda'),
+        ]
+
+        self.aws.s3.listeners.append(self.on_s3_event)
+        self.aws.logs.listeners.append(self.on_log_event)
+        self.aws.cloudwatch.listeners.append(self.on_metric_datapoint)
+        self.aws.lambda_.listeners.append(self.on_async_invoke)
+        self.s3_sequencer = itertools.count(1)
+
+        self.datapoints: List[Tuple[float, float]] = []  # BucketSize
+        self.logged_size = 0.0  # Sum of every size_delta ever logged
+        self.alarm_state = 'INSUFFICIENT_DATA'
+        self.alarm_history: List[Dict[str, Any]] = []
+        self.cleaner_runs: List[Dict[str, Any]] = []
+        self.stats: Counter = Counter()
+
+        first_evaluation = (self.clock.now // ALARM_PERIOD_SECONDS + 1) * ALARM_PERIOD_SECONDS
+        self.schedule(first_evaluation, self.evaluate_alarm, periodic=True)
+
+    def load(self, name: str) -> Any:
+        module = self.aws.load_lambda(name, LAMBDA_ENVIRONMENTS[name])
+        module.time = VirtualTime(self.clock)
+        return module
+
+    # ------------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------------
+
+    def schedule(self, at: float, callback: Callable, *args, periodic: bool = False) -> None:
+        if not periodic:
+            self.pending += 1
+        heapq.heappush(self.events, (at, next(self.sequence), callback, args, periodic))
+
+    def step(self) -> None:
+        at, _, callback, args, periodic = heapq.heappop(self.events)
+        self.clock.now = max(self.clock.now, at)
+        if not periodic:
+            self.pending -= 1
+        callback(*args)
+
+    def run(self, until: Optional[float] = None, settle: float = 3 * ALARM_PERIOD_SECONDS) -> None:
+        """
+        Process callbacks up to the virtual time `until` (seconds from the
+        start), or else until no work is left and `settle` more seconds of
+        alarm evaluations have passed.
+        """
+        if until is not None:
+            deadline = self.start + until
+            while self.events and self.events[0][0] <= deadline:
+                self.step()
+            self.clock.now = max(self.clock.now, deadline)
+            return
+
+        while self.pending:
+            self.step()
+        deadline = self.clock.now + settle
+        while self.events and self.events[0][0] <= deadline:
+            self.step()
+            while self.pending:
+                self.step()
+
+    # ------------------------------------------------------------------------
+    # Workload
+    # ------------------------------------------------------------------------
+
+    def put_object(self, at: float, key: str, body: Any) -> None:
+        """
+        PUT an object at `at` seconds from the start.
+        """
+        self.schedule(self.start + at, lambda: self.aws.s3.put_object(Bucket=BUCKET, Key=key, Body=body))
+
+    def delete_object(self, at: float, key: str) -> None:
+        self.schedule(self.start + at, lambda: self.aws.s3.delete_object(Bucket=BUCKET, Key=key))
+
+    def request_plot(self, at: float) -> None:
+        """
+        GET the plotting API's image at `at` seconds from the start. Renders
+        are cached in the bucket, under a prefix the notifications filter out.
+        """
+        if 'plotting-lambda' not in self.functions:
+            self.functions['plotting-lambda'] = self.load('plotting-lambda')
+        self.schedule(self.start + at, self.invoke, 'plotting-lambda', {'queryStringParameters': {'format': 'image'}})
+
+    # ------------------------------------------------------------------------
+    # Wiring
+    # ------------------------------------------------------------------------
+
+    def on_s3_event(self, event_name: str, bucket: str, key: str, size: int) -> None:
+        """
+        S3 notification -> SNS -> both subscribed queues. Each delivery is
+        delayed independently and may be duplicated (at-least-once delivery).
+        Keys the subscriptions' filter policy excludes reach neither queue.
+        """
+        self.stats['s3_events'] += 1
+        if key.startswith(tuple(NOTIFICATION_EXCLUDED_PREFIXES)):
+            self.stats['filtered_events'] += 1
+            return
+        record = s3_record(event_name, bucket, key, size, self.clock.now,
+                           sequencer=f'{next(self.s3_sequencer):016X}')
+        body = sns_envelope([record])
+
+        for queue in self.queues.values():
+            copies = 1
+            while self.rng.random() < self.duplicate_probability:
+                copies += 1
+            self.stats['duplicate_deliveries'] += copies - 1
+            for _ in range(copies):
+                delay = self.delivery_delay + self.rng.uniform(0, self.delivery_jitter)
+                self.schedule(self.clock.now + delay, self.deliver, queue, body)
+
+    def deliver(self, queue: Queue, body: str) -> None:
+        queue.sent += 1
+        queue.visible.append({
+            'id': f'{queue.name}-{queue.sent}',
+            'body': body,
+            'receive_count': 0
+        })
+        for event_source in self.event_sources:
+            if event_source.queue is queue:
+                event_source.notify()
+
+    def invoke(self, function: str, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Run a handler with its output captured into its log group.
+        Returns None when the invocation raised.
+        """
+        self.stats[f'invocations:{function}'] += 1
+        log_group = LOGGING_LOG_GROUP if function == 'logging-lambda' else f'/aws/lambda/{function}'
+        with self.aws.logs.capture(log_group):
+            try:
+                return self.functions[function].lambda_handler(event, None)
+            except Exception as e:
+                print(f'Invocation failed: {e!r}')
+                self.stats[f'errors:{function}'] += 1
+                return None
+
+    def on_log_event(self, log_group: str, timestamp: float, message: str) -> None:
+        """
+        The SizeDeltaMetricFilter: { $.size_delta = * } -> TotalObjectSize,
+        and BucketSize values logged in embedded metric format.
+        """
+        if not message.startswith('{'):
+            return
+        try:
+            entry = json.loads(message)
+        except json.JSONDecodeError:
+            return
+        if not isinstance(entry, dict):
+            return
+        if log_group == LOGGING_LOG_GROUP and isinstance(entry.get('size_delta'), (int, float)):
+            self.logged_size += entry['size_delta']
+        if '_aws' in entry and entry.get('BucketName') == BUCKET and SIZE_METRIC_NAME in entry:
+            self.datapoints.append((entry['_aws']['Timestamp'] / 1000, float(entry[SIZE_METRIC_NAME])))
+
+    def on_metric_datapoint(self, namespace: str, name: str, dimensions: Dict[str, str],
+                            timestamp: float, value: float) -> None:
+        """
+        BucketSize values published with PutMetricData.
+        """
+        if (namespace, name) == (SIZE_METRIC_NAMESPACE, SIZE_METRIC_NAME) and dimensions.get('BucketName') == BUCKET:
+            self.datapoints.append((timestamp, value))
+
+    def evaluate_alarm(self) -> None:
+        """
+        Evaluate the period that just ended; actions run on the transition to ALARM.
+        """
+        now = self.clock.now
+        period_start = now - ALARM_PERIOD_SECONDS
+        values = [value for timestamp, value in self.datapoints if period_start <= timestamp < now]
+        maximum = max(values, default=0.0)
+        # Missing data is treated as not breaching
+        state = 'ALARM' if values and maximum > ALARM_THRESHOLD else 'OK'
+
+        if state != self.alarm_state:
+            self.alarm_history.append({
+                'time': round(now - self.start, 3),
+                'state': state,
+                'value': maximum
+            })
+            self.alarm_state = state
+            if state == 'ALARM':
+                self.schedule(now + self.alarm_action_delay, self.run_cleaner, 'alarm', {
+                    'source': 'aws.cloudwatch',
+                    'alarmData': {
+                        'alarmName': 'Assignment4-TotalObjectSize-Alarm',
+                        'state': {'value': 'ALARM', 'reason': f'Maximum {maximum} > {ALARM_THRESHOLD}'}
+                    }
+                })
+
+        self.datapoints = [point for point in self.datapoints if point[0] >= now]
+        self.schedule(now + ALARM_PERIOD_SECONDS, self.evaluate_alarm, periodic=True)
+
+    def on_async_invoke(self, function: str, payload: Dict[str, Any]) -> None:
+        """
+        The size-tracking lambda's asynchronous cleaner invocations.
+        """
+        if function in self.functions:
+            self.schedule(self.clock.now + ASYNC_INVOKE_DELAY_SECONDS, self.run_cleaner, 'quota', payload)
+
+    def run_cleaner(self, trigger: str, event: Dict[str, Any]) -> None:
+        response = self.invoke('cleaner-lambda', event)
+        body = json.loads(response['body']) if response else None
+        self.cleaner_runs.append({
+            'time': round(self.clock.now - self.start, 3),
+            'trigger': trigger,
+            'status': response['statusCode'] if response else None,
+            'deleted_objects': body.get('deleted_objects', []) if isinstance(body, dict) else []
+        })
+
+    # ------------------------------------------------------------------------
+    # Results
+    # ------------------------------------------------------------------------
+
+    def bucket_size(self) -> Tuple[int, int]:
+        """
+        (total size, object count) of the bucket, excluding plot artifacts.
+        """
+        is_plot_key = self.functions['size-tracking-lambda'].is_plot_key
+        objects = [obj for key, obj in self.aws.s3.buckets[BUCKET].items() if not is_plot_key(key)]
+        return sum(obj.size for obj in objects), len(objects)
+
+    def summary(self) -> Dict[str, Any]:
+        actual_size, actual_count = self.bucket_size()
+        aggregate = self.aws.dynamodb.tables[TABLE_NAME].get(
+            {'bucketName': f'{BUCKET}#aggregate', 'timestamp': 0}
+        ) or {}
+        tracked_size = int(aggregate.get('total_size', 0))
+        tracked_count = int(aggregate.get('object_count', 0))
+
+        return {
+            'virtual_seconds': round(self.clock.now - self.start, 3),
+            's3_events': self.stats['s3_events'],
+            'filtered_events': self.stats['filtered_events'],
+            'duplicate_deliveries': self.stats['duplicate_deliveries'],
+            'invocations': {
+                name.split(':', 1)[1]: count for name, count in sorted(self.stats.items())
+                if name.startswith('invocations:')
+            },
+            'errors': {
+                name.split(':', 1)[1]: count for name, count in sorted(self.stats.items())
+                if name.startswith('errors:')
+            },
+            'dead_letters': {name: len(queue.dead_letters) for name, queue in self.queues.items()},
+            'alarm_transitions': self.alarm_history,
+            'cleaner_runs': self.cleaner_runs,
+            'bucket': {'size': actual_size, 'objects': actual_count},
+            'tracked': {'size': tracked_size, 'objects': tracked_count},
+            'tracking_consistent': (tracked_size, tracked_count) == (actual_size, actual_count),
+            # The size_delta metric summed over all time
+            'logged_size': self.logged_size,
+            'metric_consistent': self.logged_size == actual_size,
+            'api_calls': dict(sorted(self.aws.api_calls.items()))
+        }
+
+# ============================================================================
+# Scenarios
+# ============================================================================
+
+def driver_scenario(simulator: Simulator, args: argparse.Namespace) -> None:
+    """
+    The driver lambda's assignment workflow, without its 210 s of sleeps.
+    """
+    for at, key, body in DRIVER_STEPS:
+        simulator.put_object(at, key, body)
+
+def random_scenario(simulator: Simulator, args: argparse.Namespace) -> None:
+    """
+    args.objects operations at args.rate per second (Poisson arrivals) over a
+    pool of keys, so keys are overwritten; a fraction of them are deletes.
+    """
+    rng = random.Random(args.seed)
+    key_count = max(1, args.objects // 4)
+    at = 0.0
+    for _ in range(args.objects):
+        at += rng.expovariate(args.rate)
+        key = f'objects/{rng.randrange(key_count):06d}'
+        if rng.random() < args.delete_fraction:
+            simulator.delete_object(at, key)
+        else:
+            simulator.put_object(at, key, bytes(int(rng.lognormvariate(2, 1))))
+
+SCENARIOS = {
+    'driver': driver_scenario,
+    'random': random_scenario,
+}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m offline.simulator', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, default='driver')
+    parser.add_argument('--objects', type=int, default=1000, help='operations in the random scenario')
+    parser.add_argument('--rate', type=float, default=10.0, help='operations per second in the random scenario')
+    parser.add_argument('--delete-fraction', type=float, default=0.2)
+    parser.add_argument('--delay', type=float, default=0.1, help='SNS to SQS delivery delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='extra uniform random delivery delay in seconds; reorders messages')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='probability that a delivery is duplicated')
+    parser.add_argument('--plot-interval', type=float, default=0.0,
+                        help='request a plot every this many seconds while the workload runs (0: never)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+    if not 0 <= args.duplicates < 1:
+        parser.error('--duplicates must be in [0, 1)')
+
+    simulator = Simulator(seed=args.seed, delivery_delay=args.delay, delivery_jitter=args.jitter,
+                          duplicate_probability=args.duplicates)
+    SCENARIOS[args.scenario](simulator, args)
+    if args.plot_interval > 0:
+        workload_end = max(at for at, *_ in simulator.events) - simulator.start
+        for index in range(1, int(workload_end // args.plot_interval) + 1):
+            simulator.request_plot(index * args.plot_interval)
+
+    started = time.perf_counter()
+    simulator.run()
+    summary = dict(simulator.summary(), wall_seconds=round(time.perf_counter() - started, 3))
+
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print(f'Simulated {summary["virtual_seconds"]:g} s in {summary["wall_seconds"]:g} s '
+              f'({summary["s3_events"]} S3 events, {summary["filtered_events"]} filtered out, '
+              f'{summary["duplicate_deliveries"]} duplicate deliveries)')
+        print(f'Invocations: {summary["invocations"]}')
+        if summary['errors'] or any(summary['dead_letters'].values()):
+            print(f'Errors: {summary["errors"]}, dead letters: {summary["dead_letters"]}')
+        timeline = [
+            (transition['time'], f'alarm -> {transition["state"]} (max {transition["value"]:g})')
+            for transition in summary['alarm_transitions']
+        ] + [
+            (run['time'], f'cleaner ({run["trigger"]}) deleted {len(run["deleted_objects"])} objects '
+                          f'{run["deleted_objects"][:5]}')
+            for run in summary['cleaner_runs']
+        ]
+        for at, line in sorted(timeline, key=lambda entry: entry[0]):
+            print(f'  t={at:>9.1f}s  {line}')
+        print(f'Bucket: {summary["bucket"]}, tracked: {summary["tracked"]}, '
+              f'consistent: {summary["tracking_consistent"]}')
+        print(f'size_delta metric total: {summary["logged_size"]:g}, '
+              f'consistent: {summary["metric_consistent"]}')
+
+    return 0 if summary['tracking_consistent'] and summary['metric_consistent'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
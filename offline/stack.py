@@ -0,0 +1,97 @@
+"""
+The deployed resources as fakes: the storage stack's bucket and tables
+(lib/storage-stack.ts) and each function's environment (lib/lambda-stack.ts).
+Keep in sync with the CDK stacks.
+"""
+import time
+from typing import Callable, Dict
+
+from offline.fakes import FakeAWS
+
+BUCKET = 'assignment3-bucket'
+TABLE_NAME = 'assignment3-table'
+OBJECT_INDEX_TABLE_NAME = 'assignment3-object-index'
+OBJECT_SIZE_INDEX_NAME = 'bySize'
+
+BUCKET_ARN = f'arn:aws:s3:::{BUCKET}'
+
+# Environment of the shared layer, set on every function
+SHARED_ENVIRONMENT: Dict[str, str] = {
+    'METRICS_SAMPLE_RATE': '1',
+    'CLIENT_CONNECT_TIMEOUT_SECONDS': '3',
+    'CLIENT_READ_TIMEOUT_SECONDS': '10',
+    'LISTING_MAX_WORKERS': '8',
+    'TOMBSTONE_TTL_SECONDS': '86400',
+    'HISTORY_SHARDS': '1',
+    'RAW_RETENTION_SECONDS': '604800',
+    'HISTORY_LAYOUT': 'items',
+    'PACKED_BLOCK_SECONDS': '300',
+    'QUOTA_BYTES': '20',
+}
+
+# Function -> environment, as configured in the lambda stack
+LAMBDA_ENVIRONMENTS: Dict[str, Dict[str, str]] = {
+    'size-tracking-lambda': {
+        'BUCKET_ARN': BUCKET_ARN,
+        'TABLE_NAME': TABLE_NAME,
+        'OBJECT_INDEX_TABLE_NAME': OBJECT_INDEX_TABLE_NAME,
+        'TRACKING_MODE': 'incremental',
+        'COMPACT_AFTER_SECONDS': '86400',
+        'RECONCILE_WRITE_WORKERS': '16',
+        'SIZE_METRIC_EMISSION': 'put',
+        'CLEANER_FUNCTION_NAME': 'cleaner-lambda',
+        'CLEANUP_DEBOUNCE_SECONDS': '30',
+        **SHARED_ENVIRONMENT,
+    },
+    'logging-lambda': {
+        'BUCKET_NAME': BUCKET,
+        'OBJECT_INDEX_TABLE_NAME': OBJECT_INDEX_TABLE_NAME,
+        **SHARED_ENVIRONMENT,
+    },
+    'plotting-lambda': {
+        'BUCKET_ARN': BUCKET_ARN,
+        'TABLE_NAME': TABLE_NAME,
+        'PLOT_RENDERER': 'png',
+        **SHARED_ENVIRONMENT,
+    },
+    'cleaner-lambda': {
+        'BUCKET_NAME': BUCKET,
+        'TABLE_NAME': TABLE_NAME,
+        'OBJECT_INDEX_TABLE_NAME': OBJECT_INDEX_TABLE_NAME,
+        'OBJECT_SIZE_INDEX_NAME': OBJECT_SIZE_INDEX_NAME,
+        'TARGET_SIZE_BYTES': '20',
+        'EVICTION_POLICY': 'largest',
+        **SHARED_ENVIRONMENT,
+    },
+    'driver-lambda': {
+        'BUCKET_ARN': BUCKET_ARN,
+        'TABLE_NAME': TABLE_NAME,
+        'OBJECT_INDEX_TABLE_NAME': OBJECT_INDEX_TABLE_NAME,
+        **SHARED_ENVIRONMENT,
+    },
+}
+
+# Keys the SNS subscriptions of both queues filter out by message body
+NOTIFICATION_EXCLUDED_PREFIXES = ['plot-cache/']
+
+# Log group of the logging lambda, which the size_delta metric filter reads
+LOGGING_LOG_GROUP = '/aws/lambda/Assignment4-LoggingLambda'
+
+# The size-tracking lambda's gauge of the bucket's total size, which the
+# size alarm watches
+SIZE_METRIC_NAMESPACE = 'Assignment4App'
+SIZE_METRIC_NAME = 'BucketSize'
+
+def new_account(clock: Callable[[], float] = time.time) -> FakeAWS:
+    """
+    Fake account with the bucket and tables of the storage stack.
+    """
+    aws = FakeAWS(clock)
+    aws.s3.create_bucket(BUCKET)
+    aws.dynamodb.create_table(TABLE_NAME, 'bucketName', 'timestamp', ttl_attribute='expires_at')
+    aws.dynamodb.create_table(
+        OBJECT_INDEX_TABLE_NAME, 'bucketName', 'objectKey',
+        indexes={OBJECT_SIZE_INDEX_NAME: ('bucketName', 'live_size')},
+        ttl_attribute='expires_at'
+    )
+    return aws
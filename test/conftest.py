@@ -0,0 +1,32 @@
+"""
+Fixtures for the Python tests of the lambdas, which run the unmodified
+handlers against the fakes of the offline package:
+
+    python -m pytest test
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from offline.stack import LAMBDA_ENVIRONMENTS, new_account  # noqa: E402
+
+@pytest.fixture
+def aws():
+    return new_account()
+
+@pytest.fixture
+def size_tracking(aws):
+    return aws.load_lambda('size-tracking-lambda', LAMBDA_ENVIRONMENTS['size-tracking-lambda'])
+
+@pytest.fixture
+def plotting(aws):
+    return aws.load_lambda('plotting-lambda', LAMBDA_ENVIRONMENTS['plotting-lambda'])
+
+@pytest.fixture
+def load_cleaner(aws):
+    def load(**environment):
+        return aws.load_lambda('cleaner-lambda', dict(LAMBDA_ENVIRONMENTS['cleaner-lambda'], **environment))
+    return load
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from offline.bench import seed_objects
+from offline.events import s3_record, sqs_batch
+from offline.fakes import ClientError
+from offline.stack import BUCKET, LAMBDA_ENVIRONMENTS, TABLE_NAME
+
+def test_throttled_index_query_fails_without_listing(aws, load_cleaner, monkeypatch):
+    total_size = seed_objects(aws, 50)
+    cleaner = load_cleaner()
+    table = aws.dynamodb.Table
+
+    def throttled(**kwargs):
+        raise ClientError('Rate exceeded', 'Query', code='ProvisionedThroughputExceededException')
+
+    def throttled_table(name):
+        resource = table(name)
+        resource.query = throttled
+        return resource
+    monkeypatch.setattr(aws.dynamodb, 'Table', throttled_table)
+
+    response = cleaner.lambda_handler({'target_size': total_size - 1}, None)
+    assert response['statusCode'] == 500
+    assert aws.api_calls['s3:ListObjectsV2'] == 0
+    assert aws.api_calls['s3:DeleteObjects'] == 0
+
+def test_missing_index_falls_back_to_listing(aws, load_cleaner):
+    total_size = seed_objects(aws, 50)
+    cleaner = load_cleaner(OBJECT_INDEX_TABLE_NAME='missing-table')
+
+    response = cleaner.lambda_handler({'target_size': total_size - 1}, None)
+    assert response['statusCode'] == 200
+    assert aws.api_calls['s3:ListObjectsV2'] > 0
+    assert aws.api_calls['s3:DeleteObjects'] == 1
+
+@pytest.mark.parametrize('policy', ['largest', 'oldest', 'lru'])
+def test_full_tracking_mode_evicts_from_a_listing(aws, load_cleaner, policy):
+    # Full mode keeps no running total on the aggregate and no object index
+    size_tracking = aws.load_lambda('size-tracking-lambda', dict(LAMBDA_ENVIRONMENTS['size-tracking-lambda'],
+                                                                 TRACKING_MODE='full'))
+    for i, size in enumerate([5, 30, 10]):
+        aws.s3.add_object(BUCKET, f'object-{i}', size)
+        record = s3_record('ObjectCreated:Put', BUCKET, f'object-{i}', size, sequencer=f'{i + 1:02X}')
+        size_tracking.lambda_handler(sqs_batch([[record]]), None)
+    assert 'total_size' not in aws.dynamodb.Table(TABLE_NAME).get_item(Key=size_tracking.aggregate_key(BUCKET))['Item']
+
+    response = load_cleaner().lambda_handler({'target_size': 20, 'policy': policy}, None)
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert body['current_size'] <= 20
+    assert body['deleted_objects']
+    assert sum(obj.size for obj in aws.s3.buckets[BUCKET].values()) == body['current_size']
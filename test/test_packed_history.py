@@ -0,0 +1,25 @@
+from decimal import Decimal
+
+def test_block_round_trip(size_tracking):
+    samples = [
+        (size_tracking.to_micros(Decimal('1700000000.000001')), 0, 0),
+        (size_tracking.to_micros(Decimal('1700000000.5')), 2 ** 40, 3),
+        (size_tracking.to_micros(Decimal('1700000299.999999')), 17, 1),
+    ]
+    item = size_tracking.encode_block(samples)
+    assert item['sample_count'] == 3
+    assert size_tracking.decode_block(item) == samples
+    # Stored attributes come back from DynamoDB as Binary, not bytes
+    assert size_tracking.decode_block({name: bytearray(value) for name, value in item.items()
+                                       if name != 'sample_count'}) == samples
+    assert size_tracking.from_micros(samples[0][0]) == Decimal('1700000000.000001')
+
+def test_empty_block_round_trip(size_tracking):
+    assert size_tracking.decode_block(size_tracking.encode_block([])) == []
+
+def test_packed_blocks_decode_like_the_plotting_reader(size_tracking, plotting):
+    samples = [(1700000000000000 + i * 250000, 1000 - 3 * i, i) for i in range(100)]
+    timestamps, sizes = plotting.to_arrays([size_tracking.encode_block(samples)], 'packed',
+                                           1700000000.0, 1700000024.75)
+    assert timestamps.tolist() == [micros / 1000000 for micros, _, _ in samples]
+    assert sizes.tolist() == [size for _, size, _ in samples]
@@ -0,0 +1,159 @@
+import json
+import sys
+import time
+
+import numpy as np
+import pytest
+
+from offline.bench import seed_history
+from offline.events import s3_record, sqs_batch
+from offline.stack import BUCKET
+
+@pytest.mark.parametrize('params', [
+    {'start': 'nan', 'end': '100'},
+    {'start': '0', 'end': 'inf'},
+    {'start': '-inf'},
+])
+def test_non_finite_windows_are_rejected(plotting, params):
+    with pytest.raises(ValueError):
+        plotting.parse_window(params)
+    assert plotting.lambda_handler({'queryStringParameters': params}, None)['statusCode'] == 400
+    assert plotting.lambda_handler({'resource': '/query', 'queryStringParameters': params}, None)['statusCode'] == 400
+
+def pages(timestamps, sizes, page_size):
+    return iter([
+        (np.array(timestamps[i:i + page_size], dtype=float), np.array(sizes[i:i + page_size], dtype=np.int64))
+        for i in range(0, len(timestamps), page_size)
+    ])
+
+def test_merge_pages_interleaves_streams_in_timestamp_order(plotting):
+    streams = [
+        pages([0, 3, 6, 9, 12], [0, 3, 6, 9, 12], 2),
+        pages([1, 4, 7], [1, 4, 7], 1),
+        pages([], [], 1),
+        pages([2, 5, 8, 11, 14, 17], [2, 5, 8, 11, 14, 17], 4),
+    ]
+    merged = list(plotting.merge_pages(streams))
+    timestamps = np.concatenate([page[0] for page in merged])
+    sizes = np.concatenate([page[1] for page in merged])
+    assert timestamps.tolist() == [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12, 14, 17]
+    assert sizes.tolist() == timestamps.tolist()
+
+def test_merge_pages_of_no_streams_is_empty(plotting):
+    assert list(plotting.merge_pages([])) == []
+
+def test_downsampler_does_not_depend_on_page_order(plotting):
+    rng = np.random.default_rng(0)
+    timestamps = np.sort(rng.uniform(0, 1000, 5000))
+    # Few distinct sizes, so every bucket has ties for its min and max
+    sizes = rng.integers(0, 5, 5000)
+    chunks = np.array_split(np.arange(5000), 37)
+
+    results = []
+    for order in (range(37), reversed(range(37)), rng.permutation(37)):
+        downsampler = plotting.MinMaxDownsampler(0, 1000, 100)
+        for index in order:
+            downsampler.add(timestamps[chunks[index]], sizes[chunks[index]])
+        results.append(downsampler.result())
+
+    for timestamps_out, sizes_out in results[1:]:
+        assert timestamps_out.tolist() == results[0][0].tolist()
+        assert sizes_out.tolist() == results[0][1].tolist()
+    assert len(results[0][0]) <= 100
+    assert np.all(np.diff(results[0][0]) > 0)
+
+def plot_request(start, end, **headers):
+    return {'queryStringParameters': {'start': str(start), 'end': str(end)}, 'headers': headers}
+
+def test_plot_cache_survives_its_own_writes(aws, size_tracking, plotting):
+    aws.s3.add_object(BUCKET, 'a', 10)
+    size_tracking.lambda_handler(sqs_batch([[s3_record('ObjectCreated:Put', BUCKET, 'a', 10, sequencer='01')]]), None)
+    notifications = []
+    aws.s3.listeners.append(lambda *notification: notifications.append(notification))
+    start = int(time.time()) - 60
+    end = start + 120
+
+    rendered = plotting.lambda_handler(plot_request(start, end), None)
+    assert rendered['statusCode'] == 200
+    assert json.loads(rendered['body'])['cached'] is False
+    etag = rendered['headers']['ETag']
+
+    # The cache entry's own notifications reach size-tracking without
+    # writing a sample, so they do not move the cache key
+    cache_writes = [key for _, _, key, _ in notifications]
+    assert cache_writes and all(key.startswith('plot-cache/') for key in cache_writes)
+    size_tracking.lambda_handler(sqs_batch([
+        [s3_record(event_name, bucket, key, size, sequencer=f'{i + 2:02X}')]
+        for i, (event_name, bucket, key, size) in enumerate(notifications)
+    ]), None)
+
+    plotting.plot_memory_cache.clear()
+    cached = plotting.lambda_handler(plot_request(start, end), None)
+    assert json.loads(cached['body'])['cached'] is True
+    assert cached['headers']['ETag'] == etag
+
+def test_matching_etag_is_not_modified(aws, size_tracking, plotting):
+    aws.s3.add_object(BUCKET, 'a', 10)
+    size_tracking.lambda_handler(sqs_batch([[s3_record('ObjectCreated:Put', BUCKET, 'a', 10, sequencer='01')]]), None)
+    start = int(time.time()) - 60
+    etag = plotting.lambda_handler(plot_request(start, start + 120), None)['headers']['ETag']
+
+    aws.api_calls.clear()
+    response = plotting.lambda_handler(plot_request(start, start + 120, **{'if-none-match': etag}), None)
+    assert response['statusCode'] == 304
+    assert response['headers']['ETag'] == etag
+    # Only the aggregate was read: nothing rendered or fetched from the cache
+    assert set(aws.api_calls) == {'dynamodb:GetItem'}
+
+    # A new sample changes the key, so the old ETag no longer matches
+    aws.s3.add_object(BUCKET, 'b', 5)
+    size_tracking.lambda_handler(sqs_batch([[s3_record('ObjectCreated:Put', BUCKET, 'b', 5, sequencer='02')]]), None)
+    response = plotting.lambda_handler(plot_request(start, start + 120, **{'If-None-Match': etag}), None)
+    assert response['statusCode'] == 200
+    assert response['headers']['ETag'] != etag
+
+def test_window_percentiles_use_bounded_memory(plotting):
+    series = sys.modules[plotting.WindowAggregates.__module__]
+    rng = np.random.default_rng(1)
+    small = series.WindowAggregates(0, 100, quota=0)
+    sizes = rng.integers(0, 10 ** 6, 500)
+    small.add(np.arange(500, dtype=float), sizes)
+    # Exact while every sample fits in the sample
+    assert small.result()['percentiles'] == {f'p{p:g}': float(np.percentile(sizes, p))
+                                             for p in series.DEFAULT_PERCENTILES}
+
+    large = series.WindowAggregates(0, 10 ** 6, quota=0)
+    all_sizes = []
+    for page in range(100):
+        sizes = rng.integers(0, 10 ** 6, 10000)
+        large.add(np.arange(page * 10000, (page + 1) * 10000, dtype=float), sizes)
+        all_sizes.append(sizes)
+        assert len(large.sample_sizes) <= series.PERCENTILE_SAMPLE_SIZE
+    all_sizes = np.concatenate(all_sizes)
+    result = large.result()
+    assert result['count'] == len(all_sizes)
+    for p in series.DEFAULT_PERCENTILES:
+        # Within a few times the expected rank error of the estimate
+        rank = np.mean(all_sizes <= result['percentiles'][f'p{p:g}']) * 100
+        assert abs(rank - p) < 3
+
+def query(plotting, **params):
+    response = plotting.lambda_handler({'resource': '/query', 'queryStringParameters': params}, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+def test_query_pages_after_a_cursor_skip_the_aggregates(aws, plotting):
+    first, last = seed_history(aws, 500)
+    window = {'start': str(first), 'end': str(last), 'limit': '100'}
+    page = query(plotting, **window)
+    assert page['aggregates']['count'] == 500
+    assert page['next_cursor'] is not None
+
+    aws.api_calls.clear()
+    next_page = query(plotting, cursor=repr(page['next_cursor']), **window)
+    assert next_page['aggregates'] is None
+    assert next_page['timestamps'][0] > page['timestamps'][-1]
+    # Only the page itself was read, not the rest of the window
+    assert aws.api_calls['dynamodb:Query'] == 1
+
+    assert query(plotting, cursor=repr(page['next_cursor']), aggregates='true', **window)['aggregates']['count'] == 500
@@ -0,0 +1,177 @@
+import json
+import time
+from decimal import Decimal
+
+import pytest
+
+from offline.events import s3_record, sqs_batch
+from offline.stack import BUCKET, LAMBDA_ENVIRONMENTS, TABLE_NAME
+
+def created(aws, key, size, sequencer):
+    aws.s3.add_object(BUCKET, key, size)
+    return s3_record('ObjectCreated:Put', BUCKET, key, size, sequencer=sequencer)
+
+def tracked_total(aws, size_tracking):
+    item = aws.dynamodb.Table(TABLE_NAME).get_item(Key=size_tracking.aggregate_key(BUCKET))['Item']
+    return int(item['total_size']), int(item['object_count'])
+
+def failed_ids(response):
+    return [failure['itemIdentifier'] for failure in response['batchItemFailures']]
+
+def test_retry_after_the_sample_write_fails(aws, size_tracking, monkeypatch):
+    size_tracking.lambda_handler(sqs_batch([[created(aws, 'a', 10, '01')]]), None)
+    batch = sqs_batch([[created(aws, 'b', 7, '02')]], first_id=1)
+
+    def throttled(*args, **kwargs):
+        raise RuntimeError('throttled')
+    with monkeypatch.context() as patch:
+        patch.setattr(size_tracking, 'write_sample', throttled)
+        assert failed_ids(size_tracking.lambda_handler(batch, None)) == ['message-1']
+
+    assert failed_ids(size_tracking.lambda_handler(batch, None)) == []
+    assert tracked_total(aws, size_tracking) == (17, 2)
+
+def test_retry_after_the_aggregate_write_fails(aws, size_tracking, monkeypatch):
+    size_tracking.lambda_handler(sqs_batch([[created(aws, 'a', 10, '01')]]), None)
+    batch = sqs_batch([[created(aws, 'b', 7, '02')]], first_id=1)
+
+    def cancelled(**kwargs):
+        raise aws.dynamodb.exceptions.TransactionCanceledException(['None', 'TransactionConflict'])
+    with monkeypatch.context() as patch:
+        patch.setattr(aws.dynamodb, 'transact_write_items', cancelled)
+        patch.setattr(size_tracking, 'COMMIT_ATTEMPTS', 1)
+        assert failed_ids(size_tracking.lambda_handler(batch, None)) == ['message-1']
+    # Neither the index record nor the delta was written
+    assert tracked_total(aws, size_tracking) == (10, 1)
+
+    assert failed_ids(size_tracking.lambda_handler(batch, None)) == []
+    assert tracked_total(aws, size_tracking) == (17, 2)
+    # A redelivery after the commit is stale
+    size_tracking.lambda_handler(batch, None)
+    assert tracked_total(aws, size_tracking) == (17, 2)
+
+def test_reconcile_keeps_records_indexed_after_the_listing(aws, size_tracking, monkeypatch):
+    size_tracking.lambda_handler(sqs_batch([[created(aws, 'a', 10, '01')]]), None)
+    late = sqs_batch([[created(aws, 'x', 5, '02')]], first_id=1)
+    listing = size_tracking.list_bucket_objects
+
+    def listing_then_event(bucket_name):
+        # x is created after the listing started but before reconcile writes
+        listed = [entry for entry in listing(bucket_name) if entry[0] != 'x']
+        size_tracking.lambda_handler(late, None)
+        yield from listed
+    monkeypatch.setattr(size_tracking, 'list_bucket_objects', listing_then_event)
+    size_tracking.lambda_handler({'action': 'reconcile', 'bucketName': BUCKET}, None)
+    monkeypatch.undo()
+
+    assert tracked_total(aws, size_tracking) == (15, 2)
+    # x kept its sequencer, so a redelivery is still recognized as stale
+    size_tracking.lambda_handler(late, None)
+    assert tracked_total(aws, size_tracking) == (15, 2)
+
+def test_sequencers_order_as_the_numbers_they_encode(size_tracking):
+    def sequencer(value):
+        return size_tracking.get_sequencer(s3_record('ObjectCreated:Put', BUCKET, 'a', sequencer=value))
+    assert sequencer('9') < sequencer('0A') < sequencer('0a1') < sequencer('00000000FF')
+    assert sequencer('') == ''
+
+def test_duplicate_and_out_of_order_events_are_stale(aws, size_tracking):
+    aws.s3.add_object(BUCKET, 'a', 30)
+    first = s3_record('ObjectCreated:Put', BUCKET, 'a', 10, sequencer='0A')
+    latest = s3_record('ObjectCreated:Put', BUCKET, 'a', 30, sequencer='0C')
+    removed = s3_record('ObjectRemoved:Delete', BUCKET, 'a', sequencer='0B')
+
+    size_tracking.lambda_handler(sqs_batch([[first], [latest]]), None)
+    assert tracked_total(aws, size_tracking) == (30, 1)
+    # A duplicate, then an earlier delete arriving late: neither takes effect
+    size_tracking.lambda_handler(sqs_batch([[latest], [removed], [first]], first_id=2), None)
+    assert tracked_total(aws, size_tracking) == (30, 1)
+
+@pytest.mark.parametrize('tracking_mode', ['incremental', 'full'])
+def test_batches_of_ignored_records_write_nothing(aws, tracking_mode):
+    size_tracking = aws.load_lambda('size-tracking-lambda', dict(LAMBDA_ENVIRONMENTS['size-tracking-lambda'],
+                                                                 TRACKING_MODE=tracking_mode))
+    batch = sqs_batch([
+        [s3_record('ObjectCreated:Put', BUCKET, 'plot', 100, sequencer='01')],
+        [s3_record('ObjectCreated:Put', BUCKET, 'plot-cache/0123abcd.png', 100, sequencer='02'),
+         s3_record('ObjectRestore:Completed', BUCKET, 'a', sequencer='03')],
+    ])
+    aws.api_calls.clear()
+    response = size_tracking.lambda_handler(batch, None)
+    assert failed_ids(response) == []
+    assert json.loads(response['body'])['buckets'] == []
+    assert not aws.api_calls
+
+def compact(size_tracking):
+    response = size_tracking.lambda_handler({'action': 'compact', 'bucketName': BUCKET}, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+def test_compaction_folds_legacy_samples_into_rollups(aws, size_tracking):
+    table = aws.dynamodb.Table(TABLE_NAME)
+    day = size_tracking.COMPACTION_DAY_SECONDS
+    day_start = int((time.time() - 3 * day) // day) * day
+    # Raw samples written before they expired have no expires_at
+    for offset, size in [(100, 10), (110, 50), (4000, 5)]:
+        table.put_item(Item={'bucketName': BUCKET, 'timestamp': Decimal(day_start + offset),
+                             'total_size': size, 'object_count': 1})
+    # The hour rollup saw a spike to 80 within a batch, which no raw sample records
+    table.put_item(Item={'bucketName': f'{BUCKET}#hour', 'timestamp': day_start, 'sample_count': 1,
+                         'min_size': 20, 'min_timestamp': Decimal(day_start + 100),
+                         'max_size': 80, 'max_timestamp': Decimal(day_start + 105)})
+
+    result = compact(size_tracking)
+    cutoff = int((time.time() - size_tracking.COMPACT_AFTER_SECONDS) // day) * day
+    assert (result['days'], result['samples'], result['samples_expired']) == (1, 3, 3)
+    assert result['compacted_until'] == cutoff
+    assert table.get_item(Key=size_tracking.aggregate_key(BUCKET))['Item']['compacted_until'] == cutoff
+
+    hour = table.get_item(Key={'bucketName': f'{BUCKET}#hour', 'timestamp': day_start})['Item']
+    # The minimum widens to the samples', the maximum keeps the spike
+    assert (hour['sample_count'], hour['min_size'], hour['max_size'], hour['last_size']) == (2, 10, 80, 50)
+    day_rollup = table.get_item(Key={'bucketName': f'{BUCKET}#day', 'timestamp': day_start})['Item']
+    assert (day_rollup['sample_count'], day_rollup['min_size'], day_rollup['max_size']) == (3, 5, 50)
+    samples = list(aws.dynamodb.tables[TABLE_NAME].items[BUCKET].values())
+    assert len(samples) == 3
+    assert all(sample['expires_at'] == int(sample['timestamp']) + size_tracking.RAW_RETENTION_SECONDS
+               for sample in samples)
+
+    # Nothing is left to do, even when the progress marker is lost
+    aws.api_calls.clear()
+    assert compact(size_tracking)['days'] == 0
+    assert set(aws.api_calls) == {'dynamodb:GetItem'}
+    table.update_item(Key=size_tracking.aggregate_key(BUCKET), UpdateExpression='REMOVE compacted_until')
+    result = compact(size_tracking)
+    assert (result['days'], result['rollups_written'], result['samples_expired']) == (1, 0, 0)
+
+def cleanup_dispatched(response):
+    return [bucket['cleanup_dispatched'] for bucket in json.loads(response['body'])['buckets']]
+
+def test_quota_breaches_are_debounced_until_the_bucket_is_back_within_quota(aws, size_tracking):
+    assert size_tracking.QUOTA_BYTES == 20
+    response = size_tracking.lambda_handler(sqs_batch([[created(aws, 'a', 30, '01')]]), None)
+    assert cleanup_dispatched(response) == [True]
+    assert aws.lambda_.invocations == [('cleaner-lambda', {
+        'source': 'size-tracking', 'bucketName': BUCKET, 'target_size': 20, 'overage': 10
+    })]
+
+    # Further breaches within the debounce window are left to that cleanup
+    response = size_tracking.lambda_handler(sqs_batch([[created(aws, 'b', 5, '02')]], first_id=1), None)
+    assert cleanup_dispatched(response) == [False]
+    assert len(aws.lambda_.invocations) == 1
+    aggregate = size_tracking.read_aggregate(BUCKET)
+    retry_at = aggregate['cleanup_retry_at']
+    assert retry_at == aggregate['cleanup_requested_at'] + size_tracking.CLEANUP_DEBOUNCE_SECONDS
+    assert not size_tracking.enforce_quota(BUCKET, aggregate, 35, retry_at - 1)
+    # ... and dispatched again once it has passed without the bucket recovering
+    assert size_tracking.enforce_quota(BUCKET, aggregate, 35, retry_at)
+    assert len(aws.lambda_.invocations) == 2
+
+    # Back within quota, the marker is cleared, so the next breach dispatches at once
+    aws.s3.delete_object(Bucket=BUCKET, Key='a')
+    size_tracking.lambda_handler(sqs_batch([[s3_record('ObjectRemoved:Delete', BUCKET, 'a', sequencer='03')]],
+                                           first_id=2), None)
+    assert 'cleanup_retry_at' not in size_tracking.read_aggregate(BUCKET)
+    response = size_tracking.lambda_handler(sqs_batch([[created(aws, 'c', 16, '04')]], first_id=3), None)
+    assert cleanup_dispatched(response) == [True]
+    assert aws.lambda_.invocations[-1][1]['overage'] == 1